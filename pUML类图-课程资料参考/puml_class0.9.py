@@ -1,11 +1,15 @@
-from typing import List, Annotated
+from typing import Dict, List, Annotated, Optional
 from pydantic import BaseModel, Field
 from langgraph.graph import StateGraph, END
 from langchain.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
+from langchain_core.runnables import Runnable
+import contextvars
+import io
 import re
 import os
+import threading
 os.environ['OPENAI_API_BASE_URL'] = 'https://api.91ai.me/v1'  # 注意环境变量名称的变更
 os.environ['OPENAI_API_KEY'] = '添加密钥。。。。。。。。。。。。。。。。。。'
 from langchain.output_parsers import PydanticOutputParser
@@ -264,12 +268,930 @@ Association_prompt = PromptTemplate(
     partial_variables={"format_instructions": format_instructions}
 )
 
+# ---------------- 运行上下文与截止时间 ----------------
+# 一次运行的截止时间、各阶段的时间预算和被跳过的工作记录在上下文变量中，
+# 随LangGraph节点、工具和各线程一起传播，每次链调用都经过invoke_chain检查剩余时间
+class DeadlineExceeded(Exception):
+    """运行或当前阶段已超过截止时间"""
+
+
+class RunContext:
+    def __init__(self, deadline: Optional[float] = None, low_value_reserve: float = 0.4):
+        import time
+        self.started = time.monotonic()
+        self.deadline = self.started + deadline if deadline else None
+        self.stage_deadline = None
+        # 剩余时间少于总时长的这一比例时跳过低价值的工作（如推理新的子类）
+        self.low_value_reserve = low_value_reserve
+        self.skipped: List[str] = []
+        # 逐类分析阶段中因超时未完成的类，阶段名→类名；工作表据此补做，不把它们记为已分析
+        self.unfinished: Dict[str, List[str]] = {}
+        self.timed_out = False
+        self._lock = threading.Lock()
+
+    def skip(self, message: str, stage: Optional[str] = None, classes=()):
+        with self._lock:
+            self.skipped.append(message)
+            if stage is not None:
+                self.unfinished.setdefault(stage, []).extend(classes)
+        print("跳过：", message)
+
+    def take_unfinished(self, stage: str) -> List[str]:
+        """取出并清空stage阶段记录的未完成的类"""
+        with self._lock:
+            return self.unfinished.pop(stage, [])
+
+
+def _take_unfinished(stage: str) -> List[str]:
+    """当前运行中stage阶段未完成的类，没有运行上下文时为空"""
+    ctx = _run_context.get()
+    return ctx.take_unfinished(stage) if ctx is not None else []
+
+
+_run_context = contextvars.ContextVar("puml_run_context", default=None)
+
+
+def _remaining_time() -> Optional[float]:
+    """当前阶段（不超过整次运行）剩余的秒数，没有设置截止时间时返回None"""
+    import time
+    ctx = _run_context.get()
+    if ctx is None or ctx.deadline is None:
+        return None
+    deadline = min(ctx.deadline, ctx.stage_deadline or ctx.deadline)
+    return deadline - time.monotonic()
+
+
+def _short_of_time() -> bool:
+    """剩余时间是否已不足以做低价值的工作"""
+    import time
+    ctx = _run_context.get()
+    if ctx is None or ctx.deadline is None:
+        return False
+    return ctx.deadline - time.monotonic() < (ctx.deadline - ctx.started) * ctx.low_value_reserve
+
+
+# 单飞：相同的链（提示模板、模型、解析器）以相同输入并发调用时只执行一次，其余调用等待并得到结果的副本
+_inflight_lock = threading.Lock()
+_inflight_calls = {}
+single_flight_stats = {"calls": 0, "coalesced": 0}
+
+
+def _chain_key(chain, inputs: dict) -> str:
+    import hashlib
+    import json
+
+    def step_key(step):
+        # 模型按名称区分，端点池等每次新建的Runnable按名称区分，其余步骤（提示、解析器）按完整内容区分
+        model = getattr(step, "model_name", None)
+        if model is not None:
+            return f"model:{model}:{getattr(step, 'temperature', None)}"
+        if type(step).__name__ == "RunnableLambda":
+            return f"lambda:{step.get_name()}"
+        if isinstance(step, _EndpointPoolRunnable):
+            return f"pool:{id(step.pool)}:{step.model}"
+        return repr(step)
+
+    def default(value):
+        if isinstance(value, BaseModel):
+            return value.model_dump()
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        return repr(value)
+
+    steps = getattr(chain, "steps", [chain])
+    payload = json.dumps(["|".join(step_key(step) for step in steps), inputs],
+                         ensure_ascii=False, sort_keys=True, default=default)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _single_flight(chain, inputs: dict):
+    from concurrent.futures import Future
+    key = _chain_key(chain, inputs)
+    with _inflight_lock:
+        single_flight_stats["calls"] += 1
+        future = _inflight_calls.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight_calls[key] = Future()
+        else:
+            single_flight_stats["coalesced"] += 1
+    if leader:
+        try:
+            future.set_result(chain.invoke(inputs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with _inflight_lock:
+                del _inflight_calls[key]
+        return future.result()
+    result = future.result()
+    # 各调用方会就地合并结果，共享的结果需要复制
+    return result.model_copy(deep=True) if isinstance(result, BaseModel) else result
+
+
+def invoke_chain(chain, inputs: dict, optional: bool = False, label: str = ""):
+    """调用链：相同的在途调用合并为一次；时间不足时跳过可选调用（返回空类图），
+    超过截止时间时放弃在途调用并抛出DeadlineExceeded"""
+    remaining = _remaining_time()
+    if remaining is None:
+        return _single_flight(chain, inputs)
+    ctx = _run_context.get()
+    if optional and _short_of_time():
+        ctx.skip(f"时间不足，跳过可选调用：{label}")
+        return ClassDiagram()
+    if remaining <= 0:
+        raise DeadlineExceeded(label)
+    box = {}
+
+    def call():
+        try:
+            box["result"] = _single_flight(chain, inputs)
+        except BaseException as e:
+            box["error"] = e
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(call,), daemon=True)
+    thread.start()
+    thread.join(remaining)
+    if thread.is_alive():
+        # 在途的调用无法强行终止，放弃其结果；create_llm设置的请求超时会让它随后自行结束
+        raise DeadlineExceeded(label)
+    if "error" in box:
+        raise box["error"]
+    return box["result"]
+
+
+# ---------------- 性能剖析 ----------------
+# 默认关闭，包装的函数只多一次全局变量判断；configure_profiling指定目录后，本地阶段和图节点的每次执行
+# 用cProfile、tracemalloc和栈采样剖析，写出<序号>_<阶段>.prof（pstats/snakeviz可读）、
+# .collapsed（flamegraph.pl/speedscope可读的折叠栈）和.mem.txt（内存峰值和分配最多的代码行）
+_profile_settings = None
+_profile_sequence = 0
+_profile_lock = threading.Lock()
+_profile_local = threading.local()
+# 正在做内存剖析的阶段数，以及tracemalloc是否由剖析开启（开启前已在跟踪时不由剖析关闭）
+_profile_memory = {"stages": 0, "owned": False}
+
+
+def configure_profiling(directory: Optional[str], sample_interval: float = 0.005, memory: bool = True,
+                        memory_frames: int = 8):
+    """directory不为空时开启剖析，结果写入该目录，为空时关闭；memory为False时不做tracemalloc（它会让被测代码明显变慢）；
+    tracemalloc只在被剖析的阶段执行期间开启，阶段之间的代码不受影响"""
+    global _profile_settings
+    if not directory:
+        _profile_settings = None
+        return
+    os.makedirs(directory, exist_ok=True)
+    _profile_settings = {"directory": directory, "interval": sample_interval, "memory": memory,
+                         "memory_frames": memory_frames, "pid": os.getpid()}
+    print(f"性能剖析已开启，结果写入{directory}")
+
+
+def _start_memory_tracing(frames: int):
+    """阶段开始时开启tracemalloc；已在跟踪（其他阶段或调用方开启）时沿用"""
+    import tracemalloc
+    with _profile_lock:
+        if _profile_memory["stages"] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            _profile_memory["owned"] = True
+        _profile_memory["stages"] += 1
+
+
+def _stop_memory_tracing():
+    """阶段结束时，最后一个做内存剖析的阶段关闭由剖析开启的tracemalloc"""
+    import tracemalloc
+    with _profile_lock:
+        _profile_memory["stages"] -= 1
+        if _profile_memory["stages"] == 0 and _profile_memory["owned"]:
+            tracemalloc.stop()
+            _profile_memory["owned"] = False
+
+
+def _sample_stacks(thread_id: int, interval: float, stop: threading.Event, counts: dict):
+    """每隔interval秒采样一次thread_id线程的调用栈，按折叠栈累计次数"""
+    import sys
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+
+def _profile_call(settings: dict, name: str, func, args, kwargs):
+    """剖析一次阶段执行并写出结果文件；只采样和剖析调用线程，阶段内另开的线程不计入；
+    tracemalloc是全局的，多个阶段并发执行时内存峰值互相包含"""
+    import cProfile
+    import time
+    import tracemalloc
+    global _profile_sequence
+    with _profile_lock:
+        _profile_sequence += 1
+        sequence = _profile_sequence
+    prefix = os.path.join(settings["directory"], f"{sequence:04d}_" + re.sub(r'[^\w.-]+', '_', name))
+    if settings["memory"]:
+        _start_memory_tracing(settings["memory_frames"])
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+    counts = {}
+    stop = threading.Event()
+    sampler = threading.Thread(target=_sample_stacks, args=(threading.get_ident(), settings["interval"], stop, counts),
+                               daemon=True)
+    profiler = cProfile.Profile()
+    _profile_local.active = True
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+    finally:
+        elapsed = time.perf_counter() - started
+        stop.set()
+        sampler.join()
+        _profile_local.active = False
+        if settings["memory"]:
+            # 先取内存统计再写文件，写文件的分配不计入阶段
+            try:
+                current, peak = tracemalloc.get_traced_memory()
+                statistics = tracemalloc.take_snapshot().filter_traces(
+                    (tracemalloc.Filter(False, tracemalloc.__file__),)).statistics("lineno")
+            finally:
+                _stop_memory_tracing()
+        profiler.dump_stats(prefix + ".prof")
+        with open(prefix + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in sorted(counts.items()):
+                f.write(f"{stack} {count}\n")
+        summary = f"剖析：{name}耗时{elapsed:.3f}s，采样{sum(counts.values())}次"
+        if settings["memory"]:
+            with open(prefix + ".mem.txt", "w", encoding="utf-8") as f:
+                f.write(f"阶段：{name}\n耗时：{elapsed:.3f}s\n")
+                f.write(f"峰值内存：{(peak - memory_before) / 1024:.1f}KiB（阶段开始时已占用{memory_before / 1024:.1f}KiB）\n")
+                f.write(f"结束时仍占用：{(current - memory_before) / 1024:.1f}KiB\n\n分配最多的代码行：\n")
+                for stat in statistics[:25]:
+                    f.write(f"{stat}\n")
+            summary += f"，峰值内存{(peak - memory_before) / 1024:.1f}KiB"
+        print(summary)
+
+
+def profile_stage(name: str):
+    """装饰器：剖析开启时剖析被装饰函数的每次执行；已在剖析中的嵌套阶段和子进程中直接执行"""
+    import functools
+
+    def decorate(func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            settings = _profile_settings
+            if settings is None or getattr(_profile_local, "active", False) or settings["pid"] != os.getpid():
+                return func(*args, **kwargs)
+            return _profile_call(settings, name, func, args, kwargs)
+
+        return run
+
+    return decorate
+
+
+# ---------------- 多端点负载均衡 ----------------
+# 配置多个OpenAI兼容的网关后，每次链调用路由到当前最优的健康端点：
+# 按EWMA延迟和在途请求数打分，连续失败或错误率过高的端点被摘除，冷却后以单个探测请求重新接入
+class EndpointConfig(BaseModel):
+    base_url: str
+    api_key: str
+    max_concurrency: int = Field(default=4, description="该端点同时在途的请求上限")
+
+
+class Endpoint:
+    def __init__(self, config: EndpointConfig):
+        self.config = config
+        self.in_flight = 0
+        self.latency = None  # EWMA延迟（秒），None表示尚无样本
+        self.error_rate = 0.0  # EWMA错误率
+        self.failures = 0  # 连续失败次数
+        self.ejected_until = 0.0
+        self.cooldown = 0.0
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+
+
+def _is_endpoint_error(error: Exception) -> bool:
+    """连接失败、超时、5xx和429说明端点本身有问题，应换端点重试并计入该端点的错误；
+    其余错误（如400请求错误、上下文超长）换到哪个端点都一样，直接抛出"""
+    try:
+        import openai
+    except ImportError:
+        openai = None
+    if openai is not None:
+        if isinstance(error, openai.APIConnectionError):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class _EndpointPoolRunnable(Runnable):
+    """端点池的Runnable包装：invoke和stream都经端点池路由，stream逐段产出"""
+
+    def __init__(self, pool: "EndpointPool", model: str):
+        self.pool = pool
+        self.model = model
+        self.name = f"EndpointPool[{model}]"
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.pool.invoke(input, self.model)
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.pool.stream(input, self.model)
+
+
+class EndpointPool:
+    """OpenAI兼容端点池：最小延迟路由、故障摘除与重新探测、单端点并发上限"""
+
+    def __init__(self, configs: List[EndpointConfig], alpha: float = 0.3, eject_after: int = 3,
+                 max_error_rate: float = 0.5, base_cooldown: float = 5.0, max_cooldown: float = 60.0):
+        if not configs:
+            raise ValueError("端点池至少需要一个端点")
+        self.endpoints = [Endpoint(config) for config in configs]
+        self.alpha = alpha
+        self.eject_after = eject_after
+        self.max_error_rate = max_error_rate
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self._clients = {}
+        self._changed = threading.Condition()
+
+    @classmethod
+    def from_env(cls) -> Optional["EndpointPool"]:
+        """从OPENAI_API_BASE_URLS/OPENAI_API_KEYS（逗号分隔，单个密钥可共用）读取端点配置，未配置时返回None"""
+        urls = [u.strip() for u in os.environ.get("OPENAI_API_BASE_URLS", "").split(",") if u.strip()]
+        if not urls:
+            return None
+        keys = [k.strip() for k in os.environ.get("OPENAI_API_KEYS", os.environ.get("OPENAI_API_KEY", "")).split(",")]
+        concurrency = int(os.environ.get("OPENAI_ENDPOINT_CONCURRENCY", "4"))
+        return cls([EndpointConfig(base_url=url, api_key=keys[i] if i < len(keys) else keys[-1],
+                                   max_concurrency=concurrency) for i, url in enumerate(urls)])
+
+    def _score(self, endpoint: Endpoint) -> float:
+        # 没有样本的端点优先试用；在途请求越多、错误率越高得分越差
+        latency = endpoint.latency if endpoint.latency is not None else 0.0
+        return latency * (1 + endpoint.in_flight) / max(0.05, 1 - endpoint.error_rate)
+
+    def _acquire(self, exclude) -> Endpoint:
+        """选出得分最优且有空闲并发的健康端点；全部繁忙时等待，全部摘除时选冷却最早结束的端点探测"""
+        import time
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                candidates = []
+                for endpoint in self.endpoints:
+                    if endpoint in exclude or endpoint.in_flight >= endpoint.config.max_concurrency:
+                        continue
+                    if endpoint.ejected_until > now or (endpoint.ejected_until and endpoint.probing):
+                        continue
+                    candidates.append(endpoint)
+                if not candidates and all(e in exclude or e.ejected_until > now for e in self.endpoints):
+                    remaining = [e for e in self.endpoints if e not in exclude]
+                    if not remaining:
+                        raise RuntimeError("端点池中没有可用的端点")
+                    soonest = min(remaining, key=lambda e: e.ejected_until)
+                    candidates = [] if soonest.probing else [soonest]
+                if candidates:
+                    endpoint = min(candidates, key=self._score)
+                    if endpoint.ejected_until:
+                        endpoint.probing = True  # 冷却结束后只放行一个探测请求
+                    endpoint.in_flight += 1
+                    endpoint.requests += 1
+                    return endpoint
+                remaining_time = _remaining_time()
+                if remaining_time is not None and remaining_time <= 0:
+                    raise DeadlineExceeded("等待空闲端点")
+                self._changed.wait(timeout=0.5 if remaining_time is None else min(0.5, remaining_time))
+
+    def _release(self, endpoint: Endpoint, latency: Optional[float], error: bool):
+        import time
+        with self._changed:
+            endpoint.in_flight -= 1
+            endpoint.error_rate = (1 - self.alpha) * endpoint.error_rate + self.alpha * (1.0 if error else 0.0)
+            if error:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                already_ejected = endpoint.ejected_until > time.monotonic() and not endpoint.probing
+                if not already_ejected and (endpoint.probing or endpoint.failures >= self.eject_after
+                                            or endpoint.error_rate > self.max_error_rate):
+                    endpoint.cooldown = min(self.max_cooldown, endpoint.cooldown * 2 or self.base_cooldown)
+                    endpoint.ejected_until = time.monotonic() + endpoint.cooldown
+                    print(f"端点{endpoint.config.base_url}被摘除{endpoint.cooldown:.0f}秒")
+            else:
+                # 超时放弃或请求本身出错时没有延迟样本
+                if latency is not None:
+                    endpoint.latency = latency if endpoint.latency is None else \
+                        (1 - self.alpha) * endpoint.latency + self.alpha * latency
+                endpoint.failures = 0
+                if endpoint.ejected_until:
+                    print(f"端点{endpoint.config.base_url}探测成功，重新接入")
+                endpoint.ejected_until = 0.0
+                endpoint.cooldown = 0.0
+            endpoint.probing = False
+            self._changed.notify_all()
+
+    def _client(self, endpoint: Endpoint, model: str):
+        remaining = _remaining_time()
+        if remaining is not None:
+            return ChatOpenAI(openai_api_base=endpoint.config.base_url, openai_api_key=endpoint.config.api_key,
+                              model=model, temperature=0, max_retries=0, timeout=max(remaining, 1.0))
+        key = (endpoint.config.base_url, model)
+        if key not in self._clients:
+            # 重试由端点池负责，换到其他端点上进行
+            self._clients[key] = ChatOpenAI(openai_api_base=endpoint.config.base_url,
+                                            openai_api_key=endpoint.config.api_key,
+                                            model=model, temperature=0, max_retries=0)
+        return self._clients[key]
+
+    def invoke(self, prompt, model: str = "gpt-4"):
+        """把一次对话请求路由到最优端点，端点故障时换端点重试，每个端点最多尝试一次；请求本身的错误直接抛出"""
+        import time
+        tried = set()
+        last_error = None
+        while len(tried) < len(self.endpoints):
+            endpoint = self._acquire(tried)
+            tried.add(endpoint)
+            started = time.monotonic()
+            try:
+                result = self._client(endpoint, model).invoke(prompt)
+            except DeadlineExceeded:
+                self._release(endpoint, None, False)
+                raise
+            except Exception as e:
+                endpoint_error = _is_endpoint_error(e)
+                self._release(endpoint, None, endpoint_error)
+                if not endpoint_error:
+                    raise
+                print(f"端点{endpoint.config.base_url}调用失败：{e}")
+                last_error = e
+                continue
+            self._release(endpoint, time.monotonic() - started, False)
+            return result
+        raise last_error
+
+    def stream(self, prompt, model: str = "gpt-4"):
+        """流式调用：与invoke相同地选择端点和换端点重试，但已经产出内容后出错时不再重试（内容无法撤回）"""
+        import time
+        tried = set()
+        last_error = None
+        while len(tried) < len(self.endpoints):
+            endpoint = self._acquire(tried)
+            tried.add(endpoint)
+            started = time.monotonic()
+            emitted = False
+            try:
+                for chunk in self._client(endpoint, model).stream(prompt):
+                    emitted = True
+                    yield chunk
+            except (DeadlineExceeded, GeneratorExit):
+                # 超过截止时间或调用方不再读取
+                self._release(endpoint, None, False)
+                raise
+            except Exception as e:
+                endpoint_error = _is_endpoint_error(e)
+                self._release(endpoint, None, endpoint_error)
+                if not endpoint_error or emitted:
+                    raise
+                print(f"端点{endpoint.config.base_url}调用失败：{e}")
+                last_error = e
+                continue
+            self._release(endpoint, time.monotonic() - started, False)
+            return
+        raise last_error
+
+    def as_runnable(self, model: str = "gpt-4"):
+        """包装成可放进prompt | llm | parser链中的Runnable，stream保持逐段输出"""
+        return _EndpointPoolRunnable(self, model)
+
+    def stats(self) -> List[dict]:
+        import time
+        now = time.monotonic()
+        return [{"base_url": e.config.base_url, "ewma_latency": e.latency, "error_rate": round(e.error_rate, 3),
+                 "requests": e.requests, "errors": e.errors, "in_flight": e.in_flight,
+                 "ejected": e.ejected_until > now} for e in self.endpoints]
+
+
+_endpoint_pool = None
+
+
+def configure_endpoint_pool(pool: Optional[EndpointPool]):
+    """设置全局端点池，设为None时回到单一的OPENAI_API_BASE_URL"""
+    global _endpoint_pool
+    _endpoint_pool = pool
+
+
+def create_llm(model: str = "gpt-4"):
+    """创建各分析工具使用的对话模型；配置了端点池时返回经端点池路由的Runnable，
+    设置了截止时间时请求超时不超过剩余时间"""
+    pool = _endpoint_pool or EndpointPool.from_env()
+    if pool is not None:
+        configure_endpoint_pool(pool)
+        return pool.as_runnable(model)
+    remaining = _remaining_time()
+    return ChatOpenAI(
+        openai_api_base=os.environ['OPENAI_API_BASE_URL'],
+        openai_api_key=os.environ['OPENAI_API_KEY'],
+        model=model, temperature=0, **({"timeout": max(remaining, 1.0)} if remaining is not None else {}))
+
+
 # 使用Pydantic定义状态数据模型
+# ---------------- 类图校验 ----------------
+# 在图节点之间对中间类图做一次基于索引的线性扫描：发现空条目、丢失或重复的类、悬空端点、重复边、
+# 继承环和字段异常，能直接修复的就地修复，丢失特征的类只对这些类重新请求特征分析
+class Diagnostic(BaseModel):
+    code: str = Field(description="问题类别：none_class、lost_class、duplicate_class、duplicate_member、empty_class、"
+                                  "dangling_endpoint、duplicate_edge、inheritance_cycle、schema_anomaly")
+    severity: str = Field(default="error", description="error或warning")
+    message: str = Field(description="问题描述")
+    classes: List[str] = Field(default_factory=list, description="涉及的类名")
+    action: str = Field(default="", description="修复方式：removed、merged、restored、normalized、requery，为空表示未处理")
+    stage: str = Field(default="", description="发现问题的阶段")
+
+
+class ValidationResult(BaseModel):
+    class_model: ClassDiagram = Field(description="修复后的类图")
+    diagnostics: List[Diagnostic] = Field(default_factory=list)
+    requery: List[str] = Field(default_factory=list, description="需要重新请求特征分析的类")
+
+
+_RELATION_DEFAULT_TYPES = {
+    "association_relationships": "关联",
+    "inheritance_relationships": "继承",
+    "aggregation_relationships": "聚合",
+    "composition_relationships": "组合",
+    "dependency_relationships": "依赖",
+}
+
+
+def _normalize_navigation(value) -> Optional[str]:
+    """把导航属性规范为"True"/"False"，无法识别时返回None"""
+    value = str(value or "").strip().lower()
+    if value in ("true", "yes", "1", "是", "可导航"):
+        return "True"
+    if value in ("false", "no", "0", "否", "", "none"):
+        return "False"
+    return None
+
+
+@profile_stage("validate_classdiagram")
+def validate_classdiagram(classmodel: ClassDiagram, previous: Optional[ClassDiagram] = None) -> ValidationResult:
+    """校验并修复类图副本，时间与类和关系的总数成线性；previous为上一阶段的类图，用于找回本阶段丢失的类"""
+    # 成员和关系字段都是字符串，逐层浅复制即可，比deepcopy快一个数量级
+    model = ClassDiagram.model_construct(
+        classes=[cls if cls is None else cls.model_copy(update={"attributes": list(cls.attributes),
+                                                                 "methods": list(cls.methods)})
+                 for cls in classmodel.classes],
+        **{field: [rel if rel is None else rel.model_copy() for rel in getattr(classmodel, field)]
+           for field in _RELATION_DEFAULT_TYPES})
+    diagnostics = []
+    requery = []
+
+    def report(code, message, classes=(), action="", severity="error"):
+        diagnostics.append(Diagnostic(code=code, severity=severity, message=message, classes=list(classes), action=action))
+
+    # 类：去掉空条目，合并同名类，去掉重复成员
+    classes = {}
+    none_count = 0
+    for cls in model.classes:
+        if cls is None:
+            none_count += 1
+            continue
+        name = (cls.class_name or "").strip()
+        if not name:
+            report("schema_anomaly", "类名为空", action="removed")
+            continue
+        if name != cls.class_name:
+            report("schema_anomaly", f"类名“{cls.class_name}”两端有空白", [name], "normalized", "warning")
+            cls.class_name = name
+        for field in ("attributes", "methods"):
+            members = getattr(cls, field)
+            unique = list(dict.fromkeys(m for m in members if m and m.strip()))
+            if len(unique) != len(members):
+                report("duplicate_member", f"类{name}的{field}中有重复或空的成员", [name], "normalized", "warning")
+                setattr(cls, field, unique)
+        existing = classes.get(name)
+        if existing is None:
+            classes[name] = cls
+            continue
+        report("duplicate_class", f"类{name}重复出现", [name], "merged")
+        for field in ("attributes", "methods"):
+            members = getattr(existing, field)
+            seen = set(members)
+            members.extend(m for m in getattr(cls, field) if m not in seen)
+    if none_count:
+        report("none_class", f"{none_count}个类条目为空（通常是LLM改了类名）", action="removed")
+    if previous is not None:
+        # 各阶段都不应删除类：本阶段丢失的类按上一阶段的样子找回，并重新请求它的特征
+        for cls in previous.classes:
+            if cls is not None and cls.class_name not in classes:
+                classes[cls.class_name] = cls.model_copy(deep=True)
+                requery.append(cls.class_name)
+                report("lost_class", f"类{cls.class_name}在本阶段丢失", [cls.class_name], "restored")
+    for name, cls in classes.items():
+        if not cls.attributes and not cls.methods:
+            requery.append(name)
+            report("empty_class", f"类{name}没有属性和方法", [name], "requery", "warning")
+    model.classes = list(classes.values())
+
+    # 关系：去掉悬空端点和重复边，规范导航属性和关系类型
+    for field, default_type in _RELATION_DEFAULT_TYPES.items():
+        seen = set()
+        kept = []
+        for rel in getattr(model, field):
+            if rel is None:
+                report("schema_anomaly", f"{field}中有空条目", action="removed")
+                continue
+            rel.source_class, rel.target_class = rel.source_class.strip(), rel.target_class.strip()
+            missing = [n for n in (rel.source_class, rel.target_class) if n not in classes]
+            if missing:
+                report("dangling_endpoint", f"{field}中{rel.source_class}→{rel.target_class}引用了不存在的类",
+                       missing, "removed")
+                continue
+            if not rel.relation_type.strip():
+                rel.relation_type = default_type
+            if field == "association_relationships":
+                for nav in ("source_navigation", "target_navigation"):
+                    value = _normalize_navigation(getattr(rel, nav))
+                    if value != getattr(rel, nav):
+                        report("schema_anomaly", f"关联{rel.assicaiation_name}的{nav}取值“{getattr(rel, nav)}”不规范",
+                               [rel.source_class, rel.target_class], "normalized", "warning")
+                        setattr(rel, nav, value or "False")
+            if field == "inheritance_relationships" and rel.source_class == rel.target_class:
+                report("inheritance_cycle", f"类{rel.source_class}继承自身", [rel.source_class], "removed")
+                continue
+            key = tuple(rel.__dict__.values())
+            if key in seen:
+                report("duplicate_edge", f"{field}中{rel.source_class}→{rel.target_class}重复", 
+                       [rel.source_class, rel.target_class], "removed", "warning")
+                continue
+            seen.add(key)
+            kept.append(rel)
+        setattr(model, field, kept)
+
+    # 继承环：沿子类→父类做一次迭代DFS，去掉每条回边即可消除所有环
+    parents = {}
+    for i, rel in enumerate(model.inheritance_relationships):
+        parents.setdefault(rel.source_class, []).append((rel.target_class, i))
+    color = {}  # 1：在当前路径上，2：已完成
+    position = {}
+    path = []
+    back_edges = set()
+    for start in parents:
+        if start in color:
+            continue
+        color[start], position[start] = 1, 0
+        path.append(start)
+        stack = [iter(parents[start])]
+        while stack:
+            step = next(stack[-1], None)
+            if step is None:
+                color[path.pop()] = 2
+                stack.pop()
+                continue
+            parent, i = step
+            state = color.get(parent)
+            if state == 1:
+                back_edges.add(i)
+                cycle = path[position[parent]:] + [parent]
+                report("inheritance_cycle", "继承关系成环：" + " → ".join(cycle), cycle[:-1], "removed")
+            elif state is None:
+                color[parent], position[parent] = 1, len(path)
+                path.append(parent)
+                stack.append(iter(parents.get(parent, ())))
+    if back_edges:
+        model.inheritance_relationships = [rel for i, rel in enumerate(model.inheritance_relationships)
+                                           if i not in back_edges]
+    return ValidationResult(class_model=model, diagnostics=diagnostics, requery=requery)
+
+
+def print_diagnostics(diagnostics: List[Diagnostic]):
+    for d in diagnostics:
+        action = f"（{d.action}）" if d.action else ""
+        print(f"[{d.severity}] {d.stage} {d.code}：{d.message}{action}")
+
+
+# ---------------- 类簇划分 ----------------
+# 类很多时，泛化和关联分析的每次调用都带上全部类名，提示随类数线性增长、总token随类数平方增长；
+# 按需求文本中类的同句共现和已有关系建图，用标签传播划分类簇，逐类分析只带上所在类簇和少量边界类，
+# 最后每个类簇再做一次只含代表类的跨类簇分析
+_SENTENCE_SPLIT = re.compile(r'[。！？；!?;\n]+|\.(?=\s|$)')
+
+
+class ClusterOptions(BaseModel):
+    min_classes: int = Field(default=100, description="类数少于该值时不划分类簇，逐类分析带上全部类名")
+    max_cluster_size: int = Field(default=30, description="每个类簇最多包含的类数")
+    boundary_size: int = Field(default=8, description="每个类簇附带的边界类数（与类簇联系最紧密的簇外类）")
+    hubs_per_cluster: int = Field(default=3, description="跨类簇分析中代表每个类簇的类数")
+    relation_weight: float = Field(default=2.0, description="已有关系在共现图中的边权")
+    max_iterations: int = Field(default=20, description="标签传播的迭代上限")
+    seed: int = 7
+
+
+class ClassClusters(BaseModel):
+    clusters: List[List[str]] = Field(default_factory=list)
+    boundary: List[List[str]] = Field(default_factory=list, description="各类簇的边界类")
+    hubs: List[List[str]] = Field(default_factory=list, description="各类簇中与簇外联系最紧密的代表类")
+    membership: Dict[str, int] = Field(default_factory=dict, description="类名到所在类簇的序号")
+
+    def scope(self, names: List[str]) -> List[str]:
+        """names所在的类簇及其边界类；有类不在任何类簇中时返回空表，由调用方退回全部类名"""
+        positions = [self.membership.get(name) for name in names]
+        if not positions or None in positions:
+            return []
+        return list(dict.fromkeys(name for i in dict.fromkeys(positions)
+                                  for name in self.clusters[i] + self.boundary[i]))
+
+    def cross_cluster_calls(self) -> List[tuple]:
+        """跨类簇分析：每个类簇一次调用，(本类簇的代表类, 其他类簇的代表类)"""
+        calls = []
+        for i, hubs in enumerate(self.hubs):
+            others = [name for j, other in enumerate(self.hubs) if j != i for name in other]
+            if hubs and others:
+                calls.append((hubs, others))
+        return calls
+
+
+def _cooccurrence_graph(text: str, classmodel: ClassDiagram, class_names: List[str],
+                        options: ClusterOptions) -> Dict[str, Dict[str, float]]:
+    """带权无向图：同一句中提到的类两两连边（一句提到k个类时每条边权1/(k-1)），已有关系按relation_weight连边"""
+    import bisect
+    graph = {name: {} for name in class_names}
+
+    def link(a, b, weight):
+        if a != b and a in graph and b in graph:
+            graph[a][b] = graph[a].get(b, 0.0) + weight
+            graph[b][a] = graph[b].get(a, 0.0) + weight
+
+    sentence_starts = [0] + [m.end() for m in _SENTENCE_SPLIT.finditer(text)]
+    hits = []
+    for name in class_names:
+        start = text.find(name) if name else -1
+        while start != -1:
+            hits.append((start, -len(name), name))
+            start = text.find(name, start + 1)
+    hits.sort()
+    mentions = {}
+    covered = 0
+    for start, negative_length, name in hits:
+        # 同一位置取最长的类名，包含在较长类名中的短类名（如“订单项”中的“订单”）不计
+        if start < covered:
+            continue
+        covered = start - negative_length
+        mentions.setdefault(bisect.bisect_right(sentence_starts, start) - 1, set()).add(name)
+    for names in mentions.values():
+        # 一句罗列了大量类时不能说明它们关系紧密
+        if len(names) < 2 or len(names) > options.max_cluster_size:
+            continue
+        names = sorted(names)
+        weight = 1.0 / (len(names) - 1)
+        for i, a in enumerate(names):
+            for b in names[i + 1:]:
+                link(a, b, weight)
+    for field in _RELATION_DEFAULT_TYPES:
+        for rel in getattr(classmodel, field):
+            if rel is not None:
+                link(rel.source_class, rel.target_class, options.relation_weight)
+    return graph
+
+
+def _label_propagation(graph: Dict[str, Dict[str, float]], class_names: List[str], options: ClusterOptions) -> Dict[str, int]:
+    """异步标签传播：每个类随机顺序地采用邻居中权重和最大的标签，平局时保留原标签，没有变化或达到迭代上限时停止"""
+    import random
+    rng = random.Random(options.seed)
+    labels = {name: i for i, name in enumerate(class_names)}
+    order = list(class_names)
+    for _ in range(options.max_iterations):
+        rng.shuffle(order)
+        changed = False
+        for name in order:
+            weights = {}
+            for other, weight in graph[name].items():
+                weights[labels[other]] = weights.get(labels[other], 0.0) + weight
+            if not weights:
+                continue
+            best = max(weights.values())
+            if weights.get(labels[name], 0.0) >= best:
+                continue
+            labels[name] = min(label for label, weight in weights.items() if weight == best)
+            changed = True
+        if not changed:
+            break
+    return labels
+
+
+def cluster_classes(text: str, classmodel: ClassDiagram, options: Optional[ClusterOptions] = None) -> Optional[ClassClusters]:
+    """把类划分为规模不超过max_cluster_size的类簇，并求出各类簇的边界类和代表类；
+    类数少于min_classes，或省下的类名token抵不上跨类簇分析的额外调用时返回None"""
+    options = options or ClusterOptions()
+    class_names = list(dict.fromkeys(cls.class_name for cls in classmodel.classes if cls is not None))
+    if len(class_names) < max(options.min_classes, 2):
+        return None
+    clusters = _partition_classes(text, classmodel, class_names, options)
+    return clusters if _clustering_pays_off(text, class_names, clusters) else None
+
+
+def _bfs_components(group, neighbors) -> List[List[str]]:
+    """把group中的类按只在group内部展开的宽度优先顺序分成连通分量，neighbors(name)按优先顺序给出相邻的类"""
+    members = set(group)
+    visited = set()
+    components = []
+    for seed in group:
+        if seed in visited:
+            continue
+        visited.add(seed)
+        order = [seed]
+        for name in order:
+            for other in neighbors(name):
+                if other in members and other not in visited:
+                    visited.add(other)
+                    order.append(other)
+        components.append(order)
+    return components
+
+
+def _pack_groups(groups, max_size: int, neighbors) -> List[List[str]]:
+    """把类的分组装成规模不超过max_size的页面：过大的组按宽度优先顺序切开使相邻的类尽量在一起，
+    较小的组从大到小依次装入同一页。类簇划分和分页渲染共用"""
+    pages = []
+    small = []
+    for group in sorted(groups, key=len, reverse=True):
+        if len(group) > max_size:
+            order = [name for component in _bfs_components(group, neighbors) for name in component]
+            pages.extend(order[i:i + max_size] for i in range(0, len(order), max_size))
+            continue
+        if len(small) + len(group) > max_size:
+            pages.append(small)
+            small = []
+        small.extend(group)
+    if small:
+        pages.append(small)
+    return pages
+
+
+def _partition_classes(text: str, classmodel: ClassDiagram, class_names: List[str],
+                       options: ClusterOptions) -> ClassClusters:
+    """按共现图划分类簇，不检查类数，也不检查划分是否划算"""
+    graph = _cooccurrence_graph(text, classmodel, class_names, options)
+    labels = _label_propagation(graph, class_names, options)
+    groups = {}
+    for name in class_names:
+        groups.setdefault(labels[name], []).append(name)
+    # 过大的类簇沿共现权重从大到小的邻接切开
+    clusters = _pack_groups(groups.values(), options.max_cluster_size,
+                            lambda name: sorted(graph[name], key=graph[name].get, reverse=True))
+    result = ClassClusters(clusters=clusters,
+                           membership={name: i for i, cluster in enumerate(clusters) for name in cluster})
+    for i, cluster in enumerate(clusters):
+        outside = {}
+        external = {}
+        for name in cluster:
+            for other, weight in graph[name].items():
+                if result.membership[other] != i:
+                    outside[other] = outside.get(other, 0.0) + weight
+                    external[name] = external.get(name, 0.0) + weight
+        result.boundary.append(sorted(outside, key=outside.get, reverse=True)[:options.boundary_size])
+        # 代表类取与簇外联系最紧密的类，没有簇外联系时取前几个类
+        hubs = sorted(external, key=external.get, reverse=True)[:options.hubs_per_cluster]
+        result.hubs.append(hubs or cluster[:options.hubs_per_cluster])
+    return result
+
+
+def _clustering_pays_off(text: str, class_names: List[str], clusters: ClassClusters) -> bool:
+    """按类簇限定省下的类名token是否超过跨类簇分析的额外调用（每次都带上需求文本和提示模板）"""
+    full = count_tokens(",".join(class_names))
+    saved = sum(len(cluster) * (full - count_tokens(",".join(clusters.scope(cluster[:1]))))
+                for cluster in clusters.clusters)
+    overhead = count_tokens(text) + count_tokens(Association_prompt.format(input="", class_name="", classes=""))
+    extra = sum(overhead + count_tokens(",".join(hubs + others)) for hubs, others in clusters.cross_cluster_calls())
+    return saved > extra
+
+
 class AgentState(BaseModel):
     usecase_file_path:str
     input_text: str
     class_model:ClassDiagram=Field(default_factory=ClassDiagram)
     plantuml_code: str = ""
+    analyzed: Dict[str, List[str]] = Field(default_factory=dict, description="各逐类分析阶段已经分析过的类名")
+    feature_batch_size: int = Field(default=1, description="特征分析每次调用分析的类数")
+    invent_children: bool = Field(default=True, description="泛化分析是否推理新的子类")
+    worklist_iterations: int = Field(default=2, description="工作表补充分析的迭代上限")
+    diagnostics: List[Diagnostic] = Field(default_factory=list, description="节点间校验发现的问题")
+    requeried: List[str] = Field(default_factory=list, description="校验后已重新请求过特征的类，每个类只重试一次")
+    condense: bool = Field(default=True, description="长需求文本是否先浓缩成领域摘要")
+    condense_min_tokens: int = Field(default=3000, description="需求文本少于该token数时直接使用原文")
+    digest_text: str = Field(default="", description="浓缩得到的领域摘要，为空时逐类分析使用原文")
+    cluster_options: ClusterOptions = Field(default_factory=ClusterOptions,
+                                            description="类很多时泛化和关联分析按类簇限定其他类的集合")
+    refine_workers: int = Field(default=1, description="大于1时refine按连通分量在这么多个进程中并行执行")
 
 
 # 工具函数保持不变...
@@ -278,9 +1200,28 @@ def analyze_text_to_classdiagram(file_path: str) -> ClassDiagram:
   """从plantUML文本中提取类图"""
   with open(file_path, 'r', encoding='utf-8') as file:
       content = file.read()
+  return parse_plantuml_text(content)
+
+
+@profile_stage("parse_plantuml_text")
+def parse_plantuml_text(content: str, verbose: bool = True) -> ClassDiagram:
+  """从plantUML文本内容中提取类图"""
+  log = print if verbose else (lambda *args: None)
   #用字符匹配的方式，将content中的类与属性和操作提取出来 ，形成ClassDiagram对象
-  class_pattern = r'class\s+([^\s{]+)\s*{\s*([^}]*)\s*}'
-  matches = re.findall(class_pattern, content, re.DOTALL)
+  # 先匹配类头再找下一个"}"，没有"}"时其后的类也不可能闭合，直接结束；
+  # 不用一个正则匹配整个类，避免未闭合的类体让正则反复回溯（耗时随文本长度超线性增长）
+  class_head = re.compile(r'class\s+([^\s{]+)\s*\{')
+  matches = []
+  position = 0
+  while True:
+      head = class_head.search(content, position)
+      if head is None:
+          break
+      close = content.find("}", head.end())
+      if close == -1:
+          break
+      matches.append((head.group(1), content[head.end():close]))
+      position = close + 1
   result=ClassDiagram()
   for match in matches:
         class_name = match[0].strip()
@@ -301,7 +1242,8 @@ def analyze_text_to_classdiagram(file_path: str) -> ClassDiagram:
         )
         result.classes.append(class_structure)
   #用字符匹配的方式，将content中的继承关系提取出来 ，添加到ClassDiagram
-  inheritance_pattern = r'([^\s]+)\s+<\|--\s+([^\s]+)'
+  # 类名只从空白之后开始匹配，很长的无空白文本不会在每个位置重新尝试
+  inheritance_pattern = r'(?<!\S)(\S+)\s+<\|--\s+(\S+)'
   inheritance_matches = re.findall(inheritance_pattern, content)
   for match in inheritance_matches:
         parent_class = match[0].strip()
@@ -315,11 +1257,11 @@ def analyze_text_to_classdiagram(file_path: str) -> ClassDiagram:
   #用字符匹配的方式，将content中的关联关系提取出来 ，添加到ClassDiagram 例如：关联这样表示：住院医生 “1 手术执行者” --> “0..* 手术项目” 手术治疗 : 关联
 
   #association_pattern = r'([^\s]+)\s+"([^"]+)"\s*(<-->|-->|<--)\s*"([^"]+)"\s+([^\s]+)\s*:\s*关联'
-  association_pattern = r'([^\s]+)\s+"([^"]+)"\s*(<-->|-->|--|<--)\s*"([^"]+)"\s+([^\s]+)\s*:\s*(.+)'
+  association_pattern = r'(?<!\S)(\S+)\s+"([^"]+)"\s*(<-->|-->|--|<--)\s*"([^"]+)"\s+(\S+)\s*:\s*(.+)'
   association_matches = re.findall(association_pattern, content)
 
   for match in association_matches:
-      print("匹配到关联关系：", match)
+      log("匹配到关联关系：", match)
       source_class = match[0].strip()
       target_class = match[4].strip()
       source_adds = match[1].strip()
@@ -384,23 +1326,45 @@ def get_classes_from_Actors(file_path: str) -> ClassDiagram:
     #return list(set(actors))  # 去重后返回
     return  result
 @tool
-def analyze_features(text: str,classmodel: ClassDiagram) -> ClassDiagram:
-    """从文本中提取特征作为类的属性和方法"""
+def analyze_features(text: str,classmodel: ClassDiagram, only_classes: Optional[List[str]] = None,
+                     batch_size: int = 1) -> ClassDiagram:
+    """从文本中提取特征作为类的属性和方法，only_classes不为空时只分析其中的类，其余类和关系保持不变；
+    batch_size大于1时一次调用分析多个类，需求文本只发送一次"""
     #复制一个classmodel的副本
     result_classmodel=ClassDiagram()
+    if only_classes is not None:
+        result_classmodel=classmodel.model_copy(deep=True)
     #result_classmodel.classes=classmodel.classes.copy()
-    llm = ChatOpenAI(
-        openai_api_base=os.environ['OPENAI_API_BASE_URL'],
-        openai_api_key=os.environ['OPENAI_API_KEY'],
-        model="gpt-4", temperature=0)
+    llm = create_llm()
     #对于classmodel.classes中的每个类，添加一些属性和方法
-    for cls in classmodel.classes:
+    targets = [cls for cls in classmodel.classes
+               if only_classes is None or (cls is not None and cls.class_name in only_classes)]
+    for start in range(0, len(targets), max(1, batch_size)):
+        batch = targets[start:start + max(1, batch_size)]
         #cls.class_name
         # chain = few_shot_prompt | llm | parser
         chain = feture_prompt | llm | parser
-        result = chain.invoke({"input": text, "class_name": cls.class_name})
-        target_class = next((c for c in result.classes if c.class_name == cls.class_name), None)
-        result_classmodel.classes.append(target_class)
+        try:
+            result = invoke_chain(chain, {"input": text, "class_name": "，".join(cls.class_name for cls in batch)},
+                                  label="特征分析")
+        except DeadlineExceeded:
+            #超过截止时间：其余类保持原样，保证已有的分析结果不丢失
+            skipped = targets[start:]
+            names = [c.class_name for c in skipped if c is not None]
+            _run_context.get().skip("特征分析未完成的类：" + ",".join(names), "analyze_features", names)
+            if only_classes is None:
+                result_classmodel.classes.extend(skipped)
+            break
+        for cls in batch:
+            target_class = next((c for c in result.classes if c.class_name == cls.class_name), None)
+            if only_classes is None:
+                #批量分析时LLM漏掉的类保留原样，单个分析时保持原有行为
+                result_classmodel.classes.append(target_class if target_class or len(batch) == 1 else cls)
+            elif target_class:
+                #只补充新类的特征，保留该类已有的属性和方法
+                old_class = next(c for c in result_classmodel.classes if c is not None and c.class_name == cls.class_name)
+                old_class.attributes += [a for a in target_class.attributes if a not in old_class.attributes]
+                old_class.methods += [m for m in target_class.methods if m not in old_class.methods]
     return  result_classmodel
 
 @tool
@@ -410,16 +1374,17 @@ def analyze_classes(text: str,classmodel: ClassDiagram) -> ClassDiagram:
     print("初始类结构：")
     print(classmodel)
 
-    llm = ChatOpenAI(
-        openai_api_base=os.environ['OPENAI_API_BASE_URL'],
-        openai_api_key=os.environ['OPENAI_API_KEY'],
-        model="gpt-4", temperature=0)
+    llm = create_llm()
     #chain = few_shot_prompt | llm | parser
     chain = class_prompt | llm | parser
 
     #return chain.invoke({"input": text}).split('\n')
     #return chain.invoke({"input": text}).content.split('\n')
-    result=chain.invoke({"input": text})
+    try:
+        result=invoke_chain(chain, {"input": text}, label="类识别")
+    except DeadlineExceeded:
+        _run_context.get().skip("类识别")
+        return classmodel
     print("分析后类结构：")
     print(result)
     #将原来的类结构与新分析的类结构合并，避免重复
@@ -432,10 +1397,7 @@ def analyze_classes(text: str,classmodel: ClassDiagram) -> ClassDiagram:
 @tool
 def analyze_generalization(text: str,classmodel: ClassDiagram) -> ClassDiagram:
     """分析类之间的泛化关系"""
-    llm = ChatOpenAI(
-        openai_api_base=os.environ['OPENAI_API_BASE_URL'],
-        openai_api_key=os.environ['OPENAI_API_KEY'],
-        model="gpt-4", temperature=0)
+    llm = create_llm()
     #chain = few_shot_prompt | llm | parser
     chain = Generalization_prompt | llm | parser
 
@@ -452,24 +1414,166 @@ def analyze_generalization(text: str,classmodel: ClassDiagram) -> ClassDiagram:
       target_class = next((c for c in result.classes if c.class_name == old_class.class_name), None)
       if target_class:
         # 合并属性，避免重复
-        target_class.attributes = list(set(target_class.attributes + old_class.attributes))
+        target_class.attributes = list(dict.fromkeys(target_class.attributes + old_class.attributes))
         # 合并方法，避免重复
-        target_class.methods = list(set(target_class.methods + old_class.methods))
+        target_class.methods = list(dict.fromkeys(target_class.methods + old_class.methods))
       else:
         # 如果 result 中没有该类，则直接添加
         result.classes.append(old_class)
     return  result
+
+
+# 泛化候选的离线检测：提示模板Generalization_PROMPT_TEMPLATE中的规则1（属性和操作的子集关系）
+# 本质上是集合运算，用位集合在本地完成，LLM只处理本地无法判定的类
+class GeneralizationCandidates(BaseModel):
+    inheritance_relationships: List[InheritanceRelationship] = Field(default_factory=list, description="由成员子集关系推出的继承关系")
+    shared_parent_clusters: List[List[str]] = Field(default_factory=list, description="成员高度重叠、可能具有公共父类的类簇")
+    shared_members: List[List[str]] = Field(default_factory=list, description="每个类簇的公共成员，可作为公共父类的属性和方法")
+    unresolved: List[str] = Field(default_factory=list, description="本地无法判定、仍需LLM分析的类名")
+
+
+def _member_key(member: str) -> str:
+    """成员的规范化键：去掉可见性前缀和空白，属性与方法分开计数"""
+    key = re.sub(r'\s+', '', member.lstrip('+-#~ '))
+    return ("m:" if '(' in key else "a:") + key
+
+
+def _minhash_candidate_pairs(masks, member_count, num_hashes=64, rows=4, seed=7):
+    """MinHash + LSH分桶，返回可能高度重叠的类下标对（大模型时代替两两比较）"""
+    import random
+    rng = random.Random(seed)
+    # 每个成员预先分配num_hashes个随机值，成员集合的签名取逐位最小值
+    table = [[rng.getrandbits(32) for _ in range(num_hashes)] for _ in range(member_count)]
+    buckets = {}
+    for i, mask in enumerate(masks):
+        # 逐个取出置位的成员，不按位长扫描（成员总数很大时按位长扫描会使整体退化为平方复杂度）
+        rows_of_members = [table[m] for m in _iter_bits(mask)]
+        if not rows_of_members:
+            continue
+        signature = [min(values) for values in zip(*rows_of_members)]
+        for band in range(0, num_hashes, rows):
+            buckets.setdefault((band, tuple(signature[band:band + rows])), []).append(i)
+    pairs = set()
+    for bucket in buckets.values():
+        for x in range(len(bucket)):
+            for y in range(x + 1, len(bucket)):
+                pairs.add((bucket[x], bucket[y]))
+    return sorted(pairs)
+
+
+def detect_generalization_candidates(classmodel: ClassDiagram, min_members: int = 2,
+                                     overlap_threshold: float = 0.6,
+                                     lsh_threshold: int = 2000, min_shared_members: int = 3,
+                                     min_coverage: float = 0.5) -> GeneralizationCandidates:
+    """根据类的属性和方法集合，在本地推出继承关系和公共父类候选；
+    待比较的类超过lsh_threshold个时才用MinHash/LSH代替两两比较（两千个类以内两两比较更快）。
+    方向：成员集合为真子集的类是父类，成员更多的类是子类（子类继承父类全部成员后再增加自己的成员），
+    与Generalization_PROMPT_TEMPLATE规则1的字面说法（子集一方是子类）相反，以面向对象的继承语义为准。
+    本地推出的继承不再经LLM确认，所以证据要足：父类至少有min_shared_members个成员，且占子类成员的min_coverage以上；
+    只共有“编号”“名称”之类少数通用成员的类不据此判定，留给重叠类簇或LLM分析"""
+    classes = [cls for cls in classmodel.classes if cls is not None]
+    names = [cls.class_name for cls in classes]
+    # 每个成员分配一个位，每个类的成员集合表示为一个整数位集合
+    member_bits = {}
+    member_text = []
+    masks = []
+    for cls in classes:
+        mask = 0
+        for member in cls.attributes + cls.methods:
+            key = _member_key(member)
+            if key not in member_bits:
+                member_bits[key] = len(member_bits)
+                member_text.append(member)
+            mask |= 1 << member_bits[key]
+        masks.append(mask)
+    sizes = [mask.bit_count() for mask in masks]
+    # 倒排位集合：拥有某成员的类的集合
+    owners = [0] * len(member_bits)
+    for i, mask in enumerate(masks):
+        m = mask
+        while m:
+            low = m & -m
+            owners[low.bit_length() - 1] |= 1 << i
+            m ^= low
+    all_classes = (1 << len(classes)) - 1
+
+    # 1.子集关系：父类的成员是子类成员的真子集
+    parents_of = {i: [] for i in range(len(classes))}
+    for p, mask in enumerate(masks):
+        if sizes[p] < max(min_members, min_shared_members):
+            continue
+        holders = all_classes
+        m = mask
+        while m and holders:
+            low = m & -m
+            holders &= owners[low.bit_length() - 1]
+            m ^= low
+        holders &= ~(1 << p)
+        while holders:
+            low = holders & -holders
+            c = low.bit_length() - 1
+            holders ^= low
+            if sizes[c] > sizes[p] >= min_coverage * sizes[c]:
+                parents_of[c].append(p)
+    # 只保留直接父类：去掉被其他父类蕴含的祖先（A⊂B⊂C时只给出C继承B、B继承A）
+    inheritance = []
+    related = set()
+    for c, parents in parents_of.items():
+        for p in parents:
+            if any(q != p and masks[p] & masks[q] == masks[p] and sizes[q] > sizes[p] for q in parents):
+                continue
+            inheritance.append(InheritanceRelationship(source_class=names[c], target_class=names[p]))
+            related.update((c, p))
+
+    # 2.重叠关系：其余类中Jaccard相似度高的类合并成簇，建议公共父类
+    rest = [i for i in range(len(classes)) if i not in related and sizes[i] >= min_members]
+    if len(rest) > lsh_threshold:
+        local = _minhash_candidate_pairs([masks[i] for i in rest], len(member_bits))
+        pairs = [(rest[x], rest[y]) for x, y in local]
+    else:
+        pairs = [(rest[x], rest[y]) for x in range(len(rest)) for y in range(x + 1, len(rest))]
+    root = {i: i for i in rest}
+
+    def find(i):
+        while root[i] != i:
+            root[i] = root[root[i]]
+            i = root[i]
+        return i
+
+    for a, b in pairs:
+        common = (masks[a] & masks[b]).bit_count()
+        if common >= min_members and common / (sizes[a] + sizes[b] - common) >= overlap_threshold:
+            root[find(a)] = find(b)
+    groups = {}
+    for i in rest:
+        groups.setdefault(find(i), []).append(i)
+    clusters = [members for members in groups.values() if len(members) > 1]
+
+    result = GeneralizationCandidates(inheritance_relationships=inheritance)
+    for members in clusters:
+        shared = masks[members[0]]
+        for i in members[1:]:
+            shared &= masks[i]
+        result.shared_parent_clusters.append([names[i] for i in members])
+        result.shared_members.append([member_text[b] for b in range(shared.bit_length()) if shared >> b & 1])
+        related.update(members)
+    result.unresolved = [names[i] for i in range(len(classes)) if i not in related]
+    return result
+
+
 @tool
-def analyze_generalization2(text: str,classmodel: ClassDiagram) -> ClassDiagram:
-    """分析类之间的泛化关系"""
+def analyze_generalization2(text: str,classmodel: ClassDiagram, only_classes: Optional[List[str]] = None,
+                            invent_children: bool = True, cluster_options: Optional[ClusterOptions] = None) -> ClassDiagram:
+    """分析类之间的泛化关系，only_classes不为空时只为其中的类调用LLM，已有的关系保持不变；
+    invent_children为True时每个类（包括本地推出关系或归入公共父类候选簇的类）都调用chain2推理新的子类，为False时不调用；
+    类数达到cluster_options.min_classes时按类簇限定其他类的集合"""
     result=ClassDiagram()
     #result复制一个classmodel的副本
     result.classes=classmodel.classes.copy()
+    if only_classes is not None:
+        result=classmodel.model_copy(deep=True)
 
-    llm = ChatOpenAI(
-        openai_api_base=os.environ['OPENAI_API_BASE_URL'],
-        openai_api_key=os.environ['OPENAI_API_KEY'],
-        model="gpt-4", temperature=0)
+    llm = create_llm()
     #chain = few_shot_prompt | llm | parser
     chain1 = Generalization_prompt1 | llm | parser
     chain2 = Generalization_prompt2 | llm | parser
@@ -479,23 +1583,59 @@ def analyze_generalization2(text: str,classmodel: ClassDiagram) -> ClassDiagram:
 
     print("待分析泛化关系的类结构：",classnames)
     print(result)
+    #先在本地按成员集合的子集/重叠关系推出继承关系，LLM只分析本地无法判定的类
+    candidates = detect_generalization_candidates(classmodel)
+    print("本地推出的继承关系：", candidates.inheritance_relationships)
+    print("本地推出的公共父类候选类簇：", candidates.shared_parent_clusters)
+    for inh_rel in candidates.inheritance_relationships:
+        if inh_rel not in result.inheritance_relationships:
+            result.inheritance_relationships.append(inh_rel)
+    #类很多时每个类只带上所在类簇及边界类，最后每个类簇用代表类做一次跨类簇分析
+    clusters = cluster_classes(text, classmodel, cluster_options)
+
+    def scoped(names):
+        names_in_scope = clusters.scope(names) if clusters is not None else []
+        return ",".join(names_in_scope) if names_in_scope else classnames
+
+    #每个类簇只调用一次chain1为其命名公共父类；无法判定的类仍然分别调用chain1和chain2；
+    #本地已判定的类不再调用chain1，但推理子类与本地判定无关，仍然调用chain2
+    pending = [(", ".join(cluster), chain1, None, scoped(cluster)) for cluster in candidates.shared_parent_clusters
+               if only_classes is None or set(cluster) & set(only_classes)]
+    unresolved = set(candidates.unresolved)
+    pending += [(cls.class_name, chain1 if cls.class_name in unresolved else None,
+                 chain2 if invent_children else None, scoped([cls.class_name]))
+                for cls in classmodel.classes if cls is not None
+                and (only_classes is None or cls.class_name in only_classes)
+                and (cls.class_name in unresolved or invent_children)]
+    if clusters is not None:
+        print(f"{len(classmodel.classes)}个类划分为{len(clusters.clusters)}个类簇，逐类分析只带上所在类簇及边界类")
+        if only_classes is None:
+            pending += [(", ".join(hubs), chain1, None, ",".join(others)) for hubs, others in clusters.cross_cluster_calls()]
     #将原来的类结构与新分析的类结构合并，避免重复
     existing_class_names = {cls.class_name for cls in classmodel.classes}
-    for a_cls in classmodel.classes:
+    for position, (class_name, first_chain, second_chain, classes) in enumerate(pending):
     #用old_class中的属性和方法更新result中的类
-      print("分析类的各种泛化关系......",a_cls.class_name)
-      temp_result1 = chain1.invoke({"input": text,"class_name":  a_cls.class_name, "classes": classnames})
-      temp_result2 = chain2.invoke({"input": text, "class_name": a_cls.class_name, "classes": classnames})
+      print("分析类的各种泛化关系......",class_name)
+      try:
+          temp_result1 = invoke_chain(first_chain, {"input": text,"class_name":  class_name, "classes": classes},
+                                      label=f"泛化分析：{class_name}") if first_chain else ClassDiagram()
+          #推理新的子类价值较低，时间不足时优先跳过
+          temp_result2 = invoke_chain(second_chain, {"input": text, "class_name": class_name, "classes": classes},
+                                      optional=True, label=f"推理子类：{class_name}") if second_chain else ClassDiagram()
+      except DeadlineExceeded:
+          names = list(dict.fromkeys(name for entry in pending[position:] for name in entry[0].split(", ")))
+          _run_context.get().skip("泛化分析未完成的类：" + ",".join(names), "analyze_generalization", names)
+          break
       print("分析类的各种泛化关系结果1......",temp_result1)
       print("分析类的各种泛化关系结果2......",temp_result2)
-      print("合并类与各种泛化关系......",a_cls.class_name)
+      print("合并类与各种泛化关系......",class_name)
       for old_class in temp_result1.classes+temp_result2.classes:
         target_class = next((c for c in result.classes if c.class_name == old_class.class_name), None)
         if target_class:
         # 合并属性，避免重复
-           target_class.attributes = list(set(target_class.attributes + old_class.attributes))
+           target_class.attributes = list(dict.fromkeys(target_class.attributes + old_class.attributes))
         # 合并方法，避免重复
-           target_class.methods = list(set(target_class.methods + old_class.methods))
+           target_class.methods = list(dict.fromkeys(target_class.methods + old_class.methods))
         else:
          # 如果 result 中没有该类，则直接添加
          result.classes.append(old_class)
@@ -506,31 +1646,44 @@ def analyze_generalization2(text: str,classmodel: ClassDiagram) -> ClassDiagram:
 
     return  result
 @tool
-def analyze_associations(text: str,classmodel: ClassDiagram) -> ClassDiagram:
-    """分析类之间的关联关系"""
+def analyze_associations(text: str,classmodel: ClassDiagram, only_classes: Optional[List[str]] = None,
+                         cluster_options: Optional[ClusterOptions] = None) -> ClassDiagram:
+    """分析类之间的关联关系，only_classes不为空时只分析其中的类，已有的关联关系保持不变；
+    类数达到cluster_options.min_classes时按类簇限定其他类的集合，最后做一次跨类簇分析"""
     result=ClassDiagram()
     #result复制一个classmodel的副本
     result.classes=classmodel.classes.copy()
     result.inheritance_relationships=classmodel.inheritance_relationships.copy()
-    llm = ChatOpenAI(
-        openai_api_base=os.environ['OPENAI_API_BASE_URL'],
-        openai_api_key=os.environ['OPENAI_API_KEY'],
-        model="gpt-4", temperature=0)
+    result.association_relationships=classmodel.association_relationships.copy()
+    llm = create_llm()
     chain = Association_prompt | llm | parser
     #将原来的类结构与新分析的类结构合并，避免重复
     existing_class_names = {cls.class_name for cls in classmodel.classes}
-    for a_cls in classmodel.classes:
-        print("分析类的各种关联关系......", a_cls.class_name)
-        temp_result = chain.invoke({"input": text, "class_name": a_cls.class_name, "classes": existing_class_names})
+    clusters = cluster_classes(text, classmodel, cluster_options)
+    pending = [(a_cls.class_name, set(clusters.scope([a_cls.class_name])) if clusters is not None else None)
+               for a_cls in classmodel.classes if only_classes is None or a_cls.class_name in only_classes]
+    if clusters is not None:
+        print(f"{len(classmodel.classes)}个类划分为{len(clusters.clusters)}个类簇，逐类分析只带上所在类簇及边界类")
+        if only_classes is None:
+            pending += [(", ".join(hubs), set(others)) for hubs, others in clusters.cross_cluster_calls()]
+    for position, (class_name, classes) in enumerate(pending):
+        print("分析类的各种关联关系......", class_name)
+        try:
+            temp_result = invoke_chain(chain, {"input": text, "class_name": class_name, "classes": classes or existing_class_names},
+                                       label=f"关联分析：{class_name}")
+        except DeadlineExceeded:
+            names = list(dict.fromkeys(name for entry in pending[position:] for name in entry[0].split(", ")))
+            _run_context.get().skip(f"关联分析在{class_name}处超过截止时间，其后的类未分析", "analyze_association", names)
+            break
         print("分析类的各种关联关系关系结果......",temp_result)
-        print("合并类与各种关联关系......", a_cls.class_name)
+        print("合并类与各种关联关系......", class_name)
         for old_class in temp_result.classes :
             target_class = next((c for c in result.classes if c.class_name == old_class.class_name), None)
             if target_class:
                 # 合并属性，避免重复
-                target_class.attributes = list(set(target_class.attributes + old_class.attributes))
+                target_class.attributes = list(dict.fromkeys(target_class.attributes + old_class.attributes))
                 # 合并方法，避免重复
-                target_class.methods = list(set(target_class.methods + old_class.methods))
+                target_class.methods = list(dict.fromkeys(target_class.methods + old_class.methods))
             else:
                 # 如果 result 中没有该类，则直接添加
                 result.classes.append(old_class)
@@ -543,6 +1696,13 @@ def analyze_associations(text: str,classmodel: ClassDiagram) -> ClassDiagram:
 @tool
 def refine_features(classmodel: ClassDiagram) -> ClassDiagram:
       """优化类的属性和方法"""
+      return _refine_classdiagram(classmodel)
+
+
+@profile_stage("refine_features")
+def _refine_classdiagram(classmodel: ClassDiagram, verbose: bool = True) -> ClassDiagram:
+      """refine_features的实现：去除子类中与父类重复的属性、方法和关联关系，verbose为False时不打印过程"""
+      log = print if verbose else (lambda *args, **kwargs: None)
       # 这里可以添加一些优化逻辑，比如去除子类重复属性
       #对classmodel.inheritance_relationships进行梳理，产生继承表字典
       inheritance_father = {}
@@ -556,33 +1716,39 @@ def refine_features(classmodel: ClassDiagram) -> ClassDiagram:
             if inh_relation.target_class not in inheritance_son:
                 inheritance_son[inh_relation.target_class] = []
             inheritance_son[inh_relation.target_class].append(inh_relation.source_class)
-      print("inheritance_father:",inheritance_father)
-      print("inheritance_son:",inheritance_son)
+      log("inheritance_father:",inheritance_father)
+      log("inheritance_son:",inheritance_son)
       #遍历inheritance_son找到处于继承树中叶子节点的类,即没有子类的类
       #分别复制inheritance_son，inheritance_father到新的两个字典
       inheritance_father2 = {}
       inheritance_son2 = {}
       inheritance_father2.update(inheritance_father)
       inheritance_son2.update(inheritance_son)
-      print("inheritance_father2:",inheritance_father2)
-      print("inheritance_son2:",inheritance_son2)
-      print("开始确定继承关系定义顺序......")
+      log("inheritance_father2:",inheritance_father2)
+      log("inheritance_son2:",inheritance_son2)
+      log("开始确定继承关系定义顺序......")
       while inheritance_son2:
-       #print("inheritance_son2:",inheritance_son2)
+       #log("inheritance_son2:",inheritance_son2)
+       progressed = False
        for son_class, father_classes in list(inheritance_father2.items()):
             if son_class not in inheritance_son2 and son_class not in define_queue:
+                progressed = True
                 #将son_class加入queue中
                 define_queue.append(son_class)
-                print("define_queue:",define_queue)
+                log("define_queue:",define_queue)
                 del inheritance_father2[son_class]
-                print("inheritance_father2:",inheritance_father2)
+                log("inheritance_father2:",inheritance_father2)
                 for father_class, son_classes in list(inheritance_son2.items()):
                     if son_class in son_classes:
                         son_classes.remove(son_class)
                         if not son_classes:
                             del inheritance_son2[father_class]
-                            print("inheritance_son2:",inheritance_son2)
-      print("继承关系定义顺序：",define_queue)
+                            log("inheritance_son2:",inheritance_son2)
+       if not progressed:
+            #剩下的继承关系成环，无法再确定顺序（校验器会先去掉环）
+            log("继承关系存在环，跳过：", inheritance_son2)
+            break
+      log("继承关系定义顺序：",define_queue)
 
        #遍历 inheritance_son中的元素
       for son_class in define_queue:
@@ -600,9 +1766,10 @@ def refine_features(classmodel: ClassDiagram) -> ClassDiagram:
                 son_class_structure.methods = [meth for meth in son_class_structure.methods if meth not in father_class_structure.methods]
       #子类中删除与父类都有的相同的关联关系
       for son_class in define_queue:
-            print("son_class:",son_class)
+            log("son_class:",son_class)
             #找到classmodel.association_relationships中与son_class相关的关联关系
-            for inh_relation in classmodel.association_relationships:
+            #遍历副本：在原列表上边遍历边删除会跳过紧随其后的关联关系
+            for inh_relation in list(classmodel.association_relationships):
                 if inh_relation.source_class == son_class:
                     target_role=inh_relation.target_role
                     target_name=inh_relation.assicaiation_name
@@ -611,13 +1778,13 @@ def refine_features(classmodel: ClassDiagram) -> ClassDiagram:
                         for inh_relation2 in classmodel.association_relationships:
                             if inh_relation2.source_class == father_classes and inh_relation2.target_class==target_class and (inh_relation2.target_role==target_role or inh_relation2.assicaiation_name ==target_name ):
                                 #删除inh_relation
-                                print("inh_relation2:",inh_relation2)
-                                print("inh_relation:", inh_relation)
-                                print(f"删除子类{son_class}中与父类{father_classes}重复的关联关系_source_class：{inh_relation.source_class} --> {inh_relation.target_class} : {inh_relation.relation_type}")
+                                log("inh_relation2:",inh_relation2)
+                                log("inh_relation:", inh_relation)
+                                log(f"删除子类{son_class}中与父类{father_classes}重复的关联关系_source_class：{inh_relation.source_class} --> {inh_relation.target_class} : {inh_relation.relation_type}")
                                 if inh_relation in classmodel.association_relationships:
                                     classmodel.association_relationships.remove(inh_relation)
                                 else:
-                                    print(f"关联关系未找到，无法删除：{inh_relation}")
+                                    log(f"关联关系未找到，无法删除：{inh_relation}")
                             #找到target_class在classmodle.generaliztion的父类
 
                 if inh_relation.target_class == son_class:
@@ -628,13 +1795,13 @@ def refine_features(classmodel: ClassDiagram) -> ClassDiagram:
                         for inh_relation2 in classmodel.association_relationships:
                             if inh_relation2.target_class == father_classes and inh_relation2.source_class==source_class and (inh_relation2.source_role==source_role or inh_relation2.assicaiation_name ==source_name ):
                                 #删除inh_relation
-                                print("inh_relation2:",inh_relation2)
-                                print("inh_relation:", inh_relation)
-                                print(f"删除子类{son_class}中与父类{father_classes}重复的关联关系_target_class：{inh_relation.source_class} --> {inh_relation.target_class} : {inh_relation.relation_type}")
+                                log("inh_relation2:",inh_relation2)
+                                log("inh_relation:", inh_relation)
+                                log(f"删除子类{son_class}中与父类{father_classes}重复的关联关系_target_class：{inh_relation.source_class} --> {inh_relation.target_class} : {inh_relation.relation_type}")
                                 if inh_relation in classmodel.association_relationships:
                                     classmodel.association_relationships.remove(inh_relation)
                                 else:
-                                    print(f"关联关系未找到，无法删除：{inh_relation}")
+                                    log(f"关联关系未找到，无法删除：{inh_relation}")
       return classmodel
 
 @tool
@@ -643,9 +1810,15 @@ def generate_plantuml(classmodel: ClassDiagram) -> str:
         #class_defs = "\n".join([f"class {e.split(':')[0]} {{\n    {e.split(':')[1]}\n}}" for e in entities])
         #relation_defs = "\n".join(relationships)
         #return f"@startuml\n{class_defs}\n{relation_defs}\n@enduml"
+        return _generate_plantuml(classmodel)
+
+
+@profile_stage("generate_plantuml")
+def _generate_plantuml(classmodel: ClassDiagram, verbose: bool = True) -> str:
+        log = print if verbose else (lambda *args: None)
         # 转换类结构输出
-        print("类结构：")
-        print(classmodel)
+        log("类结构：")
+        log(classmodel)
         class_def = ""
         for cls in classmodel.classes:
             class_def += f"class {cls.class_name} {{\n"
@@ -653,10 +1826,10 @@ def generate_plantuml(classmodel: ClassDiagram) -> str:
             class_def += "\n".join(cls.methods) + "\n}\n"
             #print(class_def)
         # 转换关系输出
-        print("\n类关系：")
+        log("\n类关系：")
         relation_defs = "\n"
         for rel in classmodel.association_relationships:
-            print(f"{rel.source_class} --> {rel.target_class} : {rel.relation_type}")
+            log(f"{rel.source_class} --> {rel.target_class} : {rel.relation_type}")
             if rel.source_navigation.lower() == 'true':
                 source_navigation = '<'
             else:
@@ -667,71 +1840,1704 @@ def generate_plantuml(classmodel: ClassDiagram) -> str:
                 target_navigation = ''
             relation_defs += f'{rel.source_class} "{rel.souce_multiplicity} {rel.source_role}"{source_navigation}--{target_navigation}"{rel.target_multiplicity} {rel.target_role}" {rel.target_class} : {rel.assicaiation_name}\n'
         for rel in classmodel.inheritance_relationships:
-            print(f"{rel.source_class} <|-- {rel.target_class} : {rel.relation_type}")
+            log(f"{rel.source_class} <|-- {rel.target_class} : {rel.relation_type}")
             relation_defs +=f"{rel.target_class} <|-- {rel.source_class} : {rel.relation_type}\n"
         for rel in classmodel.aggregation_relationships:
-            print(f"{rel.source_class} o-- {rel.target_class} : {rel.relation_type}")
+            log(f"{rel.source_class} o-- {rel.target_class} : {rel.relation_type}")
             relation_defs +=f"{rel.source_class} o-- {rel.target_class} : {rel.relation_type}\n"
         for rel in classmodel.composition_relationships:
-            print(f"{rel.source_class} *-- {rel.target_class} : {rel.relation_type}")
+            log(f"{rel.source_class} *-- {rel.target_class} : {rel.relation_type}")
             relation_defs +=f"{rel.source_class} *-- {rel.target_class} : {rel.relation_type}\n"
         for rel in classmodel.dependency_relationships:
-            print(f"{rel.source_class} ..> {rel.target_class} : {rel.relation_type}")
+            log(f"{rel.source_class} ..> {rel.target_class} : {rel.relation_type}")
             relation_defs +=f"{rel.source_class} ..> {rel.target_class} : {rel.relation_type}\n"
         return f"@startuml\n{class_def}\n{relation_defs}\n@enduml"
 
 
 
-def build_workflow():
+# ---------------- 类图的序列化 ----------------
+# 版本化的JSON Lines格式：首行为文件头（含各记录的字段顺序），每个类/关系按字段顺序存成一行数组，
+# 末行为类名到行偏移的索引，
+# 可以流式读写大模型，也可以只按偏移读取单个类；可选orjson加速、zstd压缩
+try:
+    import orjson
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _json_loads = json.loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CLASSDIAGRAM_FORMAT = "puml-classdiagram"
+CLASSDIAGRAM_FORMAT_VERSION = 1
+# 记录类型即ClassDiagram的字段名
+_DIAGRAM_RECORD_MODELS = {name: info.annotation.__args__[0] for name, info in ClassDiagram.model_fields.items()}
+_DIAGRAM_RECORD_FIELDS = {name: list(model.model_fields) for name, model in _DIAGRAM_RECORD_MODELS.items()}
+
+
+def _open_binary(path: str, mode: str):
+    """按扩展名打开文件，.zst文件经zstd流式压缩/解压"""
+    if not path.endswith(".zst"):
+        return open(path, mode + "b")
+    if zstandard is None:
+        raise ImportError("读写.zst文件需要安装zstandard")
+    raw = open(path, mode + "b")
+    if mode == "w":
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+
+
+def _write_records(file, header: dict, classmodel: ClassDiagram):
+    """写入文件头、逐条记录和末尾的类索引"""
+    line = _json_dumps(dict(header, fields=_DIAGRAM_RECORD_FIELDS)) + b"\n"
+    file.write(line)
+    offset = len(line)
+    index = {}
+    counts = {}
+    for kind, fields in _DIAGRAM_RECORD_FIELDS.items():
+        # 计数与实际写出的记录一致，None不写出也不计数
+        counts[kind] = 0
+        for item in getattr(classmodel, kind):
+            if item is None:
+                continue
+            counts[kind] += 1
+            if kind == "classes":
+                index[item.class_name] = offset
+            line = _json_dumps({"t": kind, "v": [getattr(item, field) for field in fields]}) + b"\n"
+            file.write(line)
+            offset += len(line)
+    file.write(_json_dumps({"index": index, "counts": counts}) + b"\n")
+
+
+def save_classdiagram(classmodel: ClassDiagram, path: str):
+    """将类图流式保存为版本化的JSON Lines文件（.zst结尾时压缩）"""
+    with _open_binary(path, "w") as file:
+        _write_records(file, {"format": CLASSDIAGRAM_FORMAT, "version": CLASSDIAGRAM_FORMAT_VERSION,
+                              "kind": "ClassDiagram"}, classmodel)
+
+
+def save_agent_state(state: AgentState, path: str):
+    """保存AgentState：非类图字段放在文件头，类图按记录逐行保存"""
+    with _open_binary(path, "w") as file:
+        _write_records(file, {"format": CLASSDIAGRAM_FORMAT, "version": CLASSDIAGRAM_FORMAT_VERSION,
+                              "kind": "AgentState", "state": state.model_dump(exclude={"class_model"})},
+                       state.class_model)
+
+
+def _read_header(line: bytes) -> dict:
+    header = _json_loads(line)
+    if header.get("format") != CLASSDIAGRAM_FORMAT:
+        raise ValueError("不是类图序列化文件")
+    if header.get("version", 0) > CLASSDIAGRAM_FORMAT_VERSION:
+        raise ValueError(f"不支持的类图文件版本：{header.get('version')}")
+    return header
+
+
+def _record_to_model(fields: dict, record: dict):
+    """按文件头中记录的字段顺序还原模型对象"""
+    return _DIAGRAM_RECORD_MODELS[record["t"]].model_validate(dict(zip(fields[record["t"]], record["v"])))
+
+
+def iter_classdiagram_records(path: str):
+    """流式读取类图文件，逐条产出(记录类型, 模型对象)，不必一次读入整个模型"""
+    with _open_binary(path, "r") as file:
+        fields = _read_header(file.readline())["fields"]
+        for line in file:
+            record = _json_loads(line)
+            if "index" in record:
+                break
+            yield record["t"], _record_to_model(fields, record)
+
+
+def load_classdiagram(path: str) -> ClassDiagram:
+    """从序列化文件加载完整的类图"""
+    result = ClassDiagram()
+    for kind, item in iter_classdiagram_records(path):
+        getattr(result, kind).append(item)
+    return result
+
+
+def load_agent_state(path: str) -> AgentState:
+    """从序列化文件加载AgentState"""
+    with _open_binary(path, "r") as file:
+        header = _read_header(file.readline())
+    if header.get("kind") != "AgentState":
+        raise ValueError("文件中保存的不是AgentState")
+    return AgentState(**header["state"], class_model=load_classdiagram(path))
+
+
+class ClassDiagramReader:
+    """按末尾的偏移索引惰性读取单个类，不反序列化整个模型（.zst文件无法按偏移读取，
+    打开时顺序扫描一次建立类名索引（值为记录序号），读取单个类时再顺序扫描）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = {}
+        self.counts = {}
+        if path.endswith(".zst"):
+            for position, (kind, item) in enumerate(iter_classdiagram_records(path)):
+                self.counts[kind] = self.counts.get(kind, 0) + 1
+                if kind == "classes":
+                    self.index.setdefault(item.class_name, position)
+            return
+        self._file = open(path, "rb")
+        self._fields = _read_header(self._file.readline())["fields"]
+        footer = self._read_last_line()
+        self.index = footer["index"]
+        self.counts = footer["counts"]
+
+    def _read_last_line(self) -> dict:
+        file = self._file
+        end = file.seek(0, os.SEEK_END)
+        block = b""
+        position = end
+        while position > 0 and block.count(b"\n") < 2:
+            step = min(65536, position)
+            position -= step
+            file.seek(position)
+            block = file.read(step) + block
+        return _json_loads(block.rstrip(b"\n").rsplit(b"\n", 1)[-1])
+
+    def class_names(self) -> List[str]:
+        return list(self.index)
+
+    def get_class(self, class_name: str) -> Optional[ClassStructure]:
+        """按类名读取单个类"""
+        if self.path.endswith(".zst"):
+            if class_name not in self.index:
+                return None
+            return next((item for kind, item in iter_classdiagram_records(self.path)
+                         if kind == "classes" and item.class_name == class_name), None)
+        offset = self.index.get(class_name)
+        if offset is None:
+            return None
+        self._file.seek(offset)
+        return _record_to_model(self._fields, _json_loads(self._file.readline()))
+
+    def close(self):
+        if hasattr(self, "_file"):
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---------------- 类图查询索引 ----------------
+# 一次建立邻接表和基于位集合的继承传递闭包，编辑时增量维护；
+# 祖先/子类判断O(1)，祖先、后代和k跳邻域查询与输出规模成正比，不再反复扫描关系列表
+_INDEX_RELATION_KINDS = ("association", "aggregation", "composition", "dependency")
+
+
+def _iter_bits(mask: int):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class ClassDiagramIndex:
+    """ClassDiagram的查询索引：继承的父子表和祖先/后代位集合，以及关联等关系的无向邻接表。
+    通过索引的add_*/remove_*方法编辑时，类图和索引同时更新"""
+
+    def __init__(self, classmodel: ClassDiagram):
+        self.classmodel = classmodel
+        self.classes: Dict[str, ClassStructure] = {}
+        self._ids = {}
+        self._names = []
+        self._free_ids = []
+        self.parents: Dict[str, Dict[str, InheritanceRelationship]] = {}
+        self.children: Dict[str, Dict[str, InheritanceRelationship]] = {}
+        self.adjacency = {kind: {} for kind in _INDEX_RELATION_KINDS}
+        self._ancestors = {}
+        self._descendants = {}
+        for cls in classmodel.classes:
+            if cls is not None:
+                self.classes.setdefault(cls.class_name, cls)
+                self._register(cls.class_name)
+        for rel in classmodel.inheritance_relationships:
+            if rel is not None:
+                self._link_inheritance(rel)
+        for kind in _INDEX_RELATION_KINDS:
+            for rel in getattr(classmodel, f"{kind}_relationships"):
+                if rel is not None:
+                    self._link(kind, rel)
+        self._build_closure()
+
+    # ---- 内部维护 ----
+    def _register(self, name: str) -> int:
+        if name not in self._ids:
+            self._ids[name] = self._free_ids.pop() if self._free_ids else len(self._names)
+            if self._ids[name] == len(self._names):
+                self._names.append(name)
+            else:
+                self._names[self._ids[name]] = name
+            self._ancestors[name] = 0
+            self._descendants[name] = 0
+        return self._ids[name]
+
+    def _bit(self, name: str) -> int:
+        return 1 << self._ids[name]
+
+    def _link_inheritance(self, rel: InheritanceRelationship):
+        self._register(rel.source_class)
+        self._register(rel.target_class)
+        self.parents.setdefault(rel.source_class, {})[rel.target_class] = rel
+        self.children.setdefault(rel.target_class, {})[rel.source_class] = rel
+
+    def _link(self, kind: str, rel):
+        self._register(rel.source_class)
+        self._register(rel.target_class)
+        adjacency = self.adjacency[kind]
+        adjacency.setdefault(rel.source_class, []).append(rel)
+        if rel.target_class != rel.source_class:
+            adjacency.setdefault(rel.target_class, []).append(rel)
+
+    def _topological(self, names, edges) -> List[str]:
+        """names按edges（名称 -> 前驱字典）的拓扑序排列，只考虑names内部的边；成环的类排在最后"""
+        names = set(names)
+        pending = {name: sum(1 for p in edges.get(name, ()) if p in names) for name in names}
+        successors = {}
+        for name in names:
+            for p in edges.get(name, ()):
+                if p in names:
+                    successors.setdefault(p, []).append(name)
+        order = [name for name, count in pending.items() if count == 0]
+        for name in order:
+            for s in successors.get(name, ()):
+                pending[s] -= 1
+                if pending[s] == 0:
+                    order.append(s)
+        if len(order) < len(names):
+            placed = set(order)
+            order.extend(name for name in names if name not in placed)
+        return order
+
+    def _recompute(self, names, up: bool):
+        """按拓扑序重新计算names的祖先（up）或后代位集合；有环时迭代到不动点"""
+        edges, closure = (self.parents, self._ancestors) if up else (self.children, self._descendants)
+        order = self._topological(names, edges)
+        for name in order:
+            closure[name] = 0
+        changed = True
+        while changed:
+            changed = False
+            for name in order:
+                mask = 0
+                for other in edges.get(name, ()):
+                    mask |= self._bit(other) | closure[other]
+                if mask != closure[name]:
+                    closure[name] = mask
+                    changed = True
+
+    def _build_closure(self):
+        self._recompute(self._ids, True)
+        self._recompute(self._ids, False)
+
+    # ---- 查询 ----
+    def __contains__(self, name: str) -> bool:
+        return name in self._ids
+
+    def is_subclass(self, child: str, parent: str) -> bool:
+        """child是否（直接或间接）继承parent，O(1)"""
+        return child in self._ids and parent in self._ids and bool(self._ancestors[child] >> self._ids[parent] & 1)
+
+    def ancestors(self, name: str) -> List[str]:
+        return [self._names[i] for i in _iter_bits(self._ancestors.get(name, 0))]
+
+    def descendants(self, name: str) -> List[str]:
+        return [self._names[i] for i in _iter_bits(self._descendants.get(name, 0))]
+
+    def relations_of(self, name: str, kinds=("association",)) -> list:
+        return [rel for kind in kinds for rel in self.adjacency[kind].get(name, ())]
+
+    def neighborhood(self, name: str, hops: int, kinds=("association",), include_inheritance: bool = False) -> Dict[str, int]:
+        """沿kinds关系（include_inheritance时也沿继承）在hops跳内可达的类及其跳数，按宽度优先"""
+        if name not in self._ids:
+            return {}
+        distance = {name: 0}
+        frontier = [name]
+        for hop in range(1, hops + 1):
+            next_frontier = []
+            for current in frontier:
+                neighbors = [rel.target_class if rel.source_class == current else rel.source_class
+                             for rel in self.relations_of(current, kinds)]
+                if include_inheritance:
+                    neighbors.extend(self.parents.get(current, ()))
+                    neighbors.extend(self.children.get(current, ()))
+                for neighbor in neighbors:
+                    if neighbor not in distance:
+                        distance[neighbor] = hop
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        return distance
+
+    def relations_within(self, name: str, hops: int, kinds=("association",)) -> list:
+        """从name出发hops跳内经过的所有kinds关系（每条只出现一次）"""
+        distance = self.neighborhood(name, hops, kinds)
+        seen = set()
+        result = []
+        for current, hop in distance.items():
+            if hop >= hops:
+                continue
+            for rel in self.relations_of(current, kinds):
+                if id(rel) not in seen:
+                    seen.add(id(rel))
+                    result.append(rel)
+        return result
+
+    # ---- 增量编辑 ----
+    def add_class(self, cls: ClassStructure):
+        self.classmodel.classes.append(cls)
+        self.classes.setdefault(cls.class_name, cls)
+        self._register(cls.class_name)
+
+    def remove_class(self, name: str):
+        """删除类及其所有关系"""
+        for parent, rel in list(self.parents.get(name, {}).items()):
+            self.remove_inheritance(rel)
+        for child, rel in list(self.children.get(name, {}).items()):
+            self.remove_inheritance(rel)
+        for kind in _INDEX_RELATION_KINDS:
+            for rel in list(self.adjacency[kind].get(name, ())):
+                self.remove_relation(kind, rel)
+        self.classmodel.classes = [c for c in self.classmodel.classes if c is None or c.class_name != name]
+        self.classes.pop(name, None)
+        if name in self._ids:
+            self._free_ids.append(self._ids.pop(name))
+            del self._ancestors[name], self._descendants[name]
+            self.parents.pop(name, None)
+            self.children.pop(name, None)
+
+    def add_inheritance(self, rel: InheritanceRelationship):
+        """新增继承：child及其后代的祖先集合并入parent及其祖先，parent及其祖先的后代集合并入child及其后代"""
+        child, parent = rel.source_class, rel.target_class
+        if parent in self.parents.get(child, {}):
+            return
+        self.classmodel.inheritance_relationships.append(rel)
+        self._link_inheritance(rel)
+        new_ancestors = self._bit(parent) | self._ancestors[parent]
+        new_descendants = self._bit(child) | self._descendants[child]
+        for i in _iter_bits(self._bit(child) | self._descendants[child]):
+            self._ancestors[self._names[i]] |= new_ancestors
+        for i in _iter_bits(self._bit(parent) | self._ancestors[parent]):
+            self._descendants[self._names[i]] |= new_descendants
+
+    def remove_inheritance(self, rel: InheritanceRelationship):
+        """删除继承：只对child及其后代重算祖先集合、对parent及其祖先重算后代集合"""
+        child, parent = rel.source_class, rel.target_class
+        stored = self.parents.get(child, {}).pop(parent, None)
+        if stored is None:
+            return
+        self.children[parent].pop(child, None)
+        # 继承按(子类, 父类)去重索引，类图中重复的同一继承一并删除
+        self.classmodel.inheritance_relationships = [
+            r for r in self.classmodel.inheritance_relationships
+            if r is None or (r.source_class, r.target_class) != (child, parent)]
+        affected_down = [child] + self.descendants(child)
+        affected_up = [parent] + self.ancestors(parent)
+        self._recompute(affected_down, True)
+        self._recompute(affected_up, False)
+
+    def add_relation(self, kind: str, rel):
+        getattr(self.classmodel, f"{kind}_relationships").append(rel)
+        self._link(kind, rel)
+
+    def remove_relation(self, kind: str, rel):
+        for name in {rel.source_class, rel.target_class}:
+            edges = self.adjacency[kind].get(name, [])
+            # 按对象身份删除，内容相同的另一条关系保留
+            position = next((i for i, r in enumerate(edges) if r is rel), None)
+            if position is not None:
+                del edges[position]
+        field = f"{kind}_relationships"
+        setattr(self.classmodel, field, [r for r in getattr(self.classmodel, field) if r is not rel])
+
+
+# ---------------- 子图提取与分页渲染 ----------------
+# 借助查询索引按种子类和跳数或给定的类集合（包/组件）提取自包含的子类图；
+# 大模型按连通性切分成规模有界的页面，并行渲染成多个.puml文件，跨页的关系以注释标出
+def _index_relations(index: ClassDiagramIndex, name: str):
+    """name参与的所有关系：(种类, 关系)"""
+    for parent, rel in index.parents.get(name, {}).items():
+        yield "inheritance", rel
+    for child, rel in index.children.get(name, {}).items():
+        yield "inheritance", rel
+    for kind in _INDEX_RELATION_KINDS:
+        for rel in index.adjacency[kind].get(name, ()):
+            yield kind, rel
+
+
+def extract_classes(classmodel: ClassDiagram, names, index: Optional[ClassDiagramIndex] = None) -> ClassDiagram:
+    """提取names中的类及两端都在其中的关系，组成独立的类图（复制，不与原类图共享对象）"""
+    index = index or ClassDiagramIndex(classmodel)
+    classes, relations = _page_records(index, names)
+    return ClassDiagram(classes=[ClassStructure(class_name=n, attributes=list(a), methods=list(m)) for n, a, m in classes],
+                        **{f"{kind}_relationships": [_DIAGRAM_RECORD_MODELS[f"{kind}_relationships"](
+                            **dict(zip(_DIAGRAM_RECORD_FIELDS[f"{kind}_relationships"], values))) for values in items]
+                           for kind, items in relations.items()})
+
+
+def _page_records(index: ClassDiagramIndex, names):
+    """names中的类及两端都在其中的关系，转成可pickle的紧凑元组，时间与输出规模成正比"""
+    selected = dict.fromkeys(name for name in names if name in index.classes)
+    classes = [(name, tuple(index.classes[name].attributes), tuple(index.classes[name].methods)) for name in selected]
+    relations = {kind: [] for kind in ("inheritance",) + _INDEX_RELATION_KINDS}
+    seen = set()
+    for name in selected:
+        for kind, rel in _index_relations(index, name):
+            if id(rel) not in seen and rel.source_class in selected and rel.target_class in selected:
+                seen.add(id(rel))
+                relations[kind].append(tuple(getattr(rel, f) for f in _DIAGRAM_RECORD_FIELDS[f"{kind}_relationships"]))
+    return classes, relations
+
+
+def extract_subdiagram(classmodel: ClassDiagram, seeds: List[str], hops: int = 1, include_ancestors: bool = True,
+                       index: Optional[ClassDiagramIndex] = None) -> ClassDiagram:
+    """提取种子类沿任意关系hops跳内的类；include_ancestors时再加上这些类的全部祖先，使继承的成员有处可查"""
+    index = index or ClassDiagramIndex(classmodel)
+    selected = {}
+    for seed in seeds:
+        selected.update(index.neighborhood(seed, hops, _INDEX_RELATION_KINDS, include_inheritance=True))
+    if include_ancestors:
+        for name in list(selected):
+            selected.update(dict.fromkeys(index.ancestors(name)))
+    return extract_classes(classmodel, selected, index)
+
+
+def partition_classdiagram(classmodel: ClassDiagram, max_classes: int = 200,
+                           index: Optional[ClassDiagramIndex] = None) -> List[List[str]]:
+    """按连通性把类切分成每页不超过max_classes个类的页面：大分量按宽度优先顺序切开使相邻的类尽量同页，
+    小分量依次装入同一页"""
+    index = index or ClassDiagramIndex(classmodel)
+    class_names = list(dict.fromkeys(cls.class_name for cls in classmodel.classes if cls is not None))
+
+    def neighbors(name):
+        for kind, rel in _index_relations(index, name):
+            yield rel.source_class
+            yield rel.target_class
+
+    return _pack_groups(_bfs_components(class_names, neighbors), max_classes, neighbors)
+
+
+def _render_pages(batch):
+    """进程池中执行：还原并渲染一批页面，写出.puml文件"""
+    for path, (classes, relations), cross_references in batch:
+        page = ClassDiagram.model_construct(
+            classes=[ClassStructure.model_construct(class_name=n, attributes=list(a), methods=list(m))
+                     for n, a, m in classes],
+            **{f"{kind}_relationships": [_DIAGRAM_RECORD_MODELS[f"{kind}_relationships"].model_construct(
+                **dict(zip(_DIAGRAM_RECORD_FIELDS[f"{kind}_relationships"], values))) for values in items]
+               for kind, items in relations.items()})
+        code = _generate_plantuml(page, verbose=False)
+        if cross_references:
+            notes = "\n".join(f"' {line}" for line in cross_references)
+            code = code.replace("\n@enduml", f"\n' 跨页引用：\n{notes}\n@enduml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(code)
+    return len(batch)
+
+
+def render_paged_plantuml(classmodel: ClassDiagram, out_dir: str, max_classes: int = 200,
+                          partition: Optional[Dict[str, List[str]]] = None,
+                          max_workers: Optional[int] = None) -> List[str]:
+    """把类图分页渲染到out_dir下的多个.puml文件，返回文件路径。
+    partition为页名到类名列表的映射（如按包划分），不给出时按连通性自动切分；跨页的关系在两端页面中以注释列出"""
+    index = ClassDiagramIndex(classmodel)
+    if partition is None:
+        partition = {f"page_{i + 1:03d}": names
+                     for i, names in enumerate(partition_classdiagram(classmodel, max_classes, index))}
+    page_of = {name: page for page, names in partition.items() for name in names}
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for page, names in partition.items():
+        cross_references = []
+        seen = set()
+        for name in names:
+            for kind, rel in _index_relations(index, name):
+                other = rel.target_class if rel.source_class == name else rel.source_class
+                other_page = page_of.get(other)
+                if other_page != page and id(rel) not in seen:
+                    seen.add(id(rel))
+                    where = f"见{other_page}.puml" if other_page else "不在任何页面中"
+                    cross_references.append(
+                        f"{rel.source_class} -> {rel.target_class}（{rel.relation_type}，{other}{where}）")
+        jobs.append((os.path.join(out_dir, f"{page}.puml"), _page_records(index, names), cross_references))
+    with open(os.path.join(out_dir, "index.txt"), "w", encoding="utf-8") as f:
+        for page, names in partition.items():
+            f.write(f"{page}.puml\t{len(names)}个类\t{'、'.join(names)}\n")
+    max_workers = max_workers or os.cpu_count() or 1
+    batches = [jobs[i::max_workers] for i in range(min(len(jobs), max_workers))]
+    _map_in_processes(_render_pages, batches, max_workers)
+    return [path for path, _, _ in jobs]
+
+
+# ---------------- 类图差异与补丁 ----------------
+# 两个版本的类图按结构比较：类按类名、成员按集合、关系按规范键匹配，成员顺序变化不算差异；
+# 补丁可序列化，也可以应用到旧类图上得到新类图，时间与类和关系的总数成线性
+class ClassPatch(BaseModel):
+    class_name: str
+    added_attributes: List[str] = Field(default_factory=list)
+    removed_attributes: List[str] = Field(default_factory=list)
+    added_methods: List[str] = Field(default_factory=list)
+    removed_methods: List[str] = Field(default_factory=list)
+
+
+class RelationChange(BaseModel):
+    kind: str = Field(description="关系所在的列表，如association_relationships")
+    key: List[str] = Field(description="规范键：关联为(发起方, 接收方, 关联名称)，其余关系为(发起方, 接收方)")
+    occurrence: int = Field(default=0, description="同一规范键的第几条关系")
+    values: Dict[str, str] = Field(default_factory=dict, description="新增时为全部字段，修改时为变化的字段")
+
+
+class ClassDiagramPatch(BaseModel):
+    added_classes: List[ClassStructure] = Field(default_factory=list)
+    removed_classes: List[str] = Field(default_factory=list)
+    changed_classes: List[ClassPatch] = Field(default_factory=list)
+    added_relations: List[RelationChange] = Field(default_factory=list)
+    removed_relations: List[RelationChange] = Field(default_factory=list)
+    changed_relations: List[RelationChange] = Field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not any(getattr(self, field) for field in type(self).model_fields)
+
+    def summary(self) -> str:
+        return (f"类 +{len(self.added_classes)} -{len(self.removed_classes)} ~{len(self.changed_classes)}，"
+                f"关系 +{len(self.added_relations)} -{len(self.removed_relations)} ~{len(self.changed_relations)}")
+
+
+def _relation_key(kind: str, rel) -> tuple:
+    if kind == "association_relationships":
+        return rel.source_class, rel.target_class, rel.assicaiation_name
+    return rel.source_class, rel.target_class
+
+
+def _keyed_relations(classmodel: ClassDiagram, kind: str) -> dict:
+    """(规范键, 序号) -> 关系；规范键相同的多条关系按出现顺序编号"""
+    keyed = {}
+    counts = {}
+    for rel in getattr(classmodel, kind):
+        if rel is None:
+            continue
+        key = _relation_key(kind, rel)
+        occurrence = counts.get(key, 0)
+        counts[key] = occurrence + 1
+        keyed[key, occurrence] = rel
+    return keyed
+
+
+def diff_classdiagrams(old: ClassDiagram, new: ClassDiagram) -> ClassDiagramPatch:
+    """计算从old到new的结构化补丁"""
+    patch = ClassDiagramPatch()
+    old_classes = {cls.class_name: cls for cls in old.classes if cls is not None}
+    new_classes = {cls.class_name: cls for cls in new.classes if cls is not None}
+    for name, cls in new_classes.items():
+        before = old_classes.get(name)
+        if before is None:
+            patch.added_classes.append(cls.model_copy(update={"attributes": list(cls.attributes),
+                                                              "methods": list(cls.methods)}))
+            continue
+        if before.attributes == cls.attributes and before.methods == cls.methods:
+            continue
+        change = ClassPatch(class_name=name)
+        for field in ("attributes", "methods"):
+            old_members, new_members = set(getattr(before, field)), set(getattr(cls, field))
+            getattr(change, f"added_{field}").extend(m for m in dict.fromkeys(getattr(cls, field)) if m not in old_members)
+            getattr(change, f"removed_{field}").extend(m for m in dict.fromkeys(getattr(before, field))
+                                                       if m not in new_members)
+        if change.added_attributes or change.removed_attributes or change.added_methods or change.removed_methods:
+            patch.changed_classes.append(change)
+    patch.removed_classes = [name for name in old_classes if name not in new_classes]
+    for kind in _RELATION_DEFAULT_TYPES:
+        old_relations, new_relations = _keyed_relations(old, kind), _keyed_relations(new, kind)
+        for (key, occurrence), rel in new_relations.items():
+            before = old_relations.get((key, occurrence))
+            if before is None:
+                patch.added_relations.append(RelationChange(kind=kind, key=list(key), occurrence=occurrence,
+                                                            values=rel.model_dump()))
+                continue
+            if before.__dict__ == rel.__dict__:
+                continue
+            changed = {f: v for f, v in rel.__dict__.items() if before.__dict__.get(f) != v}
+            if changed:
+                patch.changed_relations.append(RelationChange(kind=kind, key=list(key), occurrence=occurrence,
+                                                              values=changed))
+        patch.removed_relations.extend(RelationChange(kind=kind, key=list(key), occurrence=occurrence)
+                                       for key, occurrence in old_relations if (key, occurrence) not in new_relations)
+    return patch
+
+
+def apply_patch(classmodel: ClassDiagram, patch: ClassDiagramPatch) -> ClassDiagram:
+    """把补丁应用到类图副本上；补丁与类图不匹配（如删除不存在的类）时抛出ValueError。
+    类总是复制（refine会就地改写成员），未变化的关系对象与原类图共享，修改的关系复制后再改"""
+    # 原类图中的对象都已校验过，用model_construct复制，省去逐个校验
+    classes = {cls.class_name: ClassStructure.model_construct(class_name=cls.class_name, attributes=list(cls.attributes),
+                                                              methods=list(cls.methods))
+               for cls in classmodel.classes if cls is not None}
+    for name in patch.removed_classes:
+        if classes.pop(name, None) is None:
+            raise ValueError(f"补丁与类图不匹配：要删除的类{name}不存在")
+    for change in patch.changed_classes:
+        cls = classes.get(change.class_name)
+        if cls is None:
+            raise ValueError(f"补丁与类图不匹配：要修改的类{change.class_name}不存在")
+        for field in ("attributes", "methods"):
+            removed = set(getattr(change, f"removed_{field}"))
+            members = [m for m in getattr(cls, field) if m not in removed]
+            existing = set(members)
+            members.extend(m for m in getattr(change, f"added_{field}") if m not in existing)
+            setattr(cls, field, members)
+    for cls in patch.added_classes:
+        if cls.class_name in classes:
+            raise ValueError(f"补丁与类图不匹配：要新增的类{cls.class_name}已存在")
+        classes[cls.class_name] = cls.model_copy(update={"attributes": list(cls.attributes),
+                                                         "methods": list(cls.methods)})
+    result = ClassDiagram.model_construct(classes=list(classes.values()))
+    changes = {}
+    for op, items in (("removed", patch.removed_relations), ("changed", patch.changed_relations),
+                      ("added", patch.added_relations)):
+        for change in items:
+            changes.setdefault(change.kind, []).append((op, change))
+    for kind in _RELATION_DEFAULT_TYPES:
+        model = _DIAGRAM_RECORD_MODELS[kind]
+        relations = _keyed_relations(classmodel, kind)
+        for op, change in changes.get(kind, ()):
+            position = (tuple(change.key), change.occurrence)
+            if op == "added":
+                if position in relations:
+                    raise ValueError(f"补丁与类图不匹配：要新增的关系{change.key}已存在")
+                relations[position] = model(**change.values)
+            elif position not in relations:
+                raise ValueError(f"补丁与类图不匹配：关系{change.key}不存在")
+            elif op == "removed":
+                del relations[position]
+            else:
+                relations[position] = relations[position].model_copy(update=change.values)
+        setattr(result, kind, list(relations.values()))
+    return result
+
+
+# ---------------- 按连通分量并行优化 ----------------
+# refine_features只在同一继承树及其关联关系内部起作用：按继承+关联图的连通分量切分，
+# 各分量用紧凑的元组表示送入进程池分别优化，再按原顺序确定性地合并
+def _refine_components(classmodel: ClassDiagram):
+    """求含继承关系的连通分量，返回[(类下标, 继承关系下标, 关联关系下标)]"""
+    root = {}
+
+    def find(name):
+        root.setdefault(name, name)
+        while root[name] != name:
+            root[name] = root[root[name]]
+            name = root[name]
+        return name
+
+    for rel in classmodel.inheritance_relationships + classmodel.association_relationships:
+        root[find(rel.source_class)] = find(rel.target_class)
+    components = {}
+    for kind, items in ((0, classmodel.classes), (1, classmodel.inheritance_relationships),
+                        (2, classmodel.association_relationships)):
+        for i, item in enumerate(items):
+            if item is None:
+                continue
+            name = item.class_name if kind == 0 else item.source_class
+            if kind == 0 and name not in root:
+                continue
+            components.setdefault(find(name), ([], [], []))[kind].append(i)
+    return [component for component in components.values() if component[1]]
+
+
+def _map_in_processes(function, batches: list, max_workers: int) -> list:
+    """在进程池中对每批紧凑元组执行function并按顺序返回结果；只有一个进程或一批时直接在本进程执行。
+    fork可直接复用已加载的模块；不支持fork的平台使用默认启动方式"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    if max_workers == 1 or len(batches) <= 1:
+        return [function(batch) for batch in batches]
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        return list(executor.map(function, batches))
+
+
+def _pack_component(classmodel: ClassDiagram, component):
+    """将一个连通分量转成可pickle的紧凑元组"""
+    class_ids, inheritance_ids, association_ids = component
+    classes = tuple((i, c.class_name, tuple(c.attributes), tuple(c.methods))
+                    for i, c in ((i, classmodel.classes[i]) for i in class_ids))
+    inheritance = tuple((r.source_class, r.target_class, r.relation_type)
+                        for r in (classmodel.inheritance_relationships[i] for i in inheritance_ids))
+    fields = _DIAGRAM_RECORD_FIELDS["association_relationships"]
+    associations = tuple((i, tuple(getattr(classmodel.association_relationships[i], f) for f in fields))
+                         for i in association_ids)
+    return classes, inheritance, associations
+
+
+def _refine_packed_components(batch):
+    """进程池中执行：逐个还原连通分量并优化，返回(类下标, 属性, 方法)和保留下来的关联关系下标"""
+    fields = _DIAGRAM_RECORD_FIELDS["association_relationships"]
+    results = []
+    for classes, inheritance, associations in batch:
+        model = ClassDiagram(
+            classes=[ClassStructure(class_name=n, attributes=list(a), methods=list(m)) for _, n, a, m in classes],
+            inheritance_relationships=[InheritanceRelationship(source_class=s, target_class=t, relation_type=r)
+                                       for s, t, r in inheritance],
+            association_relationships=[AssociationRelationship(**dict(zip(fields, values))) for _, values in associations])
+        # 用对象标识找回保留下来的关联关系对应的原下标
+        ids = {id(rel): i for rel, (i, _) in zip(model.association_relationships, associations)}
+        _refine_classdiagram(model, verbose=False)
+        results.append(([(i, tuple(c.attributes), tuple(c.methods)) for (i, _, _, _), c in zip(classes, model.classes)],
+                        [ids[id(rel)] for rel in model.association_relationships]))
+    return results
+
+
+@profile_stage("refine_features_parallel")
+def refine_features_parallel(classmodel: ClassDiagram, max_workers: Optional[int] = None) -> ClassDiagram:
+    """按连通分量在进程池中并行执行refine_features的优化，结果与单线程一致，返回新的类图"""
+    components = _refine_components(classmodel)
+    max_workers = max_workers or os.cpu_count() or 1
+    # 大分量优先、轮流分配到若干批，减少进程间通信次数并均衡负载
+    components.sort(key=lambda c: -(len(c[0]) + len(c[2])))
+    batches = [[] for _ in range(min(len(components), max_workers * 4))]
+    batch_components = [[] for _ in batches]
+    for i, component in enumerate(components):
+        batches[i % len(batches)].append(_pack_component(classmodel, component))
+        batch_components[i % len(batches)].append(component)
+    outputs = _map_in_processes(_refine_packed_components, batches, max_workers)
+    result = classmodel.model_copy(deep=True)
+    removed = set()
+    for (class_results, kept), component in zip((r for output in outputs for r in output),
+                                                (c for batch in batch_components for c in batch)):
+        for i, attributes, methods in class_results:
+            result.classes[i].attributes = list(attributes)
+            result.classes[i].methods = list(methods)
+        removed.update(set(component[2]) - set(kept))
+    result.association_relationships = [rel for i, rel in enumerate(result.association_relationships) if i not in removed]
+    return result
+
+
+# 逐类分析阶段：阶段名（与图节点同名）及对应的工具，工作表按此顺序补做分析
+PER_CLASS_ANALYSES = [
+    ("analyze_features", analyze_features),
+    ("analyze_generalization", analyze_generalization2),
+    ("analyze_association", analyze_associations),
+]
+
+
+def _mark_analyzed(analyzed: Dict[str, List[str]], stage: str, classmodel: ClassDiagram,
+                   unfinished=()) -> Dict[str, List[str]]:
+    """记录classmodel中的类已经经过stage阶段的分析；unfinished中的类（因超时未完成）不记录，留给工作表补做"""
+    result = {name: names.copy() for name, names in analyzed.items()}
+    done = result.setdefault(stage, [])
+    seen = set(done) | set(unfinished)
+    for cls in classmodel.classes:
+        if cls is not None and cls.class_name not in seen:
+            done.append(cls.class_name)
+            seen.add(cls.class_name)
+    return result
+
+
+def run_worklist(text: str, classmodel: ClassDiagram, analyzed: Dict[str, List[str]], max_iterations: int = 2,
+                 cluster_options: Optional[ClusterOptions] = None, invent_children: bool = True,
+                 batch_size: int = 1):
+    """工作表调度：各阶段中途新增的类只补做其尚未做过的分析，达到不动点或迭代上限时停止；
+    cluster_options、invent_children和batch_size与各阶段相同（token规划降级后补做时也不再推想子类）"""
+    analyzed = {name: names.copy() for name, names in analyzed.items()}
+    options = {"cluster_options": cluster_options, "invent_children": invent_children, "batch_size": batch_size}
+    for iteration in range(max_iterations):
+        progressed = False
+        for stage, stage_tool in PER_CLASS_ANALYSES:
+            done = set(analyzed.get(stage, []))
+            pending = [cls.class_name for cls in classmodel.classes if cls is not None and cls.class_name not in done]
+            if not pending:
+                continue
+            print(f"工作表第{iteration + 1}轮：{stage} 补充分析新增的类", pending)
+            arguments = {"text": text, "classmodel": classmodel, "only_classes": pending}
+            arguments.update({name: value for name, value in options.items() if name in stage_tool.args})
+            classmodel = stage_tool.invoke(arguments)
+            unfinished = set(_take_unfinished(stage))
+            analyzed.setdefault(stage, []).extend(name for name in pending if name not in unfinished)
+            progressed = True
+        if not progressed:
+            print("工作表已达到不动点")
+            break
+    else:
+        print(f"工作表达到迭代上限{max_iterations}轮，停止补充分析")
+    return classmodel, analyzed
+
+
+# ---------------- 逐类流水线执行 ----------------
+# analyze_classes的响应以流式返回，每解析出一个完整的类就交给特征分析，
+# 各阶段之间用有界队列逐类传递结果，不必等上一阶段全部完成
+class StreamingClassParser:
+    """增量解析流式JSON中"classes"数组里的类对象，每个对象闭合后立即产出"""
+    _classes_key = re.compile(r'"classes"\s*:\s*\[')
+
+    def __init__(self):
+        self.text = ""
+        self.position = None
+        self.depth = 0
+        self.start = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False
+
+    def feed(self, chunk: str) -> List[ClassStructure]:
+        """追加一段文本，返回其中新闭合的类"""
+        import json
+        self.text += chunk
+        if self.position is None:
+            match = self._classes_key.search(self.text)
+            if not match:
+                return []
+            self.position = match.end()
+        found = []
+        text = self.text
+        i = self.position
+        while i < len(text) and not self.done:
+            ch = text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                if self.depth == 0:
+                    self.start = i
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        found.append(ClassStructure.model_validate(json.loads(text[self.start:i + 1])))
+                    except Exception as e:
+                        print("流式解析类失败，跳过：", e)
+            elif ch == "]" and self.depth == 0:
+                self.done = True
+            i += 1
+        self.position = i
+        return found
+
+
+_PIPELINE_DONE = object()
+
+
+def _run_pipeline_stage(name, handle, inbox, outbox, workers, stats, errors, batch_size: int = 1):
+    """启动一个流水线阶段：workers个线程每次从inbox取至多batch_size项，交给handle（参数和返回值都是列表）处理后
+    逐项放入outbox，全部结束后向outbox发送结束标记；handle抛出的异常记入errors（阶段名, 该批各项, 异常），
+    工作线程继续处理后面的项"""
+    import contextvars
+    import queue
+    import threading
+    import time
+
+    def work():
+        while True:
+            item = inbox.get()
+            if item is _PIPELINE_DONE:
+                inbox.put(_PIPELINE_DONE)
+                return
+            batch = [item]
+            # 已经排队的项凑成一批，不等待后来的项
+            while len(batch) < batch_size:
+                try:
+                    item = inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _PIPELINE_DONE:
+                    inbox.put(_PIPELINE_DONE)
+                    break
+                batch.append(item)
+            started = time.perf_counter()
+            try:
+                results = handle(batch)
+            except Exception as e:
+                print(f"流水线阶段{name}处理失败：", e)
+                errors.append((name, batch, e))
+                continue
+            finally:
+                stats.setdefault(name, []).append(time.perf_counter() - started)
+            for result in results:
+                outbox.put(result)
+
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(work,), daemon=True)
+               for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    def finish():
+        for thread in threads:
+            thread.join()
+        outbox.put(_PIPELINE_DONE)
+
+    threading.Thread(target=finish, daemon=True).start()
+
+
+def analyze_classes_pipelined(text: str, classmodel: ClassDiagram, llm=None, workers: int = 4,
+                              queue_size: int = 8, invent_children: bool = True, per_class_text: Optional[str] = None,
+                              batch_size: int = 1):
+    """流水线执行类识别→特征→泛化→关联：流式解析出的每个类立即进入下一阶段，结果经队列逐类传递；
+    per_class_text不为空时（如浓缩后的领域摘要）逐类分析用它代替原文；batch_size大于1时特征分析把已排队的类合并成一次调用。
+    泛化分析开始时其他类的特征还未分析完，因此不做本地泛化检测和类簇划分，每个类都调用chain1（与非流水线模式不同）。
+    返回类图、识别到的类名，以及各阶段出错而未完成的类（阶段名→类名，出错阶段之后的阶段也计入）；
+    所有类都出错时抛出第一个异常"""
+    import queue
+    import threading
+    import time
+    llm = llm or create_llm()
+    class_text = per_class_text or text
+    started = time.perf_counter()
+    stats = {}
+    errors = []
+    lock = threading.Lock()
+    result = ClassDiagram()
+    names_ready = threading.Event()
+    class_names = []
+    streamed = {}
+    # 泛化分析要等类识别的流结束才开始，它的收件箱不设上限：否则特征分析阻塞在向它投递上，
+    # 生产者又阻塞在向特征分析投递上，类识别的流永远读不完；结果队列同理不设上限
+    feature_inbox, association_inbox = (queue.Queue(maxsize=queue_size) for _ in range(2))
+    generalization_inbox, finished = queue.Queue(), queue.Queue()
+
+    def merge_classes(new_classes):
+        # 与各分析工具相同：已有的类合并属性和方法，新类直接添加
+        for new_class in new_classes:
+            target_class = next((c for c in result.classes if c.class_name == new_class.class_name), None)
+            if target_class:
+                target_class.attributes = list(dict.fromkeys(target_class.attributes + new_class.attributes))
+                target_class.methods = list(dict.fromkeys(target_class.methods + new_class.methods))
+            else:
+                result.classes.append(new_class)
+
+    def features(batch):
+        names = [cls.class_name for cls in batch]
+        try:
+            analyzed = invoke_chain(feture_prompt | llm | parser, {"input": class_text, "class_name": "，".join(names)},
+                                    label=f"特征分析：{'，'.join(names)}")
+        except DeadlineExceeded:
+            _run_context.get().skip(f"特征分析：{'，'.join(names)}", "analyze_features", names)
+            analyzed = ClassDiagram()
+        with lock:
+            for cls in batch:
+                target_class = next((c for c in analyzed.classes if c.class_name == cls.class_name), None)
+                merge_classes([target_class or cls])
+        return names
+
+    def generalization(names):
+        # 泛化分析需要完整的类集合，等待类识别的流结束
+        names_ready.wait()
+        classnames = ",".join(class_names)
+        for class_name in names:
+            inputs = {"input": class_text, "class_name": class_name, "classes": classnames}
+            try:
+                temp_results = [invoke_chain(Generalization_prompt1 | llm | parser, inputs, label=f"泛化分析：{class_name}")]
+                if invent_children:
+                    temp_results.append(invoke_chain(Generalization_prompt2 | llm | parser, inputs, optional=True,
+                                                     label=f"推理子类：{class_name}"))
+            except DeadlineExceeded:
+                _run_context.get().skip(f"泛化分析：{class_name}", "analyze_generalization", [class_name])
+                continue
+            with lock:
+                for temp_result in temp_results:
+                    merge_classes(temp_result.classes)
+                    for inh_rel in temp_result.inheritance_relationships:
+                        if inh_rel not in result.inheritance_relationships:
+                            result.inheritance_relationships.append(inh_rel)
+        return names
+
+    def association(names):
+        for class_name in names:
+            with lock:
+                existing_class_names = {c.class_name for c in result.classes}
+            try:
+                temp_result = invoke_chain(Association_prompt | llm | parser,
+                                           {"input": class_text, "class_name": class_name, "classes": existing_class_names},
+                                           label=f"关联分析：{class_name}")
+            except DeadlineExceeded:
+                _run_context.get().skip(f"关联分析：{class_name}", "analyze_association", [class_name])
+                continue
+            with lock:
+                merge_classes(temp_result.classes)
+                for asso_rel in temp_result.association_relationships:
+                    if asso_rel not in result.association_relationships:
+                        result.association_relationships.append(asso_rel)
+            if "first_class" not in stats:
+                stats["first_class"] = time.perf_counter() - started
+        return names
+
+    stages = ["analyze_features", "analyze_generalization", "analyze_association"]
+    _run_pipeline_stage(stages[0], features, feature_inbox, generalization_inbox, workers, stats, errors,
+                        max(1, batch_size))
+    _run_pipeline_stage(stages[1], generalization, generalization_inbox, association_inbox, workers, stats, errors)
+    _run_pipeline_stage(stages[2], association, association_inbox, finished, workers, stats, errors)
+
+    # 生产者：流式读取类识别的响应，每闭合一个类就送入特征分析
+    stream_parser = StreamingClassParser()
+    seen = set()
+
+    def produce(cls):
+        seen.add(cls.class_name)
+        class_names.append(cls.class_name)
+        streamed[cls.class_name] = cls
+        feature_inbox.put(cls)
+
+    try:
+        for chunk in (class_prompt | llm).stream({"input": text}):
+            remaining = _remaining_time()
+            if remaining is not None and remaining <= 0:
+                _run_context.get().skip("类识别的流式响应未读完")
+                break
+            for cls in stream_parser.feed(chunk.content if hasattr(chunk, "content") else str(chunk)):
+                if cls.class_name not in seen:
+                    print("流式识别到类：", cls.class_name)
+                    produce(cls)
+    except Exception as e:
+        # 类识别中途失败时，已识别的类照常完成后续分析
+        print("类识别的流式响应中断：", e)
+        errors.append(("analyze_classes", [], e))
+    # 与analyze_classes相同：保留原有但未被识别出的类
+    for old_class in classmodel.classes:
+        if old_class is not None and old_class.class_name not in seen:
+            produce(old_class)
+    stats["analyze_classes"] = [time.perf_counter() - started]
+    names_ready.set()
+    feature_inbox.put(_PIPELINE_DONE)
+    completed = []
+    while True:
+        name = finished.get()
+        if name is _PIPELINE_DONE:
+            break
+        completed.append(name)
+    # 出错的批次没有合并进类图，保留识别到的类
+    with lock:
+        merged = {c.class_name for c in result.classes}
+        merge_classes([streamed[name] for name in class_names if name not in merged])
+    failed = {}
+    for stage, batch, _ in errors:
+        if stage not in stages:
+            continue
+        names = [item.class_name if isinstance(item, ClassStructure) else item for item in batch]
+        for later in stages[stages.index(stage):]:
+            failed.setdefault(later, []).extend(names)
+    if errors:
+        print(f"流水线中{len(errors)}批处理失败，未完成的类：",
+              {stage: names for stage, names in failed.items()})
+        if set(class_names) <= set(failed.get(stages[-1], [])):
+            raise errors[0][2]
+    total = time.perf_counter() - started
+    stage_sum = sum(sum(times) for key, times in stats.items() if key != "first_class")
+    print(f"流水线完成：首个类完成耗时{stats.get('first_class', total):.2f}s，总耗时{total:.2f}s，"
+          f"各阶段耗时之和{stage_sum:.2f}s")
+    return result, class_names, failed
+
+
+# ---------------- token预算规划 ----------------
+# 运行前用本地分词器估算每个渲染后的提示和各阶段的token总数，超出预算时裁剪上下文或降级
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_token_encoder = None
+# tiktoken首次使用某个编码时会联网下载词表并缓存；这里只在缓存中已有完整词表时才加载，从不联网
+_CL100K_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+_CL100K_SHA256 = "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7"
+
+
+def _cached_tiktoken_file() -> Optional[str]:
+    """按tiktoken的缓存规则（TIKTOKEN_CACHE_DIR、DATA_GYM_CACHE_DIR或临时目录）找到本地的cl100k_base词表，
+    不存在或校验不通过时返回None"""
+    import hashlib
+    import tempfile
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR", os.environ.get("DATA_GYM_CACHE_DIR"))
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    if not cache_dir:
+        return None
+    path = os.path.join(cache_dir, hashlib.sha1(_CL100K_URL.encode()).hexdigest())
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # 校验不通过时tiktoken会删除缓存并重新下载，所以先自行校验
+    return path if hashlib.sha256(data).hexdigest() == _CL100K_SHA256 else None
+
+
+def count_tokens(text: str) -> int:
+    """估算文本的token数：本地缓存有tiktoken词表时精确计数，否则按字符粗略估算"""
+    global _token_encoder
+    if _token_encoder is None:
+        _token_encoder = False
+        if tiktoken is None:
+            print("未安装tiktoken，改用字符估算token数")
+        elif _cached_tiktoken_file() is None:
+            print("本地缓存中没有cl100k_base词表（可用TIKTOKEN_CACHE_DIR指定缓存目录），改用字符估算token数")
+        else:
+            try:
+                _token_encoder = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                print("tiktoken分词器不可用，改用字符估算：", e)
+    if _token_encoder:
+        return len(_token_encoder.encode(text, disallowed_special=()))
+    # 汉字约1个token，其余字符约4个一个token
+    cjk = len(re.findall(r'[\u3000-\u9fff\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class TokenBudgetExceeded(Exception):
+    """预计token超出预算，拒绝运行"""
+
+
+class TokenBudget(BaseModel):
+    per_call_tokens: int = Field(default=8000, description="单次调用的token上限（提示+输出）")
+    per_run_tokens: int = Field(default=400000, description="整次运行的token上限")
+    completion_tokens_per_class: int = Field(default=300, description="每个类预计输出的token数")
+    expected_classes: int = Field(default=15, description="analyze_classes预计得到的类数")
+    max_feature_batch_size: int = Field(default=8, description="特征分析每次调用最多分析的类数")
+
+
+class StagePlan(BaseModel):
+    stage: str
+    calls: int
+    prompt_tokens: int = Field(description="单次调用提示的最大token数")
+    completion_tokens: int = Field(description="单次调用预计输出的token数")
+    total_tokens: int = Field(description="该阶段预计的token总数（提示+输出）")
+
+
+class TokenPlan(BaseModel):
+    stages: List[StagePlan] = Field(default_factory=list)
+    total_tokens: int = 0
+    input_text: str = ""
+    feature_batch_size: int = 1
+    invent_children: bool = True
+    worklist_iterations: int = 2
+    fits: bool = True
+    notes: List[str] = Field(default_factory=list)
+
+
+def _trim_to_tokens(text: str, max_tokens: int) -> str:
+    """按段落保留需求文本的开头部分，使其不超过max_tokens"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    kept = []
+    used = 0
+    for paragraph in text.split("\n"):
+        cost = count_tokens(paragraph + "\n")
+        if used + cost > max_tokens:
+            break
+        kept.append(paragraph)
+        used += cost
+    if kept:
+        return "\n".join(kept)
+    # 第一段就超出时按字符二分截断
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def _estimate_stages(input_text: str, class_names: List[str], budget: TokenBudget,
+                     batch_size: int, invent_children: bool, worklist_iterations: int,
+                     candidates: Optional[GeneralizationCandidates] = None,
+                     cluster_options: Optional[ClusterOptions] = None) -> List[StagePlan]:
+    """按当前pipeline的调用方式估算各阶段的调用次数和token数；candidates为已知类的本地泛化检测结果"""
+    n = max(len(class_names), budget.expected_classes)
+    names = class_names + [f"示例类{i}" for i in range(n - len(class_names))]
+    # 泛化分析中chain2为每个类推理子类，chain1为部分类推理公共父类
+    new_classes = n if invent_children else n // 3
+    all_names = names + [f"新增类{i}" for i in range(new_classes)]
+    output = budget.completion_tokens_per_class
+    sample = names[0] if names else "示例类"
+    # 本地能判定继承关系的类不调用chain1，每个公共父类候选簇只调用一次chain1，其余的类（包括尚未识别的类）各调用一次
+    chain1_calls = n
+    if candidates is not None:
+        resolved = set(class_names) - set(candidates.unresolved)
+        chain1_calls = n - len(resolved) + len(candidates.shared_parent_clusters)
+    # 类很多时泛化和关联分析只带上所在类簇及边界类，另有每个类簇一次的跨类簇泛化和关联分析
+    clustering = cluster_options or ClusterOptions()
+    cluster_count = -(-n // clustering.max_cluster_size)
+    clustered = n >= clustering.min_classes
+    if clustered:
+        # 与cluster_classes相同：省下的类名token抵不上跨类簇调用（每次带上需求文本）时不划分
+        scoped_names = ",".join(names[:clustering.max_cluster_size + clustering.boundary_size])
+        saved = n * (count_tokens(",".join(names)) - count_tokens(scoped_names))
+        clustered = saved > cluster_count * count_tokens(input_text)
+    scope = clustering.max_cluster_size + clustering.boundary_size if clustered else len(all_names)
+
+    def stage(name, calls, prompt, completion):
+        prompt_tokens = count_tokens(prompt)
+        return StagePlan(stage=name, calls=calls, prompt_tokens=prompt_tokens, completion_tokens=completion,
+                         total_tokens=calls * (prompt_tokens + completion))
+
+    batch_names = "，".join(names[:batch_size])
+    stages = [
+        stage("analyze_classes", 1, class_prompt.format(input=input_text), output * n),
+        stage("analyze_features", -(-n // batch_size), feture_prompt.format(input=input_text, class_name=batch_names),
+              output * batch_size),
+        stage("analyze_generalization", chain1_calls + (n if invent_children else 0),
+              Generalization_prompt1.format(input=input_text, class_name=sample, classes=",".join(names[:scope])), output),
+        stage("analyze_association", n + new_classes,
+              Association_prompt.format(input=input_text, class_name=sample, classes=set(all_names[:scope])), output),
+    ]
+    if clustered:
+        hubs = names[:cluster_count * clustering.hubs_per_cluster]
+        stages.append(stage("cross_cluster", 2 * cluster_count,
+                            Association_prompt.format(input=input_text, class_name=",".join(hubs[:clustering.hubs_per_cluster]),
+                                                      classes=set(hubs)), output))
+    if worklist_iterations > 0 and new_classes:
+        worklist_calls = -(-new_classes // batch_size) + new_classes * (2 if invent_children else 1)
+        stages.append(stage("worklist", worklist_calls,
+                            Generalization_prompt1.format(input=input_text, class_name=sample, classes=",".join(all_names[:scope])),
+                            output))
+    return stages
+
+
+def plan_token_budget(input_text: str, class_names: List[str], budget: TokenBudget,
+                      classmodel: Optional[ClassDiagram] = None,
+                      cluster_options: Optional[ClusterOptions] = None) -> TokenPlan:
+    """估算各阶段token，选择特征分析批大小、裁剪需求文本并在必要时降级，使其满足单次和整次运行的预算；
+    给出classmodel时按其成员做本地泛化检测，本地能判定的类不计chain1调用；cluster_options与运行时的类簇设置一致"""
+    plan = TokenPlan(input_text=input_text)
+    candidates = detect_generalization_candidates(classmodel) if classmodel is not None else None
+    if candidates is not None and len(candidates.unresolved) < len(class_names):
+        plan.notes.append(f"本地泛化检测判定了{len(class_names) - len(candidates.unresolved)}个类，"
+                          f"类簇{len(candidates.shared_parent_clusters)}个")
+
+    def estimate(text, batch_size, invent_children, worklist_iterations):
+        return _estimate_stages(text, class_names, budget, batch_size, invent_children, worklist_iterations,
+                                candidates, cluster_options)
+
+    # 1.单次调用：每个提示都包含完整的需求文本，最大的一次调用超出时裁剪需求文本
+    stages = estimate(input_text, 1, True, plan.worklist_iterations)
+    largest = max(s.prompt_tokens + s.completion_tokens for s in stages)
+    if largest > budget.per_call_tokens:
+        input_tokens = count_tokens(input_text)
+        allowed = input_tokens - (largest - budget.per_call_tokens)
+        if allowed <= 0:
+            plan.fits = False
+            plan.notes.append(f"单次调用中类集合等固定部分已超出{budget.per_call_tokens}个token")
+            plan.stages = stages
+            plan.total_tokens = sum(s.total_tokens for s in stages)
+            return plan
+        plan.input_text = _trim_to_tokens(input_text, allowed)
+        plan.notes.append(f"需求文本从{input_tokens}个token裁剪到{count_tokens(plan.input_text)}个token")
+    # 2.特征分析批大小：在单次调用预算内尽量多地合并类，需求文本只发送一次
+    feature_prompt_tokens = count_tokens(feture_prompt.format(input=plan.input_text, class_name=""))
+    room = (budget.per_call_tokens - feature_prompt_tokens) // max(1, budget.completion_tokens_per_class + 8)
+    plan.feature_batch_size = max(1, min(budget.max_feature_batch_size, room))
+    # 3.整次运行：依次降级（不推理子类、不做工作表补充分析），仍超出则拒绝
+    for invent_children, worklist_iterations in ((True, 2), (False, 2), (False, 0)):
+        stages = estimate(plan.input_text, plan.feature_batch_size, invent_children, worklist_iterations)
+        plan.stages = stages
+        plan.total_tokens = sum(s.total_tokens for s in stages)
+        plan.invent_children = invent_children
+        plan.worklist_iterations = worklist_iterations
+        if plan.total_tokens <= budget.per_run_tokens:
+            break
+    if not plan.invent_children:
+        plan.notes.append("降级：泛化分析不再推理新的子类")
+    if plan.worklist_iterations == 0:
+        plan.notes.append("降级：跳过工作表补充分析")
+    if plan.total_tokens > budget.per_run_tokens:
+        plan.fits = False
+        plan.notes.append(f"降级后预计仍需{plan.total_tokens}个token，超出整次运行预算{budget.per_run_tokens}")
+    return plan
+
+
+def print_token_plan(plan: TokenPlan):
+    """运行前打印调用计划和各阶段预计的token数"""
+    print("token预算计划：")
+    print(f"{'阶段':<24}{'调用次数':>8}{'单次提示':>10}{'阶段合计':>12}")
+    for s in plan.stages:
+        print(f"{s.stage:<24}{s.calls:>8}{s.prompt_tokens:>10}{s.total_tokens:>12}")
+    print(f"预计合计：{plan.total_tokens}个token；特征分析批大小：{plan.feature_batch_size}")
+    for note in plan.notes:
+        print("  " + note)
+    if not plan.fits:
+        print("超出预算，拒绝运行")
+
+
+# ---------------- 需求文本浓缩 ----------------
+# 长需求文档先做一次map-reduce浓缩：分块并行抽取实体与事实，本地合并成领域摘要，
+# 按文档哈希缓存；逐类分析的提示用摘要代替原文，短文档直接使用原文
+class EntityFact(BaseModel):
+    name: str = Field(description="实体（候选类）名称，用汉语")
+    attributes: List[str] = Field(default_factory=list, description="文中提到的该实体的属性或信息")
+    behaviors: List[str] = Field(default_factory=list, description="该实体执行或参与的行为")
+
+
+class ChunkFacts(BaseModel):
+    entities: List[EntityFact] = Field(default_factory=list, description="文段中出现的实体")
+    relations: List[str] = Field(default_factory=list, description="实体之间的关系，如：每位顾客可以下多个订单")
+    constraints: List[str] = Field(default_factory=list, description="业务规则、数量和时间约束")
+
+
+digest_parser = PydanticOutputParser(pydantic_object=ChunkFacts)
+
+DIGEST_PROMPT_TEMPLATE = """
+你是非常有经验的系统分析师，请从以下需求文段中抽取建模所需的事实：出现的实体（人员、物品、事件、组织等）及其属性和行为，
+实体之间的关系（含数量），以及业务规则和约束。每条事实尽量简短，不要复述原文，不要遗漏实体。用汉语表示。
+严格遵循格式：
+{format_instructions}
+
+需求文段：
+{input}
+"""
+
+digest_prompt = PromptTemplate(
+    template=DIGEST_PROMPT_TEMPLATE,
+    input_variables=["input"],
+    partial_variables={"format_instructions": digest_parser.get_format_instructions()}
+)
+
+
+class CondenseOptions(BaseModel):
+    enabled: bool = Field(default=True, description="是否浓缩需求文本")
+    min_tokens: int = Field(default=3000, description="需求文本少于该token数时直接使用原文")
+    chunk_tokens: int = Field(default=1500, description="每个分块的token上限")
+    max_workers: int = Field(default=4, description="并行抽取的分块数")
+    cache_dir: str = Field(default=".digest_cache", description="摘要缓存目录，为空时不缓存")
+    prompt_tokens_per_second: float = Field(default=1500.0, description="估算延迟节省时假定的提示处理速度")
+
+
+class StageSaving(BaseModel):
+    stage: str
+    calls: int
+    raw_prompt_tokens: int = Field(description="使用原文时该阶段的提示token总数")
+    digest_prompt_tokens: int = Field(description="使用摘要时该阶段的提示token总数")
+    saved_tokens: int
+    saved_seconds: float = Field(description="按提示处理速度估算的延迟节省")
+
+
+class DigestReport(BaseModel):
+    digest_text: str = ""
+    cached: bool = False
+    chunks: int = 0
+    raw_tokens: int = 0
+    digest_tokens: int = 0
+    condense_tokens: int = Field(default=0, description="浓缩本身消耗的token（提示+输出）")
+    condense_seconds: float = 0.0
+    stages: List[StageSaving] = Field(default_factory=list)
+
+
+def _chunk_text(text: str, chunk_tokens: int) -> List[str]:
+    """按段落（过长的段落再按句子）切分，每块不超过chunk_tokens"""
+    pieces = []
+    for paragraph in text.split("\n"):
+        if count_tokens(paragraph) <= chunk_tokens:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(s for s in re.split(r'(?<=[。！？；.!?;])', paragraph) if s)
+    chunks, current, used = [], [], 0
+    for piece in pieces:
+        cost = count_tokens(piece) + 1
+        if current and used + cost > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, used = [], 0
+        current.append(piece)
+        used += cost
+    if current and "".join(current).strip():
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _merge_facts(facts: List[ChunkFacts]) -> str:
+    """把各分块的事实按实体名合并去重，生成领域摘要"""
+    entities = {}
+    relations, constraints = {}, {}
+    for chunk in facts:
+        for entity in chunk.entities:
+            name = entity.name.strip()
+            if not name:
+                continue
+            merged = entities.setdefault(name, ({}, {}))
+            merged[0].update(dict.fromkeys(a.strip() for a in entity.attributes if a.strip()))
+            merged[1].update(dict.fromkeys(b.strip() for b in entity.behaviors if b.strip()))
+        relations.update(dict.fromkeys(r.strip() for r in chunk.relations if r.strip()))
+        constraints.update(dict.fromkeys(c.strip() for c in chunk.constraints if c.strip()))
+    lines = ["【领域摘要】", "实体："]
+    for name, (attributes, behaviors) in entities.items():
+        line = f"- {name}"
+        if attributes:
+            line += "：属性 " + "、".join(attributes)
+        if behaviors:
+            line += ("；" if attributes else "：") + "行为 " + "、".join(behaviors)
+        lines.append(line)
+    if relations:
+        lines.append("关系：")
+        lines.extend(f"- {r}" for r in relations)
+    if constraints:
+        lines.append("约束：")
+        lines.extend(f"- {c}" for c in constraints)
+    return "\n".join(lines)
+
+
+def _digest_cache_path(text: str, options: CondenseOptions) -> Optional[str]:
+    import hashlib
+    if not options.cache_dir:
+        return None
+    # 提示模板或分块大小变化时缓存随之失效
+    key = hashlib.sha256("\0".join([DIGEST_PROMPT_TEMPLATE, str(options.chunk_tokens), text]).encode("utf-8"))
+    return os.path.join(options.cache_dir, key.hexdigest() + ".txt")
+
+
+def condense_requirements(text: str, options: Optional[CondenseOptions] = None, llm=None) -> DigestReport:
+    """map-reduce浓缩需求文本：分块并行抽取事实（map），本地合并为领域摘要（reduce），结果按文档哈希缓存"""
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    options = options or CondenseOptions()
+    started = time.perf_counter()
+    report = DigestReport(raw_tokens=count_tokens(text))
+    cache_path = _digest_cache_path(text, options)
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            report.digest_text = f.read()
+        report.cached = True
+    else:
+        llm = llm or create_llm()
+        chain = digest_prompt | llm | digest_parser
+        chunks = _chunk_text(text, options.chunk_tokens)
+        report.chunks = len(chunks)
+
+        def extract(chunk):
+            return invoke_chain(chain, {"input": chunk}, label="需求浓缩")
+
+        with ThreadPoolExecutor(max_workers=max(1, options.max_workers)) as executor:
+            facts = list(executor.map(lambda chunk: contextvars.copy_context().run(extract, chunk), chunks))
+        report.digest_text = _merge_facts(facts)
+        report.condense_tokens = sum(count_tokens(digest_prompt.format(input=chunk)) for chunk in chunks) + \
+            sum(count_tokens(f.model_dump_json()) for f in facts)
+        if cache_path:
+            os.makedirs(options.cache_dir, exist_ok=True)
+            temp_path = cache_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(report.digest_text)
+            os.replace(temp_path, cache_path)
+    report.digest_tokens = count_tokens(report.digest_text)
+    report.condense_seconds = time.perf_counter() - started
+    return report
+
+
+def estimate_digest_savings(report: DigestReport, raw_text: str, class_names: List[str],
+                            options: Optional[CondenseOptions] = None) -> List[StageSaving]:
+    """逐阶段估算用摘要代替原文节省的提示token和延迟（类识别阶段仍使用原文）"""
+    options = options or CondenseOptions()
+    budget = TokenBudget()
+    raw = _estimate_stages(raw_text, class_names, budget, 1, True, 2)
+    digest = _estimate_stages(report.digest_text, class_names, budget, 1, True, 2)
+    savings = []
+    for raw_stage, digest_stage in zip(raw, digest):
+        if raw_stage.stage == "analyze_classes":
+            continue
+        raw_tokens = raw_stage.calls * raw_stage.prompt_tokens
+        digest_tokens = digest_stage.calls * digest_stage.prompt_tokens
+        savings.append(StageSaving(stage=raw_stage.stage, calls=raw_stage.calls, raw_prompt_tokens=raw_tokens,
+                                   digest_prompt_tokens=digest_tokens, saved_tokens=raw_tokens - digest_tokens,
+                                   saved_seconds=(raw_tokens - digest_tokens) / options.prompt_tokens_per_second))
+    return savings
+
+
+def print_digest_report(report: DigestReport):
+    source = "缓存" if report.cached else f"{report.chunks}个分块"
+    print(f"需求浓缩（{source}）：原文{report.raw_tokens} token → 摘要{report.digest_tokens} token，"
+          f"浓缩消耗{report.condense_tokens} token、{report.condense_seconds:.2f}s")
+    for s in report.stages:
+        print(f"  {s.stage}：{s.calls}次调用，提示{s.raw_prompt_tokens} → {s.digest_prompt_tokens} token，"
+              f"节省{s.saved_tokens} token，约{s.saved_seconds:.1f}s")
+    saved = sum(s.saved_tokens for s in report.stages)
+    print(f"  合计节省{saved} token，扣除浓缩消耗后净节省{saved - report.condense_tokens} token")
+
+
+def _condense_node(state: AgentState) -> AgentState:
+    options = CondenseOptions(enabled=state.condense, min_tokens=state.condense_min_tokens)
+    if not options.enabled or count_tokens(state.input_text) < options.min_tokens:
+        return state
+    try:
+        report = condense_requirements(state.input_text, options)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        # 浓缩只是优化，失败时退回到原文继续分析
+        print(f"需求浓缩失败，使用原文：{type(e).__name__}: {e}")
+        ctx = _run_context.get()
+        if ctx is not None:
+            ctx.skip(f"需求浓缩失败（{type(e).__name__}），使用原文")
+        return state
+    report.stages = estimate_digest_savings(report, state.input_text,
+                                            [cls.class_name for cls in state.class_model.classes if cls is not None],
+                                            options)
+    print_digest_report(report)
+    return state.model_copy(update={"digest_text": report.digest_text})
+
+
+def _pipelined_node(state: AgentState) -> AgentState:
+    class_model, class_names, failed = analyze_classes_pipelined(state.input_text, state.class_model,
+                                                                 invent_children=state.invent_children,
+                                                                 per_class_text=state.digest_text or None,
+                                                                 batch_size=state.feature_batch_size)
+    # 流式识别到的类都已做过三个逐类分析，出错或超时未完成的和泛化中新增的类留给工作表补充
+    done = ClassDiagram(classes=[ClassStructure(class_name=name, attributes=[], methods=[]) for name in class_names])
+    analyzed = state.analyzed
+    for stage, _ in PER_CLASS_ANALYSES:
+        analyzed = _mark_analyzed(analyzed, stage, done, _take_unfinished(stage) + failed.get(stage, []))
+    return state.model_copy(update={"class_model": class_model, "analyzed": analyzed})
+
+
+def _per_class_node(stage: str, stage_tool, **state_arguments):
+    """逐类分析的图节点：工具参数取自state中同名映射的字段，完成后只把实际分析完的类记为已分析"""
+    def run(state: AgentState) -> AgentState:
+        inputs = {"text": state.digest_text or state.input_text, "classmodel": state.class_model}
+        inputs.update({argument: getattr(state, field) for argument, field in state_arguments.items()})
+        class_model = stage_tool.invoke(inputs)
+        analyzed = _mark_analyzed(state.analyzed, stage, state.class_model, _take_unfinished(stage))
+        return state.model_copy(update={"class_model": class_model, "analyzed": analyzed})
+
+    return run
+
+
+def _validated_stage(name: str, node):
+    """包装图节点：节点完成后校验并修复类图，只对丢失或空的、已做过特征分析的类重新请求特征（每个类一次）"""
+    def run(state: AgentState) -> AgentState:
+        after = node(state)
+        result = validate_classdiagram(after.class_model, previous=state.class_model)
+        featured = set(after.analyzed.get("analyze_features", []))
+        # 还没做特征分析的类本来就是空的，已经重试过的空类不再重复报告
+        diagnostics = [d for d in result.diagnostics if d.code != "empty_class"
+                       or (d.classes[0] in featured and d.classes[0] not in after.requeried)]
+        if not diagnostics:
+            return after.model_copy(update={"class_model": result.class_model})
+        for d in diagnostics:
+            d.stage = name
+        print_diagnostics(diagnostics)
+        class_model = result.class_model
+        requery = [n for n in dict.fromkeys(result.requery) if n in featured and n not in after.requeried]
+        if requery:
+            print(f"重新请求特征：{','.join(requery)}")
+            class_model = analyze_features.invoke({"text": after.digest_text or after.input_text,
+                                                   "classmodel": class_model, "only_classes": requery})
+        return after.model_copy(update={"class_model": class_model,
+                                        "diagnostics": after.diagnostics + diagnostics,
+                                        "requeried": after.requeried + requery})
+
+    return run
+
+
+def _llm_stage(name: str, node, share: float = 1.0, low_value: bool = False):
+    """包装调用LLM的图节点：按剩余时间的share比例分配阶段预算，超时或时间不足（低价值阶段）时跳过并保留已有结果"""
+    import time
+
+    def run(state: AgentState) -> AgentState:
+        ctx = _run_context.get()
+        if ctx is None or ctx.deadline is None:
+            return node(state)
+        now = time.monotonic()
+        remaining = ctx.deadline - now
+        if remaining <= 0 or (low_value and _short_of_time()):
+            ctx.timed_out = ctx.timed_out or remaining <= 0
+            ctx.skip(f"阶段{name}")
+            return state
+        ctx.stage_deadline = now + remaining * share
+        try:
+            return node(state)
+        except DeadlineExceeded:
+            # 整个节点作废，其中记录的未完成的类也不再需要
+            ctx.take_unfinished(name)
+            ctx.skip(f"阶段{name}未完成")
+            return state
+        finally:
+            ctx.stage_deadline = None
+            ctx.timed_out = ctx.timed_out or time.monotonic() >= ctx.deadline
+
+    return run
+
+
+def build_workflow(pipelined: bool = False):
     workflow = StateGraph(AgentState)
-    workflow.add_node("get_classes_from_Actors", lambda state: state.model_copy(
+
+    # 每个节点都可被剖析，剖析关闭时直接执行
+    def add_node(name, node):
+        workflow.add_node(name, profile_stage(name)(node))
+
+    add_node("get_classes_from_Actors", lambda state: state.model_copy(
         update={"class_model": get_classes_from_Actors.invoke(state.usecase_file_path)}
     ))
+
+    # 调用LLM的节点按剩余时间的比例分配阶段预算，超过截止时间时跳过；节点完成后校验修复类图
+    def add_llm_node(name, node, share, low_value=False):
+        add_node(name, _llm_stage(name, _validated_stage(name, node), share, low_value))
+
     # 节点定义调整为Pydantic模型兼容方式
-    workflow.add_node("analyze_classes", lambda state: state.model_copy(
+    add_llm_node("analyze_classes", lambda state: state.model_copy(
         update={"class_model": analyze_classes.invoke({
         "text": state.input_text,
         "classmodel": state.class_model
     })}
-    ))
-    workflow.add_node("analyze_features", lambda state: state.model_copy(
-        update={"class_model": analyze_features.invoke({
-        "text": state.input_text,
-        "classmodel": state.class_model
-    })}
-    ))
-    workflow.add_node("analyze_generalization", lambda state: state.model_copy(
-        update={"class_model": analyze_generalization2.invoke({
-        "text": state.input_text,
-        "classmodel": state.class_model
-        })}
-     ))
-    workflow.add_node("analyze_association", lambda state: state.model_copy(
-        update={"class_model": analyze_associations.invoke({
-        "text": state.input_text,
-        "classmodel": state.class_model
-        })}
-     ))
-    workflow.add_node("generate", lambda state: state.model_copy(
+    ), 0.5)
+    add_llm_node("analyze_features", _per_class_node("analyze_features", analyze_features,
+                                                     batch_size="feature_batch_size"), 0.3)
+    add_llm_node("analyze_generalization", _per_class_node("analyze_generalization", analyze_generalization2,
+                                                           invent_children="invent_children",
+                                                           cluster_options="cluster_options"), 0.45)
+    add_llm_node("analyze_association", _per_class_node("analyze_association", analyze_associations,
+                                                        cluster_options="cluster_options"), 0.8)
+    # 对各阶段中途新增的类补做缺少的分析，直到不动点；属于低价值工作，时间不足时跳过
+    add_llm_node("worklist", lambda state: state.model_copy(
+        update=dict(zip(("class_model", "analyzed"), run_worklist(state.digest_text or state.input_text, state.class_model, state.analyzed,
+                                                                   state.worklist_iterations, state.cluster_options,
+                                                                   state.invent_children, state.feature_batch_size)))
+    ), 1.0, low_value=True)
+    add_node("generate", lambda state: state.model_copy(
         update={"plantuml_code": generate_plantuml.invoke({
             "classmodel": state.class_model,
         })}
     ))
-    workflow.add_node("refine", lambda state: state.model_copy(
-        update={"class_model": refine_features.invoke({
+    add_node("refine", lambda state: state.model_copy(
+        update={"class_model": refine_features_parallel(state.class_model, state.refine_workers)
+                if state.refine_workers > 1 else refine_features.invoke({
             "classmodel": state.class_model
     })}
     ))
-    workflow.add_node("final_generate", lambda state: state.model_copy(
+    add_node("final_generate", lambda state: state.model_copy(
         update={"plantuml_code": generate_plantuml.invoke({
             "classmodel": state.class_model,
         })}
     ))
-    workflow.add_edge("get_classes_from_Actors", "analyze_classes")
-    workflow.add_edge("analyze_classes", "analyze_features")
-    workflow.add_edge("analyze_features", "analyze_generalization")
-    workflow.add_edge("analyze_generalization", "analyze_association")
-    workflow.add_edge("analyze_association", "generate")
+    # 流水线模式：类识别、特征、泛化、关联逐类重叠执行
+    add_llm_node("analyze_pipelined", _pipelined_node, 0.9)
+    # 长需求文本先浓缩一次，逐类分析的提示使用摘要；浓缩超时或失败时继续使用原文
+    add_node("condense", _llm_stage("condense", _condense_node, 0.2))
+    workflow.add_edge("get_classes_from_Actors", "condense")
+    if pipelined:
+        workflow.add_edge("condense", "analyze_pipelined")
+        workflow.add_edge("analyze_pipelined", "worklist")
+    else:
+        workflow.add_edge("condense", "analyze_classes")
+        workflow.add_edge("analyze_classes", "analyze_features")
+        workflow.add_edge("analyze_features", "analyze_generalization")
+        workflow.add_edge("analyze_generalization", "analyze_association")
+        workflow.add_edge("analyze_association", "worklist")
+    workflow.add_edge("worklist", "generate")
     workflow.add_edge("generate", "refine")
     workflow.add_edge("refine", "final_generate")
     workflow.add_edge("final_generate", END)
@@ -739,22 +3545,707 @@ def build_workflow():
     return workflow.compile()
 
 
-def analyze_text_to_plantuml(usecase_path_str:str,text: str) -> str:
-    agent = build_workflow()
-    result = agent.invoke(AgentState(usecase_file_path=usecase_path_str,input_text=text))
-    return AgentState(**result).plantuml_code
+class PipelineReport(BaseModel):
+    class_model: ClassDiagram = Field(default_factory=ClassDiagram, description="截至结束时得到的类图")
+    plantuml_code: str = Field(default="", description="由该类图生成的PlantUML代码")
+    skipped: List[str] = Field(default_factory=list, description="因时间不足或超时而跳过的工作")
+    timed_out: bool = Field(default=False, description="是否到达了截止时间")
+    elapsed: float = Field(default=0.0, description="总耗时（秒）")
+    diagnostics: List[Diagnostic] = Field(default_factory=list, description="节点间校验发现并修复的问题")
+
+
+def analyze_text_to_plantuml_report(usecase_path_str: str, text: str, token_budget: Optional[TokenBudget] = None,
+                                    pipelined: bool = False, deadline: Optional[float] = None,
+                                    agent=None, refine_workers: int = 1, condense: bool = True) -> PipelineReport:
+    """运行完整的分析流程；deadline为总时限（秒），到时返回已得到的最佳类图和被跳过工作的报告；
+    agent为已编译的工作流（常驻服务复用），不传时按pipelined新建；refine_workers大于1时refine在进程池中并行；
+    condense为False时不浓缩长需求文本"""
+    import time
+    ctx = RunContext(deadline)
+    context_token = _run_context.set(ctx)
+    try:
+        state = AgentState(usecase_file_path=usecase_path_str,input_text=text, refine_workers=refine_workers,
+                           condense=condense)
+        if token_budget is not None:
+            #运行前先估算各阶段的token，超出预算时裁剪上下文或降级，仍然超出则拒绝运行
+            actors = get_classes_from_Actors.invoke(usecase_path_str)
+            plan = plan_token_budget(text, [cls.class_name for cls in actors.classes], token_budget,
+                                     actors, state.cluster_options)
+            print_token_plan(plan)
+            if not plan.fits:
+                raise TokenBudgetExceeded("预计token超出预算：" + "；".join(plan.notes))
+            state = state.model_copy(update={
+                "input_text": plan.input_text,
+                "feature_batch_size": plan.feature_batch_size,
+                "invent_children": plan.invent_children,
+                "worklist_iterations": plan.worklist_iterations,
+            })
+        agent = agent or build_workflow(pipelined)
+        result = AgentState(**agent.invoke(state))
+    finally:
+        _run_context.reset(context_token)
+    return PipelineReport(class_model=result.class_model, plantuml_code=result.plantuml_code,
+                          diagnostics=result.diagnostics, skipped=ctx.skipped, timed_out=ctx.timed_out,
+                          elapsed=time.monotonic() - ctx.started)
+
+
+def analyze_text_to_plantuml(usecase_path_str:str,text: str, token_budget: Optional[TokenBudget] = None,
+                             pipelined: bool = False, deadline: Optional[float] = None, refine_workers: int = 1,
+                             condense: bool = True) -> str:
+    return analyze_text_to_plantuml_report(usecase_path_str, text, token_budget, pipelined, deadline,
+                                           refine_workers=refine_workers, condense=condense).plantuml_code
+
+
+# ---------------- HTTP服务模式 ----------------
+# 常驻的asyncio服务：工作流只编译一次，任务经有界队列交给后台线程执行；
+# 相同的并发任务合并为一个，相同的在途链调用由invoke_chain单飞合并
+class JobRequest(BaseModel):
+    # 不接受服务端文件路径等未知字段，避免通过网络读取服务器上的任意文件
+    model_config = {"extra": "forbid"}
+
+    text: str = Field(description="需求文本")
+    usecase: str = Field(default="", description="用例图参与者文本")
+    pipelined: bool = Field(default=False, description="是否使用流水线模式")
+    deadline: Optional[float] = Field(default=None, description="总时限（秒）")
+
+
+class Job(BaseModel):
+    job_id: str
+    key: str = Field(description="请求内容的哈希，相同的并发任务共用一个Job")
+    status: str = Field(default="queued", description="queued、running、done或failed")
+    submitters: int = Field(default=1, description="合并到该任务的提交次数")
+    created: float = 0.0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: str = ""
+    report: Optional[PipelineReport] = None
+
+
+def render_plantuml_text(content: str) -> str:
+    """离线路径：解析PlantUML文本→校验修复→优化类图→重新生成PlantUML，不调用LLM"""
+    classmodel = validate_classdiagram(parse_plantuml_text(content, verbose=False)).class_model
+    return _generate_plantuml(_refine_classdiagram(classmodel, verbose=False), verbose=False)
+
+
+class PumlService:
+    """接受HTTP任务的常驻服务：
+    POST /jobs 提交任务，GET /jobs/{id} 查询状态，GET /jobs/{id}/result 取结果（?format=puml返回PlantUML文本），
+    POST /render 同步执行离线的解析→优化→生成，GET /health 返回队列和单飞统计"""
+
+    def __init__(self, workers: int = 2, queue_size: int = 16, max_jobs: int = 1000,
+                 max_body_bytes: int = 4 * 1024 * 1024, max_render_bytes: int = 256 * 1024):
+        from concurrent.futures import ThreadPoolExecutor
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_jobs = max_jobs
+        self.max_body_bytes = max_body_bytes
+        self.max_render_bytes = max_render_bytes
+        # /render在自己的线程中执行，慢的渲染请求不占用任务线程
+        self._render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="puml-render")
+        self.jobs: Dict[str, Job] = {}
+        self._active: Dict[str, str] = {}  # 请求哈希 -> 排队或运行中的job_id
+        self._requests: Dict[str, JobRequest] = {}
+        self._queue = None
+        self._executor = ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix="puml-job")
+        # 工作流只编译一次，所有任务共用
+        self._agents = {False: build_workflow(False), True: build_workflow(True)}
+
+    def submit(self, request: JobRequest):
+        """提交任务，返回(job, 是否与已有任务合并)；队列已满时抛出asyncio.QueueFull"""
+        import hashlib
+        import time
+        import uuid
+        key = hashlib.sha256(request.model_dump_json().encode("utf-8")).hexdigest()
+        job_id = self._active.get(key)
+        if job_id is not None:
+            self.jobs[job_id].submitters += 1
+            return self.jobs[job_id], True
+        job = Job(job_id=uuid.uuid4().hex, key=key, created=time.time())
+        self._queue.put_nowait(job.job_id)
+        self.jobs[job.job_id] = job
+        self._requests[job.job_id] = request
+        self._active[key] = job.job_id
+        self._evict()
+        return job, False
+
+    def _evict(self):
+        # 只保留最近max_jobs个任务的记录，先淘汰已结束的
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def _run_job(self, request: JobRequest) -> PipelineReport:
+        import tempfile
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+            f.write(request.usecase)
+        try:
+            return analyze_text_to_plantuml_report(f.name, request.text, pipelined=request.pipelined,
+                                                   deadline=request.deadline, agent=self._agents[request.pipelined])
+        finally:
+            os.unlink(f.name)
+
+    async def _worker(self):
+        import asyncio
+        import time
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id = await self._queue.get()
+            job = self.jobs[job_id]
+            request = self._requests.pop(job_id)
+            job.status, job.started = "running", time.time()
+            try:
+                job.report = await loop.run_in_executor(self._executor, self._run_job, request)
+                job.status = "done"
+            except Exception as e:
+                job.status, job.error = "failed", f"{type(e).__name__}: {e}"
+            finally:
+                job.finished = time.time()
+                self._active.pop(job.key, None)
+                self._queue.task_done()
+
+    async def _handle(self, method: str, path: str, query: dict, body: bytes):
+        """返回(状态码, 响应体, Content-Type)"""
+        import asyncio
+        import json
+        parts = [p for p in path.split("/") if p]
+        if method == "POST" and parts == ["jobs"]:
+            try:
+                request = JobRequest.model_validate_json(body)
+            except ValueError as e:
+                return 400, {"error": str(e)}, None
+            try:
+                job, coalesced = self.submit(request)
+            except asyncio.QueueFull:
+                return 503, {"error": "任务队列已满，请稍后重试"}, None
+            return 202, {"job_id": job.job_id, "status": job.status, "coalesced": coalesced}, None
+        if method == "GET" and len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.jobs.get(parts[1])
+            if job is None:
+                return 404, {"error": "任务不存在"}, None
+            if len(parts) == 2:
+                return 200, job.model_dump(exclude={"report"}), None
+            if parts[2] != "result":
+                return 404, {"error": "未知路径"}, None
+            if job.status == "failed":
+                return 500, {"error": job.error}, None
+            if job.status != "done":
+                return 202, {"job_id": job.job_id, "status": job.status}, None
+            if query.get("format") == "puml":
+                return 200, job.report.plantuml_code, "text/plain; charset=utf-8"
+            return 200, job.report.model_dump(), None
+        if method == "POST" and parts == ["render"]:
+            # 低延迟的同步接口：请求体为PlantUML文本，或{"plantuml": "..."}
+            if len(body) > self.max_render_bytes:
+                return 413, {"error": f"/render的请求体超过{self.max_render_bytes}字节"}, None
+            content = body.decode("utf-8")
+            if content.lstrip().startswith("{"):
+                content = json.loads(content).get("plantuml", "")
+            code = await asyncio.get_running_loop().run_in_executor(self._render_executor, render_plantuml_text, content)
+            return 200, code, "text/plain; charset=utf-8"
+        if method == "GET" and parts == ["health"]:
+            statuses = {}
+            for job in self.jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return 200, {"queued": self._queue.qsize(), "jobs": statuses, "single_flight": single_flight_stats}, None
+        return 404, {"error": "未知路径"}, None
+
+    async def _serve_connection(self, reader, writer):
+        import asyncio
+        import json
+        from http import HTTPStatus
+        from urllib.parse import parse_qsl, urlsplit
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            if len(request_line) < 2:
+                return
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""):
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            # 读取请求体之前先检查长度，拒绝过大或不合法的Content-Length
+            length = headers.get("content-length", "0") or "0"
+            if not length.isdigit():
+                status, payload, content_type = 400, {"error": "Content-Length不合法"}, None
+            elif int(length) > self.max_body_bytes:
+                status, payload, content_type = 413, {"error": f"请求体超过{self.max_body_bytes}字节"}, None
+            else:
+                body = await reader.readexactly(int(length))
+                url = urlsplit(request_line[1])
+                status, payload, content_type = await self._handle(request_line[0].upper(), url.path,
+                                                                   dict(parse_qsl(url.query)), body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        except Exception as e:
+            status, payload, content_type = 500, {"error": f"{type(e).__name__}: {e}"}, None
+        if content_type is None:
+            payload = json.dumps(payload, ensure_ascii=False)
+            content_type = "application/json; charset=utf-8"
+        data = payload.encode("utf-8")
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n")
+        try:
+            writer.write(head.encode("latin-1") + data)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        import asyncio
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        server = await asyncio.start_server(self._serve_connection, host, port)
+        print(f"服务已启动：http://{host}:{server.sockets[0].getsockname()[1]}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in workers:
+                task.cancel()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._render_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, workers: int = 2, queue_size: int = 16,
+          max_body_bytes: int = 4 * 1024 * 1024):
+    import asyncio
+    asyncio.run(PumlService(workers, queue_size, max_body_bytes=max_body_bytes).serve(host, port))
+
+
+# ---------------- 监视模式 ----------------
+# 常驻进程轮询目录中的PlantUML文件（.puml，以及含类定义的.txt），文件保存并静默debounce秒后
+# 只重新解析改动的文件，解析结果常驻内存，校验→优化→生成后写到输出目录，并记录每次事件的延迟
+class WatchEvent(BaseModel):
+    path: str
+    summary: str = Field(default="", description="与上一版本相比的结构变化")
+    parse_ms: float = 0.0
+    refine_ms: float = 0.0
+    render_ms: float = Field(default=0.0, description="生成PlantUML并写出文件的耗时")
+    total_ms: float = Field(default=0.0, description="检测到变化后到写出文件的耗时")
+    since_save_ms: float = Field(default=0.0, description="从文件保存（修改时间）到写出文件的耗时，含轮询和防抖等待")
+    error: str = Field(default="", description="处理失败时的错误，此时没有写出文件")
+
+
+class PlantUMLWatcher:
+    """监视directory中的PlantUML文件，改动后把优化后的PlantUML写到out_dir：a.puml输出为a.puml，
+    其他后缀保留原扩展名（a.txt输出为a.txt.puml）；单个文件处理失败时产生错误事件并继续监视"""
+
+    def __init__(self, directory: str, out_dir: Optional[str] = None, interval: float = 0.05,
+                 debounce: float = 0.1, suffixes=(".puml", ".txt")):
+        self.directory = directory
+        self.out_dir = out_dir or os.path.join(directory, "_refined")
+        self.interval = interval
+        self.debounce = debounce
+        self.suffixes = tuple(suffixes)
+        self.models: Dict[str, ClassDiagram] = {}  # 常驻内存的解析结果
+        self.events: List[WatchEvent] = []
+        self._snapshot = {}  # 路径 -> (修改时间, 大小)
+        self._pending = {}  # 路径 -> 最近一次检测到变化的时刻
+        self._outputs = {}  # 输出路径 -> 写出它的源文件，只删除自己写出的输出
+        self._stop = threading.Event()
+
+    def _scan(self) -> dict:
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(self.suffixes):
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _output_path(self, path: str) -> str:
+        name = os.path.basename(path)
+        if not name.endswith(".puml"):
+            name += ".puml"
+        return os.path.join(self.out_dir, name)
+
+    def _refresh(self, path: str) -> Optional[WatchEvent]:
+        import time
+        started = time.perf_counter()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return self._remove(path)
+        model = parse_plantuml_text(content, verbose=False)
+        parsed = time.perf_counter()
+        if not model.classes and not path.endswith(".puml"):
+            # 不含类定义的.txt视为需求文本，不做处理（原先含类定义时移除其输出）
+            return self._remove(path)
+        previous = self.models.get(path)
+        output = self._output_path(path)
+        if previous is not None:
+            patch = diff_classdiagrams(previous, model)
+            if patch.is_empty() and self._outputs.get(output) == path and os.path.exists(output):
+                return None
+            summary = patch.summary()
+        else:
+            summary = f"新文件，{len(model.classes)}个类"
+        owner = self._outputs.get(output)
+        if owner is not None and owner != path:
+            raise ValueError(f"输出{output}已由{os.path.basename(owner)}写出")
+        # 校验返回副本，常驻的解析结果不被优化步骤改写
+        refined = _refine_classdiagram(validate_classdiagram(model).class_model, verbose=False)
+        refined_at = time.perf_counter()
+        code = _generate_plantuml(refined, verbose=False)
+        os.makedirs(self.out_dir, exist_ok=True)
+        with open(output + ".tmp", "w", encoding="utf-8") as f:
+            f.write(code)
+        os.replace(output + ".tmp", output)
+        # 写出成功后才替换常驻的解析结果，失败的版本在下次保存时重新处理
+        self.models[path] = model
+        self._outputs[output] = path
+        finished = time.perf_counter()
+        return WatchEvent(path=path, summary=summary, parse_ms=(parsed - started) * 1000,
+                          refine_ms=(refined_at - parsed) * 1000, render_ms=(finished - refined_at) * 1000,
+                          total_ms=(finished - started) * 1000, since_save_ms=(time.time() - mtime) * 1000)
+
+    def _remove(self, path: str) -> Optional[WatchEvent]:
+        self.models.pop(path, None)
+        output = self._output_path(path)
+        if self._outputs.get(output) != path:
+            return None
+        del self._outputs[output]
+        if os.path.exists(output):
+            os.remove(output)
+            return WatchEvent(path=path, summary="文件已删除，移除输出")
+        return None
+
+    def _process(self, path: str, exists: bool) -> Optional[WatchEvent]:
+        """处理一个文件的改动；读取、解码、解析或写出失败时返回错误事件，不影响其他文件"""
+        try:
+            return self._refresh(path) if exists else self._remove(path)
+        except Exception as e:
+            # 保留上一版本的解析结果，文件再次保存时重试
+            return WatchEvent(path=path, summary="处理失败", error=f"{type(e).__name__}: {e}")
+
+    def poll(self) -> List[WatchEvent]:
+        """扫描一次目录；静默超过debounce秒的改动文件被重新处理，返回本次产生的事件"""
+        import time
+        now = time.monotonic()
+        snapshot = self._scan()
+        for path in snapshot.keys() | self._snapshot.keys():
+            if snapshot.get(path) != self._snapshot.get(path):
+                self._pending[path] = now
+        self._snapshot = snapshot
+        events = []
+        for path, changed_at in list(self._pending.items()):
+            if now - changed_at < self.debounce:
+                continue
+            del self._pending[path]
+            event = self._process(path, path in snapshot)
+            if event is not None:
+                events.append(event)
+                self.events.append(event)
+                if event.error:
+                    print(f"{os.path.basename(path)}：{event.summary}，{event.error}")
+                    continue
+                if not event.total_ms:
+                    print(f"{os.path.basename(path)}：{event.summary}")
+                    continue
+                print(f"{os.path.basename(path)}：{event.summary}，解析{event.parse_ms:.1f}ms 优化{event.refine_ms:.1f}ms "
+                      f"生成{event.render_ms:.1f}ms，共{event.total_ms:.1f}ms（距保存{event.since_save_ms:.0f}ms）")
+        return events
+
+    def load(self):
+        """启动时处理目录中已有的文件，不计入延迟统计"""
+        self._snapshot = self._scan()
+        for path in self._snapshot:
+            event = self._process(path, True)
+            if event is not None and event.error:
+                print(f"{os.path.basename(path)}：{event.summary}，{event.error}")
+        print(f"已加载{len(self.models)}个类图文件，输出到{self.out_dir}")
+
+    def stats(self) -> dict:
+        result = {"events": len(self.events), "errors": sum(1 for e in self.events if e.error)}
+        for field in ("total_ms", "since_save_ms"):
+            values = sorted(getattr(e, field) for e in self.events if e.total_ms)
+            if values:
+                result[field] = {"mean": sum(values) / len(values), "p50": values[len(values) // 2],
+                                 "p95": values[min(len(values) - 1, int(len(values) * 0.95))], "max": values[-1]}
+        return result
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"共处理{stats['events']}次改动，其中{stats['errors']}次失败")
+        for field, name in (("total_ms", "处理耗时"), ("since_save_ms", "距保存")):
+            if field in stats:
+                s = stats[field]
+                print(f"  {name}：平均{s['mean']:.1f}ms p50 {s['p50']:.1f}ms p95 {s['p95']:.1f}ms 最大{s['max']:.1f}ms")
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        self.load()
+        try:
+            while not self._stop.wait(self.interval):
+                self.poll()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.print_stats()
+
+
+def watch_directory(directory: str, out_dir: Optional[str] = None, debounce: float = 0.1, interval: float = 0.05):
+    """监视模式入口：持续运行直到Ctrl+C，退出时打印延迟统计"""
+    PlantUMLWatcher(directory, out_dir, interval, debounce).run()
+
+
+# ---------------- 基准测试 ----------------
+def make_synthetic_classdiagram(n_classes: int, family_size: int = 8, seed: int = 1,
+                               cross_links: bool = True) -> ClassDiagram:
+    """构造用于基准测试的大型类图：若干继承族，子类成员包含父类成员，族内带随机关联，cross_links为True时族间也有关联"""
+    import random
+    rng = random.Random(seed)
+    result = ClassDiagram()
+    for i in range(n_classes):
+        family, pos = divmod(i, family_size)
+        name = f"类{i}"
+        if pos == 0:
+            attributes = [f"-族{family}属性{k}" for k in range(4)]
+            methods = [f"+族{family}操作{k}()" for k in range(2)]
+        else:
+            parent = result.classes[family * family_size + (pos - 1) // 2]
+            attributes = parent.attributes + [f"-类{i}属性{k}" for k in range(2)]
+            methods = parent.methods + [f"+类{i}操作()"]
+            result.inheritance_relationships.append(InheritanceRelationship(source_class=name, target_class=parent.class_name))
+        result.classes.append(ClassStructure(class_name=name, attributes=attributes, methods=methods))
+    for i in range(n_classes):
+        targets = [(i // family_size) * family_size + rng.randrange(family_size)]
+        if cross_links:
+            targets.insert(0, rng.randrange(n_classes))
+        for j in targets:
+            if j == i or j >= n_classes:
+                continue
+            result.association_relationships.append(AssociationRelationship(
+                assicaiation_name=f"关联{i}_{j}", source_class=f"类{i}", target_class=f"类{j}", relation_type="关联",
+                souce_multiplicity="1", target_multiplicity="0..*", source_role=f"角色{i}", target_role=f"角色{j}",
+                source_navigation="False", target_navigation="True"))
+    return result
+
+
+def benchmark_generalization_candidates(n_classes: int = 1000, repeat: int = 3):
+    """泛化候选本地检测的基准测试（默认1k个类）"""
+    import time
+    model = make_synthetic_classdiagram(n_classes)
+    expected = {(r.source_class, r.target_class) for r in model.inheritance_relationships}
+    model.inheritance_relationships = []
+    # 每隔一个类去掉一个继承来的属性，破坏子集关系，使其落入重叠类簇的判定
+    for cls in model.classes[1::2]:
+        cls.attributes = cls.attributes[1:]
+    default_threshold = detect_generalization_candidates.__defaults__[-1]
+    print(f"默认在待比较的类超过{default_threshold}个时才改用MinHash/LSH")
+    for lsh_threshold in (n_classes + 1, 0):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            candidates = detect_generalization_candidates(model, lsh_threshold=lsh_threshold)
+            best = min(best, time.perf_counter() - start)
+        found = {(r.source_class, r.target_class) for r in candidates.inheritance_relationships}
+        print(f"{n_classes}个类 强制{'MinHash/LSH' if lsh_threshold == 0 else '两两比较'}：耗时{best * 1000:.1f}ms，"
+              f"命中继承关系{len(found & expected)}/{len(expected)}，类簇{len(candidates.shared_parent_clusters)}个，"
+              f"待LLM分析的类{len(candidates.unresolved)}个")
+
+
+def benchmark_serialization(n_classes: int = 2000):
+    """对比类图的JSON Lines序列化与现有PlantUML文本往返的耗时、体积和保真度"""
+    import contextlib
+    import tempfile
+    import time
+    model = make_synthetic_classdiagram(n_classes)
+    with tempfile.TemporaryDirectory() as folder:
+        rows = []
+        puml_path = os.path.join(folder, "model.puml")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            with open(puml_path, "w", encoding="utf-8") as f:
+                f.write(generate_plantuml.func(model))
+            parsed = analyze_text_to_classdiagram.func(puml_path)
+        rows.append(("PlantUML往返", time.perf_counter() - start, os.path.getsize(puml_path), parsed == model))
+        for suffix in ([".jsonl", ".jsonl.zst"] if zstandard else [".jsonl"]):
+            path = os.path.join(folder, "model" + suffix)
+            start = time.perf_counter()
+            save_classdiagram(model, path)
+            loaded = load_classdiagram(path)
+            rows.append((suffix + "往返", time.perf_counter() - start, os.path.getsize(path), loaded == model))
+        path = os.path.join(folder, "model.jsonl")
+        start = time.perf_counter()
+        with ClassDiagramReader(path) as reader:
+            cls = reader.get_class(model.classes[n_classes // 2].class_name)
+        rows.append(("按索引读取单个类", time.perf_counter() - start, 0, cls == model.classes[n_classes // 2]))
+    for name, seconds, size, same in rows:
+        print(f"{name:<16}{seconds * 1000:>10.1f}ms{size / 1024:>10.1f}KB  与原模型一致：{same}")
+
+
+def benchmark_classdiagram_index(n_classes: int = 10000, queries: int = 10000, seed: int = 1):
+    """对比查询索引与逐次扫描关系列表（refine_features的做法）回答祖先、子类判断和2跳关联查询的耗时"""
+    import random
+    import time
+    model = make_synthetic_classdiagram(n_classes)
+    rng = random.Random(seed)
+    names = [cls.class_name for cls in model.classes]
+    pairs = [(rng.choice(names), rng.choice(names)) for _ in range(queries)]
+
+    def scan_ancestors(name):
+        found, stack = set(), [name]
+        while stack:
+            current = stack.pop()
+            for rel in model.inheritance_relationships:
+                if rel.source_class == current and rel.target_class not in found:
+                    found.add(rel.target_class)
+                    stack.append(rel.target_class)
+        return found
+
+    def scan_neighborhood(name, hops):
+        distance, frontier = {name: 0}, [name]
+        for hop in range(1, hops + 1):
+            next_frontier = []
+            for rel in model.association_relationships:
+                for a, b in ((rel.source_class, rel.target_class), (rel.target_class, rel.source_class)):
+                    if a in frontier and b not in distance:
+                        distance[b] = hop
+                        next_frontier.append(b)
+            frontier = next_frontier
+        return distance
+
+    start = time.perf_counter()
+    index = ClassDiagramIndex(model)
+    print(f"{n_classes}个类：建立索引{(time.perf_counter() - start) * 1000:.0f}ms")
+    # 扫描方式太慢，只取少量查询估算单次耗时
+    sample = pairs[:20]
+    rows = []
+    start = time.perf_counter()
+    for a, b in pairs:
+        index.is_subclass(a, b)
+    index_seconds = (time.perf_counter() - start) / len(pairs)
+    start = time.perf_counter()
+    same = all(index.is_subclass(a, b) == (b in scan_ancestors(a)) for a, b in sample)
+    rows.append(("is_subclass", index_seconds, (time.perf_counter() - start) / len(sample), same))
+    start = time.perf_counter()
+    for a, _ in pairs:
+        index.ancestors(a)
+    index_seconds = (time.perf_counter() - start) / len(pairs)
+    start = time.perf_counter()
+    same = all(set(index.ancestors(a)) == scan_ancestors(a) for a, _ in sample)
+    rows.append(("ancestors", index_seconds, (time.perf_counter() - start) / len(sample), same))
+    start = time.perf_counter()
+    for a, _ in pairs:
+        index.neighborhood(a, 2)
+    index_seconds = (time.perf_counter() - start) / len(pairs)
+    start = time.perf_counter()
+    same = all(index.neighborhood(a, 2) == scan_neighborhood(a, 2) for a, _ in sample)
+    rows.append(("2跳关联邻域", index_seconds, (time.perf_counter() - start) / len(sample), same))
+    for name, index_seconds, scan_seconds, same in rows:
+        print(f"{name:<12}索引{index_seconds * 1e6:>8.2f}µs  扫描{scan_seconds * 1e6:>12.1f}µs  "
+              f"加速{scan_seconds / index_seconds:>8.0f}倍  结果一致：{same}")
+    # 增量编辑与重建对比
+    rel = model.inheritance_relationships[len(model.inheritance_relationships) // 2]
+    start = time.perf_counter()
+    index.remove_inheritance(rel)
+    index.add_inheritance(rel)
+    edit_seconds = (time.perf_counter() - start) / 2
+    start = time.perf_counter()
+    rebuilt = ClassDiagramIndex(model)
+    rebuild_seconds = time.perf_counter() - start
+    same = all(set(index.ancestors(a)) == set(rebuilt.ancestors(a)) for a, _ in sample)
+    print(f"增量编辑一条继承{edit_seconds * 1000:.2f}ms，重建索引{rebuild_seconds * 1000:.0f}ms，结果一致：{same}")
+
+
+def benchmark_cluster_scoping(sizes=(60, 100, 500, 1000)):
+    """对比泛化（chain1）和关联分析带全部类名与按类簇限定时的提示token总数（含每次调用带上的需求文本），
+    类簇由按合成类图的继承和关联写成的需求文本划分；同时给出默认选项下cluster_classes是否会划分"""
+    import time
+    for n in sizes:
+        model = make_synthetic_classdiagram(n)
+        sentences = [f"{r.source_class}是一种{r.target_class}。" for r in model.inheritance_relationships]
+        sentences += [f"{r.source_class}与{r.target_class}之间存在{r.assicaiation_name}。" for r in model.association_relationships]
+        text = "\n".join(sentences)
+        expected = [(r.source_class, r.target_class) for r in model.inheritance_relationships]
+        model = ClassDiagram(classes=model.classes)
+        names = [cls.class_name for cls in model.classes]
+        start = time.perf_counter()
+        clusters = _partition_classes(text, model, names, ClusterOptions())
+        seconds = time.perf_counter() - start
+        together = sum(clusters.membership[a] == clusters.membership[b] for a, b in expected)
+
+        def tokens(calls):
+            return sum(count_tokens(Generalization_prompt1.format(input=text, class_name=name, classes=",".join(classes)))
+                       + count_tokens(Association_prompt.format(input=text, class_name=name, classes=set(classes)))
+                       for name, classes in calls)
+
+        full = tokens((name, names) for name in names)
+        cross = clusters.cross_cluster_calls()
+        scoped = tokens([(name, clusters.scope([name])) for name in names]
+                        + [(", ".join(hubs), others) for hubs, others in cross])
+        used = "划分" if cluster_classes(text, model) is not None else "不划分"
+        print(f"{n}个类：划分为{len(clusters.clusters)}个类簇，耗时{seconds * 1000:.0f}ms，"
+              f"父子类同簇{together}/{len(expected)}；全部类名{2 * n}次调用共{full}个token，"
+              f"按类簇{2 * (n + len(cross))}次调用共{scoped}个token，为全部类名的{scoped / full:.1%}；默认选项下{used}")
+
+
+def benchmark_refine_parallel(n_classes: int = 4000, workers=(1, 2, 4)):
+    """对比单线程refine与按连通分量并行refine的耗时，并核对结果一致"""
+    import time
+    model = make_synthetic_classdiagram(n_classes, cross_links=False)
+    # 子类重复一条父类的关联关系，让优化有关联可删
+    for rel in list(model.inheritance_relationships):
+        for asso in model.association_relationships:
+            if asso.source_class == rel.target_class:
+                model.association_relationships.append(asso.model_copy(update={"source_class": rel.source_class}))
+                break
+    start = time.perf_counter()
+    expected = _refine_classdiagram(model.model_copy(deep=True), verbose=False)
+    baseline = time.perf_counter() - start
+    print(f"{n_classes}个类，单线程：{baseline * 1000:.0f}ms")
+    for n in workers:
+        start = time.perf_counter()
+        result = refine_features_parallel(model, max_workers=n)
+        seconds = time.perf_counter() - start
+        print(f"按连通分量并行（{n}个进程）：{seconds * 1000:.0f}ms，加速{baseline / seconds:.1f}倍，结果一致：{result == expected}")
+
 
 if __name__ == "__main__":
-    #sample_text = "某供电局准备开发线路监控软件系统，用于各条供电线路的情况。该系统由专职的管理员来操作。每条供电线路安装一个线路检测仪，每30秒采集1次该线路的信息（包括电压、电流）。每隔1小时，线路检测仪通过专线向线路监控软件系统传送该小时的数据，系统接受后，保存在系统中。"
-    #从txt文件中读取sample_text
-    usecase_file_path = "usecase_model.txt"
-    with open("class_input.txt", "r", encoding="utf-8") as f:
-        sample_text = f.read()
-    #显示sample_text
-    print("输入文本:")
-    print(sample_text)
-    print("生成的PlantUML代码:")
-    print(analyze_text_to_plantuml(usecase_file_path,sample_text))
+    import argparse
+    arg_parser = argparse.ArgumentParser(description="从需求文本生成PlantUML类图")
+    arg_parser.add_argument("--serve", action="store_true", help="以常驻HTTP服务方式运行")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8000)
+    arg_parser.add_argument("--workers", type=int, default=2, help="同时执行的任务数")
+    arg_parser.add_argument("--queue-size", type=int, default=16, help="排队任务上限，超出时拒绝提交")
+    arg_parser.add_argument("--max-body", type=int, default=4 * 1024 * 1024, help="HTTP请求体的字节数上限")
+    arg_parser.add_argument("--watch", metavar="DIR", help="监视目录中的PlantUML文件，改动后输出优化结果")
+    arg_parser.add_argument("--out", metavar="DIR", help="监视模式的输出目录，默认为DIR/_refined")
+    arg_parser.add_argument("--debounce", type=float, default=0.1, help="文件静默多少秒后才处理")
+    arg_parser.add_argument("--refine-workers", type=int, default=1, help="大于1时refine按连通分量在多个进程中并行")
+    arg_parser.add_argument("--no-condense", action="store_true", help="长需求文本也直接使用原文，不先浓缩")
+    arg_parser.add_argument("--profile", metavar="DIR", help="剖析各本地阶段和图节点，把CPU、调用栈和内存结果写入DIR")
+    arg_parser.add_argument("--per-call-tokens", type=int, help="单次调用的token上限，给出后运行前先按预算规划")
+    arg_parser.add_argument("--per-run-tokens", type=int, help="整次运行的token上限，给出后运行前先按预算规划")
+    args = arg_parser.parse_args()
+    configure_profiling(args.profile)
+    if args.serve:
+        serve(args.host, args.port, args.workers, args.queue_size, args.max_body)
+    elif args.watch:
+        watch_directory(args.watch, args.out, args.debounce)
+    else:
+        #sample_text = "某供电局准备开发线路监控软件系统，用于各条供电线路的情况。该系统由专职的管理员来操作。每条供电线路安装一个线路检测仪，每30秒采集1次该线路的信息（包括电压、电流）。每隔1小时，线路检测仪通过专线向线路监控软件系统传送该小时的数据，系统接受后，保存在系统中。"
+        #从txt文件中读取sample_text
+        usecase_file_path = "usecase_model.txt"
+        with open("class_input.txt", "r", encoding="utf-8") as f:
+            sample_text = f.read()
+        #显示sample_text
+        print("输入文本:")
+        print(sample_text)
+        print("生成的PlantUML代码:")
+        limits = {"per_call_tokens": args.per_call_tokens, "per_run_tokens": args.per_run_tokens}
+        limits = {name: value for name, value in limits.items() if value is not None}
+        token_budget = TokenBudget(**limits) if limits else None
+        print(analyze_text_to_plantuml(usecase_file_path,sample_text, token_budget=token_budget,
+                                       refine_workers=args.refine_workers, condense=not args.no_condense))
 """
 if __name__ == "__main__":
     #从txt文件中读取class_text
@@ -0,0 +1,91 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "puml_class0.9.py")
+
+
+def _load_module():
+    # 脚本文件名中带点号，不能直接import；注册到sys.modules后进程池才能按名字找到其中的函数
+    if "puml_class" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("puml_class", MODULE_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["puml_class"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["puml_class"]
+
+
+@pytest.fixture(scope="session")
+def puml():
+    return _load_module()
+
+
+@pytest.fixture
+def synthetic(puml):
+    """共用的合成类图：若干继承族，族内外带随机关联"""
+    return puml.make_synthetic_classdiagram
+
+
+class FakeLLM:
+    """按提示内容返回预设JSON的假模型，记录收到的提示"""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.prompts = []
+
+    def __call__(self, prompt):
+        text = prompt.to_string() if hasattr(prompt, "to_string") else str(prompt)
+        self.prompts.append(text)
+        return self.respond(text)
+
+
+EMPTY_DIAGRAM = ('{"classes": [], "inheritance_relationships": [], "association_relationships": [], '
+                 '"aggregation_relationships": [], "composition_relationships": [], "dependency_relationships": []}')
+
+
+@pytest.fixture
+def fake_llm(puml, monkeypatch):
+    """把create_llm替换成假模型，respond默认返回空类图"""
+    from langchain_core.runnables import RunnableLambda
+
+    def install(respond=lambda prompt: EMPTY_DIAGRAM):
+        fake = FakeLLM(respond)
+        monkeypatch.setattr(puml, "create_llm", lambda model="gpt-4": RunnableLambda(fake))
+        return fake
+
+    return install
+
+
+class FakeStreamingLLM:
+    """可流式输出的假模型：respond(提示)返回完整文本，stream按chunk_size个字符分段产出"""
+
+    def __init__(self, respond, chunk_size=16, delay=0.0):
+        self.respond = respond
+        self.chunk_size = chunk_size
+        self.delay = delay
+        self.prompts = []
+
+    def runnable(self):
+        from langchain_core.runnables import Runnable
+
+        fake = self
+
+        class _Runnable(Runnable):
+            def invoke(self, prompt, config=None, **kwargs):
+                return fake._answer(prompt)
+
+            def stream(self, prompt, config=None, **kwargs):
+                import time
+                text = fake._answer(prompt)
+                for i in range(0, len(text), fake.chunk_size):
+                    time.sleep(fake.delay)
+                    yield text[i:i + fake.chunk_size]
+
+        return _Runnable()
+
+    def _answer(self, prompt):
+        text = prompt.to_string() if hasattr(prompt, "to_string") else str(prompt)
+        self.prompts.append(text)
+        return self.respond(text)
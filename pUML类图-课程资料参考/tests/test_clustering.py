@@ -0,0 +1,44 @@
+import re
+
+
+def _names_in(prompt):
+    # 关联分析的提示里，其他类的集合以Python集合的形式给出
+    return set(re.findall(r"'(类\d+)'", prompt.split("与其他类的集合", 1)[1].split("中的可能", 1)[0]))
+
+
+def test_worklist_scopes_pending_classes_by_cluster(puml, synthetic, fake_llm):
+    fake = fake_llm()
+    model = synthetic(200, cross_links=False)
+    names = [cls.class_name for cls in model.classes]
+    pending = ["类0", "类9"]
+    analyzed = {stage: names for stage, _ in puml.PER_CLASS_ANALYSES}
+    analyzed["analyze_association"] = [name for name in names if name not in pending]
+    options = puml.ClusterOptions(min_classes=0, max_cluster_size=8, boundary_size=2)
+
+    puml.run_worklist("需求", model, analyzed, 1, options)
+    prompts = [p for p in fake.prompts if "与其他类的集合" in p]
+    assert len(prompts) == len(pending)
+    for prompt in prompts:
+        assert 0 < len(_names_in(prompt)) <= options.max_cluster_size + options.boundary_size
+
+    fake.prompts.clear()
+    puml.run_worklist("需求", model, analyzed, 1, puml.ClusterOptions(min_classes=1000))
+    assert all(len(_names_in(p)) == len(names) for p in fake.prompts if "与其他类的集合" in p)
+
+
+def test_clustering_is_skipped_when_cross_calls_cost_more(puml, synthetic):
+    model = synthetic(200, cross_links=False)
+    options = puml.ClusterOptions(min_classes=0, max_cluster_size=8)
+    assert puml.cluster_classes("需求", model, options) is not None
+    # 跨类簇分析每次都带上需求文本，文本很长而类不多时按类簇限定反而更费token
+    assert puml.cluster_classes("需求" * 20000, model, options) is None
+    # 默认选项下类数不足min_classes时不划分
+    assert puml.cluster_classes("需求", puml.ClassDiagram(classes=model.classes[:64])) is None
+
+
+def test_oversized_groups_are_cut_along_breadth_first_order(puml):
+    # 链 类0-类1-…-类5 的成员顺序被打乱，切开后每个类簇仍是链上相邻的一段
+    links = {f"类{i}": [f"类{j}" for j in (i - 1, i + 1) if 0 <= j < 6] for i in range(6)}
+    group = ["类0", "类3", "类5", "类1", "类4", "类2"]
+    assert puml._pack_groups([group, ["甲"], ["乙", "丙"]], 3, links.get) == [
+        ["类0", "类1", "类2"], ["类3", "类4", "类5"], ["乙", "丙", "甲"]]
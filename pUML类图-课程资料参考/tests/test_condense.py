@@ -0,0 +1,50 @@
+import pytest
+
+
+def _state(puml, **update):
+    return puml.AgentState(usecase_file_path="", input_text="系统由管理员操作。" * 50, condense_min_tokens=1, **update)
+
+
+def test_condense_failure_falls_back_to_raw_text(puml, fake_llm, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def respond(prompt):
+        raise RuntimeError("模型不可用")
+
+    fake_llm(respond)
+    ctx = puml.RunContext(deadline=None)
+    token = puml._run_context.set(ctx)
+    try:
+        state = _state(puml)
+        result = puml._condense_node(state)
+    finally:
+        puml._run_context.reset(token)
+    assert result.digest_text == ""
+    assert result.input_text == state.input_text
+    assert any("需求浓缩失败" in s for s in ctx.skipped)
+
+
+def test_condense_deadline_still_propagates(puml, monkeypatch):
+    def condense(text, options=None, llm=None):
+        raise puml.DeadlineExceeded("需求浓缩")
+
+    monkeypatch.setattr(puml, "condense_requirements", condense)
+    with pytest.raises(puml.DeadlineExceeded):
+        puml._condense_node(_state(puml))
+
+
+@pytest.mark.parametrize("condense", [True, False])
+def test_condense_can_be_turned_off_from_the_entry_point(puml, fake_llm, tmp_path, monkeypatch, condense):
+    calls = []
+
+    def condense_requirements(text, options=None, llm=None):
+        calls.append(text)
+        return puml.DigestReport(raw_tokens=1, digest_text="摘要")
+
+    monkeypatch.setattr(puml, "condense_requirements", condense_requirements)
+    fake_llm()
+    usecase = tmp_path / "usecase.txt"
+    usecase.write_text("", encoding="utf-8")
+    report = puml.analyze_text_to_plantuml_report(str(usecase), "系统由管理员操作。" * 2000, condense=condense)
+    assert "@startuml" in report.plantuml_code
+    assert len(calls) == int(condense)
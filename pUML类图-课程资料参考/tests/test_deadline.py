@@ -0,0 +1,79 @@
+import time
+
+from conftest import EMPTY_DIAGRAM
+
+
+def _model(puml, names):
+    return puml.ClassDiagram(classes=[puml.ClassStructure(class_name=n, attributes=["-编号"], methods=[]) for n in names])
+
+
+def _slow_after(first, delay):
+    """前first次调用立即返回，之后每次调用等待delay秒"""
+    calls = []
+
+    def respond(prompt):
+        calls.append(prompt)
+        if len(calls) > first:
+            time.sleep(delay)
+        return EMPTY_DIAGRAM
+
+    return respond
+
+
+def test_stage_timeout_records_unfinished_classes(puml, fake_llm):
+    fake_llm(_slow_after(2, 0.5))
+    ctx = puml.RunContext(deadline=30)
+    ctx.stage_deadline = time.monotonic() + 0.3
+    token = puml._run_context.set(ctx)
+    try:
+        puml.analyze_associations.invoke({"text": "", "classmodel": _model(puml, ["甲", "乙", "丙", "丁"])})
+    finally:
+        puml._run_context.reset(token)
+    assert ctx.take_unfinished("analyze_association") == ["丙", "丁"]
+    assert ctx.take_unfinished("analyze_association") == []
+
+
+def test_worklist_retries_classes_skipped_by_a_stage_timeout(puml, fake_llm):
+    fake = fake_llm(_slow_after(1, 0.5))
+    model = _model(puml, ["甲", "乙", "丙"])
+    state = puml.AgentState(usecase_file_path="", input_text="需求", class_model=model)
+    node = puml._per_class_node("analyze_association", puml.analyze_associations)
+    ctx = puml.RunContext(deadline=30)
+    ctx.stage_deadline = time.monotonic() + 0.3
+    token = puml._run_context.set(ctx)
+    try:
+        state = node(state)
+    finally:
+        puml._run_context.reset(token)
+    assert state.analyzed["analyze_association"] == ["甲"]
+    # 等被放弃的在途调用结束，否则相同的调用会与它合并
+    time.sleep(0.6)
+    # 时间充足时工作表只补做未完成的类
+    fake.respond = lambda prompt: EMPTY_DIAGRAM
+    fake.prompts.clear()
+    analyzed = {stage: ["甲", "乙", "丙"] for stage, _ in puml.PER_CLASS_ANALYSES}
+    analyzed["analyze_association"] = state.analyzed["analyze_association"]
+    _, analyzed = puml.run_worklist("需求", model, analyzed, max_iterations=1)
+    assert sorted(analyzed["analyze_association"]) == ["丙", "乙", "甲"]
+    assert len(fake.prompts) == 2
+
+
+def test_worklist_node_uses_the_planned_stage_options(puml, fake_llm):
+    fake = fake_llm()
+    model = _model(puml, ["甲", "乙", "丙", "丁"])
+    # 已分析过的只有甲，其余三个类是中途新增的
+    analyzed = {stage: ["甲"] for stage, _ in puml.PER_CLASS_ANALYSES}
+    state = puml.AgentState(usecase_file_path="", input_text="需求", class_model=model, analyzed=analyzed,
+                            invent_children=False, feature_batch_size=3, worklist_iterations=1)
+    node = puml.build_workflow().nodes["worklist"].bound
+    result = node.invoke(state)
+    # 特征一次调用补做三个类；规划降级后不再推想子类
+    assert len([p for p in fake.prompts if "为选定类的添加特征" in p]) == 1
+    assert [p for p in fake.prompts if "可能子类与父类" in p] == []
+    assert sorted(result.analyzed["analyze_generalization"]) == ["丁", "丙", "乙", "甲"]
+
+    fake.prompts.clear()
+    state = state.model_copy(update={"invent_children": True, "feature_batch_size": 1})
+    node.invoke(state)
+    assert len([p for p in fake.prompts if "为选定类的添加特征" in p]) == 3
+    assert len([p for p in fake.prompts if "可能子类与父类" in p]) == 3
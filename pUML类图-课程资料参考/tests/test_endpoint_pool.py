@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StubEndpoint:
+    """本地OpenAI兼容桩服务：mode为ok/fail(500)/bad(400)，delay模拟慢端点"""
+
+    def __init__(self, reply="ok"):
+        self.mode = "ok"
+        self.delay = 0.0
+        self.reply = reply
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests += 1
+                time.sleep(stub.delay)
+                if stub.mode != "ok":
+                    status = 500 if stub.mode == "fail" else 400
+                    payload = json.dumps({"error": {"message": stub.mode, "type": "stub"}}).encode()
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                if body.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.end_headers()
+                    for piece in stub.reply:
+                        chunk = {"id": "c", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                                 "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    return
+                payload = json.dumps({
+                    "id": "c", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": stub.reply},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stubs():
+    created = []
+
+    def make(reply="ok"):
+        stub = StubEndpoint(reply)
+        created.append(stub)
+        return stub
+
+    yield make
+    for stub in created:
+        stub.close()
+
+
+def _pool(puml, *stubs, **options):
+    return puml.EndpointPool([puml.EndpointConfig(base_url=s.url, api_key="x") for s in stubs], **options)
+
+
+def _stats(pool, stub):
+    return next(s for s in pool.stats() if s["base_url"] == stub.url)
+
+
+def test_server_errors_eject_then_probe_readmits(puml, stubs):
+    healthy, broken = stubs("healthy"), stubs("broken")
+    broken.mode = "fail"
+    pool = _pool(puml, broken, healthy, eject_after=2, base_cooldown=0.3)
+    # 两端点都没有延迟样本时先试排在前面的故障端点；之后健康端点更慢也不会再路由到被摘除的端点
+    healthy.delay = 0.05
+
+    for _ in range(6):
+        assert pool.invoke("hi").content == "healthy"
+    assert broken.requests == 2
+    assert _stats(pool, broken)["ejected"]
+
+    # 冷却期内故障端点不再收到请求
+    pool.invoke("hi")
+    assert broken.requests == 2
+
+    broken.mode = "ok"
+    time.sleep(0.35)
+    healthy.delay = 0.2
+    replies = [pool.invoke("hi").content for _ in range(3)]
+    assert "broken" in replies
+    assert broken.requests >= 3
+    assert not _stats(pool, broken)["ejected"]
+
+
+def test_failed_probe_doubles_cooldown(puml, stubs):
+    healthy, broken = stubs("healthy"), stubs("broken")
+    broken.mode = "fail"
+    pool = _pool(puml, broken, healthy, eject_after=1, base_cooldown=0.2)
+    pool.invoke("hi")
+    assert _stats(pool, broken)["ejected"]
+
+    time.sleep(0.25)
+    pool.invoke("hi")
+    # 探测再次失败，冷却翻倍后仍处于摘除状态
+    assert broken.requests == 2
+    time.sleep(0.25)
+    pool.invoke("hi")
+    assert broken.requests == 2
+
+
+def test_client_errors_raise_without_failover_or_ejection(puml, stubs):
+    first, second = stubs("first"), stubs("second")
+    first.mode = second.mode = "bad"
+    pool = _pool(puml, first, second, eject_after=1)
+
+    import openai
+    for _ in range(3):
+        with pytest.raises(openai.BadRequestError):
+            pool.invoke("hi")
+    # 每次请求只发到一个端点，没有换端点重试，也没有端点被摘除
+    assert first.requests + second.requests == 3
+    assert not any(s["ejected"] for s in pool.stats())
+
+
+def test_runnable_streams_incrementally_and_fails_over(puml, stubs):
+    broken, healthy = stubs("unused"), stubs("hello world")
+    broken.mode = "fail"
+    pool = _pool(puml, broken, healthy)
+    runnable = pool.as_runnable()
+
+    chunks = [chunk.content for chunk in runnable.stream("hi")]
+    assert len(chunks) > 1
+    assert "".join(chunks) == "hello world"
+    assert runnable.invoke("hi").content == "hello world"
+
+
+def test_identical_calls_through_the_pool_are_coalesced(puml, stubs):
+    from langchain_core.prompts import PromptTemplate
+
+    stub = stubs("reply")
+    stub.delay = 0.3
+    pool = _pool(puml, stub)
+    prompt = PromptTemplate.from_template("分析{input}")
+    results = []
+
+    def call():
+        # create_llm每次调用都新建端点池的Runnable，合并不能依赖对象身份
+        results.append(puml.invoke_chain(prompt | pool.as_runnable(), {"input": "学生"}).content)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["reply"] * 3
+    assert stub.requests == 1
+
+    other_model = prompt | pool.as_runnable("gpt-4o")
+    assert puml._chain_key(prompt | pool.as_runnable(), {"input": "学生"}) != \
+        puml._chain_key(other_model, {"input": "学生"})
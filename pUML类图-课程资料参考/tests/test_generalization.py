@@ -0,0 +1,52 @@
+import random
+
+
+def _classes(puml, members):
+    return puml.ClassDiagram(classes=[puml.ClassStructure(class_name=name, attributes=attrs, methods=[])
+                                      for name, attrs in members.items()])
+
+
+def test_subset_members_give_inheritance(puml):
+    model = _classes(puml, {"用户": ["-姓名", "-电话", "-邮箱"], "教师": ["-姓名", "-电话", "-邮箱", "-工号"], "课程": ["-课程号"]})
+    candidates = puml.detect_generalization_candidates(model)
+    assert [(r.source_class, r.target_class) for r in candidates.inheritance_relationships] == [("教师", "用户")]
+    assert candidates.unresolved == ["课程"]
+
+
+def test_generic_shared_members_are_not_local_evidence(puml):
+    # 只共有“编号”“名称”的无关类、父类成员只占子类一小部分的类，都不在本地判定继承，交给LLM
+    model = _classes(puml, {"课程": ["-编号", "-名称"], "教室": ["-编号", "-名称", "-容量"],
+                            "设备": ["-型号", "-厂家", "-价格"],
+                            "实验室": ["-型号", "-厂家", "-价格"] + [f"-属性{k}" for k in range(5)]})
+    candidates = puml.detect_generalization_candidates(model)
+    assert candidates.inheritance_relationships == []
+    # 课程与教室成员高度重叠，作为公共父类候选簇仍由chain1确认
+    assert [sorted(c) for c in candidates.shared_parent_clusters] == [["教室", "课程"]]
+    assert sorted(candidates.unresolved) == ["实验室", "设备"]
+    relaxed = puml.detect_generalization_candidates(model, min_shared_members=2, min_coverage=0.0)
+    assert sorted((r.source_class, r.target_class) for r in relaxed.inheritance_relationships) == [
+        ("实验室", "设备"), ("教室", "课程")]
+
+
+def test_lsh_finds_same_clusters_as_pairwise(puml):
+    rng = random.Random(3)
+    members = {}
+    for i in range(300):
+        family = i // 6
+        members[f"类{i}"] = [f"-族{family}属性{k}" for k in range(6)] + [f"-类{i}属性{rng.randrange(2)}"]
+    model = _classes(puml, members)
+    pairwise = puml.detect_generalization_candidates(model, lsh_threshold=10 ** 6)
+    lsh = puml.detect_generalization_candidates(model, lsh_threshold=0)
+    assert sorted(map(sorted, lsh.shared_parent_clusters)) == sorted(map(sorted, pairwise.shared_parent_clusters))
+
+
+def test_locally_resolved_classes_still_invent_children(puml, fake_llm):
+    fake = fake_llm()
+    model = _classes(puml, {"用户": ["-姓名", "-电话", "-邮箱"], "教师": ["-姓名", "-电话", "-邮箱", "-工号"], "课程": ["-课程号"]})
+    puml.analyze_generalization2.invoke({"text": "", "classmodel": model})
+    invented = [p for p in fake.prompts if "可能子类与父类" in p]
+    assert len(invented) == 3
+    fake.prompts.clear()
+    puml.analyze_generalization2.invoke({"text": "", "classmodel": model, "invent_children": False})
+    assert [p for p in fake.prompts if "可能子类与父类" in p] == []
+    assert len(fake.prompts) == 1
@@ -0,0 +1,84 @@
+import random
+
+
+def _snapshot(index, names):
+    return {name: (sorted(index.ancestors(name)), sorted(index.descendants(name)),
+                   index.neighborhood(name, 2, include_inheritance=True)) for name in names}
+
+
+def _inherit(puml, child, parent):
+    return puml.InheritanceRelationship(source_class=child, target_class=parent)
+
+
+def test_closure_and_neighborhood_on_synthetic_families(puml, synthetic):
+    index = puml.ClassDiagramIndex(synthetic(24, family_size=8, cross_links=False))
+    # 每族是一棵二叉树：类0 <- 类1、类2，类1 <- 类3、类4，类3 <- 类7
+    assert index.is_subclass("类7", "类3")
+    assert index.is_subclass("类7", "类0")
+    assert not index.is_subclass("类0", "类7")
+    assert not index.is_subclass("类7", "类8")
+    assert not index.is_subclass("类7", "不存在")
+    assert sorted(index.ancestors("类7")) == ["类0", "类1", "类3"]
+    assert sorted(index.descendants("类1")) == ["类3", "类4", "类7"]
+
+    reached = index.neighborhood("类0", 2, kinds=(), include_inheritance=True)
+    assert reached == {"类0": 0, "类1": 1, "类2": 1, "类3": 2, "类4": 2, "类5": 2, "类6": 2}
+    assert index.neighborhood("不存在", 3) == {}
+    # 没有族间关联时邻域不会越过族的边界
+    assert all(int(n[1:]) < 8 for n in index.neighborhood("类0", 5, include_inheritance=True))
+
+
+def test_incremental_edits_match_a_rebuild(puml, synthetic):
+    rng = random.Random(3)
+    model = synthetic(40, family_size=8)
+    index = puml.ClassDiagramIndex(model)
+    next_id = 40
+    for _ in range(200):
+        names = list(index.classes)
+        op = rng.random()
+        if op < 0.35:
+            child, parent = rng.sample(names, 2)
+            if not index.is_subclass(parent, child):
+                index.add_inheritance(_inherit(puml, child, parent))
+        elif op < 0.6 and model.inheritance_relationships:
+            index.remove_inheritance(rng.choice(model.inheritance_relationships))
+        elif op < 0.75:
+            name = f"类{next_id}"
+            next_id += 1
+            index.add_class(puml.ClassStructure(class_name=name, attributes=[], methods=[]))
+            index.add_inheritance(_inherit(puml, name, rng.choice(names)))
+        elif op < 0.85:
+            index.remove_class(rng.choice(names))
+        elif op < 0.95:
+            source, target = rng.sample(names, 2)
+            index.add_relation("association", puml.AssociationRelationship(
+                assicaiation_name="新关联", source_class=source, target_class=target, relation_type="关联",
+                souce_multiplicity="1", target_multiplicity="1", source_role="", target_role="",
+                source_navigation="False", target_navigation="True"))
+        elif model.association_relationships:
+            index.remove_relation("association", rng.choice(model.association_relationships))
+
+    rebuilt = puml.ClassDiagramIndex(model)
+    names = list(rebuilt.classes)
+    assert sorted(index.classes) == sorted(names)
+    assert _snapshot(index, names) == _snapshot(rebuilt, names)
+    for child in names:
+        for parent in names:
+            assert index.is_subclass(child, parent) == rebuilt.is_subclass(child, parent)
+
+
+def test_removing_one_of_two_paths_keeps_the_ancestor(puml):
+    model = puml.ClassDiagram(classes=[puml.ClassStructure(class_name=n, attributes=[], methods=[])
+                                       for n in ("甲", "乙", "丙", "丁")])
+    index = puml.ClassDiagramIndex(model)
+    index.add_inheritance(_inherit(puml, "乙", "甲"))
+    index.add_inheritance(_inherit(puml, "丙", "甲"))
+    index.add_inheritance(_inherit(puml, "丁", "乙"))
+    index.add_inheritance(_inherit(puml, "丁", "丙"))
+    index.remove_inheritance(_inherit(puml, "丁", "乙"))
+    assert index.is_subclass("丁", "甲")
+    assert not index.is_subclass("丁", "乙")
+    assert sorted(index.descendants("甲")) == ["丁", "丙", "乙"]
+    index.remove_inheritance(_inherit(puml, "丙", "甲"))
+    assert not index.is_subclass("丁", "甲")
+    assert index.descendants("甲") == ["乙"]
@@ -0,0 +1,81 @@
+import pytest
+
+
+def _associate(puml, source, target):
+    return puml.AssociationRelationship(
+        assicaiation_name=f"{source}_{target}", source_class=source, target_class=target, relation_type="关联",
+        souce_multiplicity="1", target_multiplicity="0..*", source_role="", target_role="",
+        source_navigation="False", target_navigation="True")
+
+
+@pytest.fixture
+def chain(puml):
+    """祖 <|-- 甲 <|-- 乙 —— 丙 —— 丁，戊与其他类无关"""
+    return puml.ClassDiagram(
+        classes=[puml.ClassStructure(class_name=n, attributes=[f"-{n}属性"], methods=[])
+                 for n in ("祖", "甲", "乙", "丙", "丁", "戊")],
+        inheritance_relationships=[puml.InheritanceRelationship(source_class="甲", target_class="祖"),
+                                   puml.InheritanceRelationship(source_class="乙", target_class="甲")],
+        association_relationships=[_associate(puml, "乙", "丙"), _associate(puml, "丙", "丁")])
+
+
+def _names(model):
+    return {cls.class_name for cls in model.classes}
+
+
+def test_subdiagram_follows_hops_and_adds_ancestors(puml, chain):
+    assert _names(puml.extract_subdiagram(chain, ["丙"], hops=1, include_ancestors=False)) == {"乙", "丙", "丁"}
+    # 乙的祖先甲、祖一并带上，使继承的成员有处可查
+    sub = puml.extract_subdiagram(chain, ["丙"], hops=1)
+    assert _names(sub) == {"祖", "甲", "乙", "丙", "丁"}
+    assert len(sub.inheritance_relationships) == 2
+    assert len(sub.association_relationships) == 2
+    assert _names(puml.extract_subdiagram(chain, ["丁"], hops=2, include_ancestors=False)) == {"乙", "丙", "丁"}
+
+
+def test_extracted_classes_keep_only_internal_relations_and_are_copies(puml, chain):
+    sub = puml.extract_classes(chain, ["乙", "丙", "不存在"])
+    assert _names(sub) == {"乙", "丙"}
+    assert [(r.source_class, r.target_class) for r in sub.association_relationships] == [("乙", "丙")]
+    assert sub.inheritance_relationships == []
+    sub.classes[0].attributes.append("-新属性")
+    assert chain.classes[2].attributes == ["-乙属性"]
+
+
+def test_pages_are_bounded_and_cover_every_class_once(puml, synthetic):
+    model = synthetic(100, family_size=8, cross_links=False)
+    pages = puml.partition_classdiagram(model, max_classes=20)
+    assert all(0 < len(page) <= 20 for page in pages)
+    names = [name for page in pages for name in page]
+    assert sorted(names) == sorted(cls.class_name for cls in model.classes)
+    # 小分量整体装入同一页，不被拆开
+    page_of = {name: i for i, page in enumerate(pages) for name in page}
+    assert all(len({page_of[f"类{f * 8 + k}"] for k in range(8)}) == 1 for f in range(12))
+
+    large = synthetic(50, family_size=50, cross_links=False)
+    assert [len(page) for page in puml.partition_classdiagram(large, max_classes=20)] == [20, 20, 10]
+
+
+def test_cross_page_relations_are_noted_on_both_pages(puml, chain, tmp_path):
+    paths = puml.render_paged_plantuml(chain, str(tmp_path), partition={"甲页": ["甲", "乙"], "丙页": ["丙", "丁"]},
+                                       max_workers=1)
+    assert [p.rsplit("/", 1)[-1] for p in paths] == ["甲页.puml", "丙页.puml"]
+    first, second = ((tmp_path / name).read_text(encoding="utf-8") for name in ("甲页.puml", "丙页.puml"))
+    for page, other in ((first, "丙见丙页.puml"), (second, "乙见甲页.puml")):
+        notes = page.split("' 跨页引用：", 1)[1]
+        assert f"' 乙 -> 丙（关联，{other}）" in notes
+    # 祖不在任何页面中，甲页注明该继承关系的去向
+    assert "' 甲 -> 祖（继承，祖不在任何页面中）" in first
+    assert "class 丁" in second and "class 甲" not in second
+    assert (tmp_path / "index.txt").read_text(encoding="utf-8").splitlines() == [
+        "甲页.puml\t2个类\t甲、乙", "丙页.puml\t2个类\t丙、丁"]
+
+
+def test_automatic_partition_writes_an_index(puml, synthetic, tmp_path):
+    model = synthetic(40, family_size=8, cross_links=False)
+    paths = puml.render_paged_plantuml(model, str(tmp_path), max_classes=16, max_workers=2)
+    lines = (tmp_path / "index.txt").read_text(encoding="utf-8").splitlines()
+    assert len(lines) == len(paths) == 3
+    assert [line.split("\t")[0] for line in lines] == ["page_001.puml", "page_002.puml", "page_003.puml"]
+    assert sum(int(line.split("\t")[1].rstrip("个类")) for line in lines) == 40
+    assert all("@enduml" in open(path, encoding="utf-8").read() for path in paths)
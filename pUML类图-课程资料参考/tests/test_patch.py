@@ -0,0 +1,99 @@
+import random
+
+import pytest
+
+
+def _associate(puml, source, target, name, role=""):
+    return puml.AssociationRelationship(
+        assicaiation_name=name, source_class=source, target_class=target, relation_type="关联",
+        souce_multiplicity="1", target_multiplicity="0..*", source_role=role, target_role="",
+        source_navigation="False", target_navigation="True")
+
+
+def _mutate(puml, model, rng):
+    """对类图副本做一组随机编辑：增删类和成员、打乱成员顺序、增删改关系（含规范键相同的重复关系）"""
+    new = model.model_copy(deep=True)
+    names = [cls.class_name for cls in new.classes]
+    for _ in range(rng.randrange(1, 12)):
+        op = rng.randrange(8)
+        if op == 0:
+            new.classes.append(puml.ClassStructure(class_name=f"新类{rng.randrange(10 ** 6)}",
+                                                   attributes=["-编号"], methods=[]))
+        elif op == 1 and len(new.classes) > 1:
+            new.classes.pop(rng.randrange(len(new.classes)))
+        elif op == 2:
+            cls = rng.choice(new.classes)
+            cls.attributes.append(f"-属性{rng.randrange(100)}")
+        elif op == 3:
+            cls = rng.choice(new.classes)
+            if cls.methods:
+                cls.methods.pop(rng.randrange(len(cls.methods)))
+            rng.shuffle(cls.attributes)
+        elif op == 4:
+            source, target = rng.sample(names, 2)
+            rel = _associate(puml, source, target, "重复关联")
+            # 同一规范键的关系出现多次
+            new.association_relationships.extend([rel, rel.model_copy(update={"source_role": "另一角色"})])
+        elif op == 5 and new.association_relationships:
+            new.association_relationships.pop(rng.randrange(len(new.association_relationships)))
+        elif op == 6 and new.association_relationships:
+            i = rng.randrange(len(new.association_relationships))
+            new.association_relationships[i] = new.association_relationships[i].model_copy(
+                update={"target_multiplicity": str(rng.randrange(5))})
+        elif op == 7:
+            source, target = rng.sample(names, 2)
+            new.inheritance_relationships.append(puml.InheritanceRelationship(source_class=source, target_class=target))
+    return new
+
+
+def test_random_patches_round_trip(puml, synthetic):
+    rng = random.Random(5)
+    old = synthetic(30)
+    old.association_relationships.append(_associate(puml, "类0", "类1", "重复关联"))
+    old.association_relationships.append(_associate(puml, "类0", "类1", "重复关联", "第二条"))
+    snapshot = old.model_dump()
+    for _ in range(200):
+        new = _mutate(puml, old, rng)
+        patch = puml.diff_classdiagrams(old, new)
+        restored = puml.ClassDiagramPatch.model_validate_json(patch.model_dump_json())
+        assert restored == patch
+        applied = puml.apply_patch(old, restored)
+        assert puml.diff_classdiagrams(applied, new).is_empty()
+        assert old.model_dump() == snapshot
+    assert puml.diff_classdiagrams(old, old.model_copy(deep=True)).is_empty()
+
+
+def test_duplicate_key_relations_are_matched_by_occurrence(puml):
+    classes = [puml.ClassStructure(class_name=n, attributes=[], methods=[]) for n in ("甲", "乙")]
+    first, second = _associate(puml, "甲", "乙", "管理"), _associate(puml, "甲", "乙", "管理", "第二条")
+    old = puml.ClassDiagram(classes=classes, association_relationships=[first, second])
+    new = puml.ClassDiagram(classes=classes, association_relationships=[first, second.model_copy(update={"source_role": "改"})])
+    patch = puml.diff_classdiagrams(old, new)
+    assert [(c.occurrence, c.values) for c in patch.changed_relations] == [(1, {"source_role": "改"})]
+    assert [r.source_role for r in puml.apply_patch(old, patch).association_relationships] == ["", "改"]
+
+    removed = puml.diff_classdiagrams(old, puml.ClassDiagram(classes=classes, association_relationships=[first]))
+    assert [c.occurrence for c in removed.removed_relations] == [1]
+
+
+def test_reordered_members_are_not_a_change(puml):
+    old = puml.ClassDiagram(classes=[puml.ClassStructure(class_name="甲", attributes=["-a", "-b"], methods=[])])
+    new = puml.ClassDiagram(classes=[puml.ClassStructure(class_name="甲", attributes=["-b", "-a"], methods=[])])
+    assert puml.diff_classdiagrams(old, new).is_empty()
+
+
+@pytest.mark.parametrize("patch", [
+    {"removed_classes": ["不存在"]},
+    {"changed_classes": [{"class_name": "不存在", "added_attributes": ["-a"]}]},
+    {"added_classes": [{"class_name": "甲", "attributes": [], "methods": []}]},
+    {"removed_relations": [{"kind": "inheritance_relationships", "key": ["甲", "乙"]}]},
+    {"changed_relations": [{"kind": "inheritance_relationships", "key": ["乙", "甲"], "occurrence": 1,
+                            "values": {"relation_type": "继承"}}]},
+    {"added_relations": [{"kind": "inheritance_relationships", "key": ["乙", "甲"],
+                          "values": {"source_class": "乙", "target_class": "甲", "relation_type": "继承"}}]},
+])
+def test_patches_that_do_not_fit_raise(puml, patch):
+    model = puml.ClassDiagram(classes=[puml.ClassStructure(class_name=n, attributes=[], methods=[]) for n in ("甲", "乙")],
+                              inheritance_relationships=[puml.InheritanceRelationship(source_class="乙", target_class="甲")])
+    with pytest.raises(ValueError, match="补丁与类图不匹配"):
+        puml.apply_patch(model, puml.ClassDiagramPatch.model_validate(patch))
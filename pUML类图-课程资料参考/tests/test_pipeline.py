@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+
+import pytest
+
+from conftest import EMPTY_DIAGRAM, FakeStreamingLLM
+
+
+def _diagram(classes):
+    return json.dumps({"classes": classes, "inheritance_relationships": [], "association_relationships": [],
+                       "aggregation_relationships": [], "composition_relationships": [],
+                       "dependency_relationships": []}, ensure_ascii=False)
+
+
+def _responder(n, fail_features_for=()):
+    names = [f"类{i}" for i in range(n)]
+
+    def respond(prompt):
+        if "请从以下需求文本中提取类" in prompt:
+            return _diagram([{"class_name": name, "attributes": [], "methods": []} for name in names])
+        if "为选定类的添加特征" in prompt:
+            selected = prompt.rsplit("待分析的类:", 1)[-1].strip().split("，")
+            if fail_features_for == "all" or set(selected) & set(fail_features_for):
+                raise RuntimeError("模型返回了无法解析的内容")
+            return _diagram([{"class_name": name, "attributes": [f"-{name}编号"], "methods": []} for name in selected])
+        return EMPTY_DIAGRAM
+
+    return respond
+
+
+def _run(puml, llm, **kwargs):
+    box = {}
+    thread = threading.Thread(target=lambda: box.setdefault(
+        "result", puml.analyze_classes_pipelined("需求", puml.ClassDiagram(), llm=llm, **kwargs)), daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), "流水线没有结束"
+    return box["result"]
+
+
+@pytest.mark.parametrize("n", [10, 40])
+def test_pipeline_finishes_with_more_classes_than_queue_capacity(puml, n):
+    fake = FakeStreamingLLM(_responder(n))
+    result, names, failed = _run(puml, fake.runnable(), workers=2, queue_size=2)
+    assert names == [f"类{i}" for i in range(n)]
+    assert sorted(c.class_name for c in result.classes) == sorted(names)
+    assert failed == {}
+
+
+def test_pipeline_reports_failed_items_and_keeps_going(puml):
+    fake = FakeStreamingLLM(_responder(12, fail_features_for=["类3"]))
+    result, names, failed = _run(puml, fake.runnable(), workers=2, queue_size=2)
+    assert len(names) == 12
+    assert failed["analyze_features"] == ["类3"]
+    assert failed["analyze_association"] == ["类3"]
+    # 出错的类仍保留在类图中
+    assert "类3" in {c.class_name for c in result.classes}
+
+
+def test_pipeline_raises_when_every_class_fails(puml):
+    fake = FakeStreamingLLM(_responder(3, fail_features_for="all"))
+    with pytest.raises(RuntimeError):
+        puml.analyze_classes_pipelined("需求", puml.ClassDiagram(), llm=fake.runnable(), workers=2)
+
+
+def test_pipeline_batches_feature_calls(puml):
+    respond = _responder(12)
+
+    def slow_features(prompt):
+        # 特征分析较慢时，后面识别出的类在队列中排队，凑成批次
+        if "为选定类的添加特征" in prompt:
+            time.sleep(0.05)
+        return respond(prompt)
+
+    fake = FakeStreamingLLM(slow_features)
+    result, names, failed = _run(puml, fake.runnable(), workers=1, queue_size=16, batch_size=4)
+    feature_calls = [p for p in fake.prompts if "为选定类的添加特征" in p]
+    assert len(feature_calls) < 12
+    assert all(c.attributes == [f"-{c.class_name}编号"] for c in result.classes)
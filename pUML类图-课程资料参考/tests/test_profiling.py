@@ -0,0 +1,57 @@
+import threading
+import tracemalloc
+
+import pytest
+
+PUML = "@startuml\nclass 学生 {\n -学号\n}\n@enduml\n"
+
+
+@pytest.fixture
+def profiling(puml, tmp_path):
+    puml.configure_profiling(str(tmp_path))
+    yield tmp_path
+    puml.configure_profiling(None)
+
+
+def test_memory_tracing_is_started_and_stopped_per_stage(puml, profiling):
+    assert not tracemalloc.is_tracing()
+    puml.parse_plantuml_text(PUML, verbose=False)
+    assert not tracemalloc.is_tracing()
+    assert len(list(profiling.glob("*_parse_plantuml_text.mem.txt"))) == 1
+
+
+def test_tracing_started_by_the_caller_is_left_running(puml, profiling):
+    tracemalloc.start()
+    try:
+        puml.parse_plantuml_text(PUML, verbose=False)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_concurrent_stages_share_one_tracing_session(puml, profiling):
+    both_started = threading.Barrier(2)
+    first_done = threading.Event()
+    still_tracing = []
+
+    @puml.profile_stage("并发阶段")
+    def stage(first):
+        both_started.wait(timeout=5)
+        if not first:
+            # 先结束的阶段不能关掉仍在执行的阶段所用的跟踪
+            first_done.wait(timeout=5)
+            still_tracing.append(tracemalloc.is_tracing())
+
+    def run(first):
+        stage(first)
+        if first:
+            first_done.set()
+
+    threads = [threading.Thread(target=run, args=(first,)) for first in (True, False)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert still_tracing == [True]
+    assert not tracemalloc.is_tracing()
+    assert len(list(profiling.glob("*.mem.txt"))) == 2
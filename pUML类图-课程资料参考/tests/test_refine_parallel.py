@@ -0,0 +1,28 @@
+def _with_duplicated_associations(model):
+    # 子类重复一条父类的关联关系，让优化有关联可删
+    for rel in list(model.inheritance_relationships):
+        for asso in model.association_relationships:
+            if asso.source_class == rel.target_class:
+                model.association_relationships.append(asso.model_copy(update={"source_class": rel.source_class}))
+                break
+    return model
+
+
+def test_parallel_refine_matches_single_process(puml, synthetic):
+    model = _with_duplicated_associations(synthetic(200, cross_links=False))
+    expected = puml._refine_classdiagram(model.model_copy(deep=True), verbose=False)
+    for workers in (1, 2):
+        assert puml.refine_features_parallel(model, max_workers=workers) == expected
+
+
+def test_refine_node_uses_process_pool_when_configured(puml, synthetic, monkeypatch):
+    model = _with_duplicated_associations(synthetic(40, cross_links=False))
+    calls = []
+    original = puml.refine_features_parallel
+    monkeypatch.setattr(puml, "refine_features_parallel", lambda m, n: calls.append(n) or original(m, n))
+    graph = puml.build_workflow()
+    node = graph.nodes["refine"].bound
+    state = puml.AgentState(usecase_file_path="", input_text="", class_model=model, refine_workers=2)
+    result = node.invoke(state)
+    assert calls == [2]
+    assert result.class_model == puml._refine_classdiagram(model.model_copy(deep=True), verbose=False)
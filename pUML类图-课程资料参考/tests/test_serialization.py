@@ -0,0 +1,21 @@
+import pytest
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".jsonl.zst"])
+def test_reader_lists_classes_and_counts_written_records(puml, synthetic, tmp_path, suffix):
+    if suffix.endswith(".zst") and puml.zstandard is None:
+        pytest.skip("需要zstandard")
+    model = synthetic(50)
+    model.classes.insert(3, None)
+    model.association_relationships.append(None)
+    path = str(tmp_path / ("model" + suffix))
+    puml.save_classdiagram(model, path)
+    with puml.ClassDiagramReader(path) as reader:
+        names = [cls.class_name for cls in model.classes if cls is not None]
+        assert reader.class_names() == names
+        assert reader.counts["classes"] == 50
+        assert reader.counts["association_relationships"] == len(model.association_relationships) - 1
+        assert reader.get_class("类7") == next(c for c in model.classes if c is not None and c.class_name == "类7")
+        assert reader.get_class("不存在") is None
+    loaded = puml.load_classdiagram(path)
+    assert loaded.classes == [cls for cls in model.classes if cls is not None]
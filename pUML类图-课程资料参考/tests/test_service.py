@@ -0,0 +1,188 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _request(service, raw: bytes):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        writer = FakeWriter()
+        await service._serve_connection(reader, writer)
+        return writer.data
+
+    head, _, body = asyncio.run(run()).partition(b"\r\n\r\n")
+    return int(head.split()[1]), body.decode("utf-8")
+
+
+@pytest.fixture
+def service(puml):
+    service = puml.PumlService(workers=1, queue_size=4, max_body_bytes=1024)
+    service._queue = asyncio.Queue(maxsize=4)
+    yield service
+    service._executor.shutdown(wait=False)
+    service._render_executor.shutdown(wait=False)
+
+
+def test_oversized_body_is_rejected_before_reading(service):
+    # 只声明长度而不发送请求体：若服务先读取请求体，会因读不满而直接断开
+    status, body = _request(service, b"POST /jobs HTTP/1.1\r\nContent-Length: 4096\r\n\r\n")
+    assert status == 413
+    status, _ = _request(service, b"POST /jobs HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+    assert status == 400
+
+
+def test_job_request_rejects_server_paths(service):
+    payload = json.dumps({"text": "t", "usecase_path": "/etc/passwd"}).encode()
+    status, body = _request(service, b"POST /jobs HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(payload), payload))
+    assert status == 400
+    assert "usecase_path" in body
+    assert service._queue.qsize() == 0
+
+    payload = json.dumps({"text": "t", "usecase": "学生"}).encode()
+    status, body = _request(service, b"POST /jobs HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(payload), payload))
+    assert status == 202
+    assert service._queue.qsize() == 1
+
+
+def _post(service, path, payload: bytes):
+    return _request(service, b"POST %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (path, len(payload), payload))
+
+
+def test_render_rejects_bodies_over_its_own_cap(puml):
+    service = puml.PumlService(workers=1, max_body_bytes=1024 * 1024, max_render_bytes=1024)
+    try:
+        status, _ = _post(service, b"/render", b"class A {\n}\n" + b" " * 2048)
+        assert status == 413
+        status, body = _post(service, b"/render", "@startuml\nclass 学生 {\n -学号\n}\n@enduml\n".encode())
+        assert status == 200
+        assert "学生" in body
+    finally:
+        service._executor.shutdown(wait=False)
+        service._render_executor.shutdown(wait=False)
+
+
+def test_parser_stays_linear_on_unterminated_input(puml):
+    adversarial = [
+        "class A {" + " " * 200000,
+        "class A {" * 20000,
+        "a" * 200000,
+        'A "1" --> "' * 20000,
+    ]
+    for content in adversarial:
+        started = time.perf_counter()
+        puml.parse_plantuml_text(content, verbose=False)
+        assert time.perf_counter() - started < 1.0
+
+
+def test_parser_results_are_unchanged_on_normal_input(puml):
+    model = puml.parse_plantuml_text(
+        "@startuml\nclass 用户 {\n -姓名\n +登录()\n}\nclass 教师 {\n -工号\n}\nclass 课程 {\n}\n"
+        "用户 <|-- 教师\n教师 \"1 讲授者\" --> \"0..* 课程\" 课程 : 讲授\n@enduml\n", verbose=False)
+    assert [(c.class_name, c.attributes, c.methods) for c in model.classes] == [
+        ("用户", ["-姓名"], ["+登录()"]), ("教师", ["-工号"], []), ("课程", [], [])]
+    assert [(r.source_class, r.target_class) for r in model.inheritance_relationships] == [("教师", "用户")]
+    [association] = model.association_relationships
+    assert (association.source_class, association.target_class, association.assicaiation_name) == ("教师", "课程", "讲授")
+    assert (association.souce_multiplicity, association.target_role) == ("1", "课程")
+
+
+def test_identical_pending_jobs_are_coalesced(service):
+    payload = json.dumps({"text": "学生选课", "usecase": "选课"}).encode()
+    replies = [json.loads(_post(service, b"/jobs", payload)[1]) for _ in range(3)]
+    assert [r["coalesced"] for r in replies] == [False, True, True]
+    assert len({r["job_id"] for r in replies}) == 1
+    assert service.jobs[replies[0]["job_id"]].submitters == 3
+    assert service._queue.qsize() == 1
+
+    other = json.loads(_post(service, b"/jobs", json.dumps({"text": "图书借阅"}).encode())[1])
+    assert other["coalesced"] is False and other["job_id"] != replies[0]["job_id"]
+    # 任务结束后相同的请求重新排队，不再合并到已结束的任务
+    service._active.pop(service.jobs[replies[0]["job_id"]].key)
+    again = json.loads(_post(service, b"/jobs", payload)[1])
+    assert again["coalesced"] is False and again["job_id"] != replies[0]["job_id"]
+
+
+def test_identical_chain_calls_share_one_llm_call(puml):
+    import threading
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+    from langchain_core.runnables import RunnableLambda
+
+    release = threading.Event()
+    calls = []
+
+    def blocking_llm(prompt):
+        calls.append(prompt.to_string())
+        release.wait(timeout=5)
+        return '{"classes": [{"class_name": "学生", "attributes": ["-学号"], "methods": []}]}'
+
+    def chain():
+        # 每个调用方各自新建链，合并按链的内容而不是对象身份
+        return (PromptTemplate.from_template("分析{input}") | RunnableLambda(blocking_llm)
+                | PydanticOutputParser(pydantic_object=puml.ClassDiagram))
+
+    results = []
+    coalesced = puml.single_flight_stats["coalesced"]
+    threads = [threading.Thread(target=lambda: results.append(puml.invoke_chain(chain(), {"input": "需求"})))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while puml.single_flight_stats["coalesced"] - coalesced < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [r.classes[0].class_name for r in results] == ["学生"] * 4
+    # 调用方会就地修改结果，各自拿到的是独立的副本
+    assert len({id(r) for r in results}) == 4
+
+    puml.invoke_chain(chain(), {"input": "另一个需求"})
+    assert len(calls) == 2
+
+
+def _get(service, path: bytes):
+    return _request(service, b"GET %s HTTP/1.1\r\n\r\n" % path)
+
+
+def test_job_status_and_result_endpoints(puml, service):
+    job, _ = service.submit(puml.JobRequest(text="学生选课"))
+    path = b"/jobs/" + job.job_id.encode()
+    status, body = _get(service, path)
+    assert status == 200 and json.loads(body)["status"] == "queued"
+    assert _get(service, path + b"/result")[0] == 202
+
+    job.status, job.error = "failed", "RuntimeError: 模型不可用"
+    status, body = _get(service, path + b"/result")
+    assert status == 500 and "模型不可用" in body
+
+    job.status, job.error = "done", ""
+    job.report = puml.PipelineReport(plantuml_code="@startuml\nclass 学生\n@enduml\n")
+    status, body = _get(service, path)
+    assert status == 200 and "report" not in json.loads(body)
+    status, body = _get(service, path + b"/result")
+    assert status == 200 and json.loads(body)["plantuml_code"].startswith("@startuml")
+    status, body = _get(service, path + b"/result?format=puml")
+    assert (status, body) == (200, "@startuml\nclass 学生\n@enduml\n")
+
+    assert _get(service, b"/jobs/unknown")[0] == 404
+    assert _get(service, path + b"/other")[0] == 404
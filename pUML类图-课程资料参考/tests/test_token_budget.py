@@ -0,0 +1,60 @@
+def _stage(plan, name):
+    return next(s for s in plan.stages if s.stage == name)
+
+
+def test_plan_counts_locally_resolved_generalization(puml, synthetic):
+    model = synthetic(40)
+    names = [cls.class_name for cls in model.classes]
+    budget = puml.TokenBudget(per_call_tokens=10 ** 6, per_run_tokens=10 ** 9)
+    blind = puml.plan_token_budget("需求", names, budget)
+    informed = puml.plan_token_budget("需求", names, budget, classmodel=model)
+    candidates = puml.detect_generalization_candidates(model)
+    chain1 = len(candidates.unresolved) + len(candidates.shared_parent_clusters)
+    assert _stage(blind, "analyze_generalization").calls == 2 * len(names)
+    assert _stage(informed, "analyze_generalization").calls == chain1 + len(names)
+    assert informed.total_tokens < blind.total_tokens
+
+
+def test_plan_follows_cluster_options(puml):
+    names = [f"类{i}" for i in range(100)]
+    budget = puml.TokenBudget(per_call_tokens=10 ** 6, per_run_tokens=10 ** 9)
+    clustered = puml.plan_token_budget("需求", names, budget, cluster_options=puml.ClusterOptions(min_classes=50))
+    flat = puml.plan_token_budget("需求", names, budget, cluster_options=puml.ClusterOptions(min_classes=500))
+    assert any(s.stage == "cross_cluster" for s in clustered.stages)
+    assert not any(s.stage == "cross_cluster" for s in flat.stages)
+    assert (_stage(clustered, "analyze_association").prompt_tokens
+            < _stage(flat, "analyze_association").prompt_tokens)
+
+
+def test_missing_tokenizer_cache_never_downloads(puml, monkeypatch, tmp_path):
+    import types
+    requested = []
+
+    def get_encoding(name):
+        # 缓存中没有词表时，真实的get_encoding会联网下载
+        requested.append(name)
+        raise OSError("network unavailable")
+
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(puml, "tiktoken", types.SimpleNamespace(get_encoding=get_encoding))
+    monkeypatch.setattr(puml, "_token_encoder", None)
+    assert puml.count_tokens("学生选课abcd") == 5
+    assert requested == []
+
+
+def test_cached_tokenizer_is_loaded_after_checking_its_hash(puml, monkeypatch, tmp_path):
+    import hashlib
+    import types
+    data = b"cached vocabulary"
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(puml, "_CL100K_SHA256", hashlib.sha256(data).hexdigest())
+    path = tmp_path / hashlib.sha1(puml._CL100K_URL.encode()).hexdigest()
+    path.write_bytes(b"corrupted")
+    assert puml._cached_tiktoken_file() is None
+    path.write_bytes(data)
+    assert puml._cached_tiktoken_file() == str(path)
+
+    encoder = types.SimpleNamespace(encode=lambda text, disallowed_special: text.split())
+    monkeypatch.setattr(puml, "tiktoken", types.SimpleNamespace(get_encoding=lambda name: encoder))
+    monkeypatch.setattr(puml, "_token_encoder", None)
+    assert puml.count_tokens("a b c") == 3
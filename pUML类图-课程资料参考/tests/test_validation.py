@@ -0,0 +1,116 @@
+def _cls(puml, name, attributes=("-编号",)):
+    return puml.ClassStructure(class_name=name, attributes=list(attributes), methods=[])
+
+
+def _inherit(puml, child, parent):
+    return puml.InheritanceRelationship(source_class=child, target_class=parent)
+
+
+def _associate(puml, source, target, source_navigation="False", target_navigation="True"):
+    return puml.AssociationRelationship(
+        assicaiation_name=f"{source}_{target}", source_class=source, target_class=target, relation_type="关联",
+        souce_multiplicity="1", target_multiplicity="0..*", source_role="", target_role="",
+        source_navigation=source_navigation, target_navigation=target_navigation)
+
+
+def _codes(result):
+    return [d.code for d in result.diagnostics]
+
+
+def test_none_entries_are_removed(puml):
+    model = puml.ClassDiagram.model_construct(
+        classes=[_cls(puml, "甲"), None, None], association_relationships=[None],
+        inheritance_relationships=[], aggregation_relationships=[], composition_relationships=[],
+        dependency_relationships=[])
+    result = puml.validate_classdiagram(model)
+    assert [c.class_name for c in result.class_model.classes] == ["甲"]
+    assert result.class_model.association_relationships == []
+    assert "none_class" in _codes(result)
+    # 原类图不被修改
+    assert model.classes[1] is None
+
+
+def test_lost_class_is_restored_from_the_previous_stage(puml):
+    previous = puml.ClassDiagram(classes=[_cls(puml, "甲"), _cls(puml, "乙", ["-名称"])])
+    result = puml.validate_classdiagram(puml.ClassDiagram(classes=[_cls(puml, "甲")]), previous=previous)
+    assert [c.class_name for c in result.class_model.classes] == ["甲", "乙"]
+    assert result.class_model.classes[1].attributes == ["-名称"]
+    assert result.requery == ["乙"]
+    assert _codes(result) == ["lost_class"]
+
+
+def test_dangling_endpoints_and_duplicate_edges_are_dropped(puml):
+    model = puml.ClassDiagram(
+        classes=[_cls(puml, "甲"), _cls(puml, "乙")],
+        association_relationships=[_associate(puml, "甲", "乙"), _associate(puml, "甲", "乙"),
+                                   _associate(puml, "甲", "丙")],
+        inheritance_relationships=[_inherit(puml, "乙", "丁")])
+    result = puml.validate_classdiagram(model)
+    assert [(r.source_class, r.target_class) for r in result.class_model.association_relationships] == [("甲", "乙")]
+    assert result.class_model.inheritance_relationships == []
+    dangling = [d for d in result.diagnostics if d.code == "dangling_endpoint"]
+    assert sorted(c for d in dangling for c in d.classes) == ["丁", "丙"]
+    assert _codes(result).count("duplicate_edge") == 1
+
+
+def test_inheritance_cycles_are_broken_by_removing_back_edges(puml):
+    model = puml.ClassDiagram(
+        classes=[_cls(puml, n) for n in ("甲", "乙", "丙", "丁")],
+        inheritance_relationships=[_inherit(puml, "乙", "甲"), _inherit(puml, "丙", "乙"), _inherit(puml, "甲", "丙"),
+                                   _inherit(puml, "丁", "丁"), _inherit(puml, "丁", "甲")])
+    result = puml.validate_classdiagram(model)
+    kept = result.class_model.inheritance_relationships
+    # 自环直接去掉，三元环只去掉一条回边，其余继承保留
+    assert len(kept) == 3
+    assert ("丁", "甲") in [(r.source_class, r.target_class) for r in kept]
+    index = puml.ClassDiagramIndex(result.class_model)
+    assert not any(index.is_subclass(n, n) for n in ("甲", "乙", "丙", "丁"))
+    assert _codes(result).count("inheritance_cycle") == 2
+
+
+def test_navigation_values_are_normalized(puml):
+    model = puml.ClassDiagram(
+        classes=[_cls(puml, "甲"), _cls(puml, "乙")],
+        association_relationships=[_associate(puml, "甲", "乙", "是", "yes"), _associate(puml, "乙", "甲", "?", "False")])
+    result = puml.validate_classdiagram(model)
+    navigation = [(r.source_navigation, r.target_navigation) for r in result.class_model.association_relationships]
+    assert navigation == [("True", "True"), ("False", "False")]
+    assert _codes(result).count("schema_anomaly") == 3
+
+
+def _stage(puml, lose):
+    """包装一个会丢掉lose中的类、并清空其余类成员的假节点"""
+    def node(state):
+        classes = [c.model_copy(update={"attributes": []}) for c in state.class_model.classes if c.class_name not in lose]
+        return state.model_copy(update={"class_model": puml.ClassDiagram(classes=classes)})
+
+    return puml._validated_stage("测试阶段", node)
+
+
+def test_lost_class_is_requeried_exactly_once(puml, fake_llm):
+    fake = fake_llm()
+    model = puml.ClassDiagram(classes=[_cls(puml, "甲"), _cls(puml, "乙")])
+    state = puml.AgentState(usecase_file_path="", input_text="需求", class_model=model,
+                            analyzed={"analyze_features": ["甲", "乙"]})
+    stage = _stage(puml, {"乙"})
+    state = stage(state)
+    assert [c.class_name for c in state.class_model.classes] == ["甲", "乙"]
+    features = [p for p in fake.prompts if "为选定类的添加特征" in p]
+    assert len(features) == 2
+    assert sorted(state.requeried) == ["乙", "甲"]
+
+    fake.prompts.clear()
+    state = stage(state)
+    assert [p for p in fake.prompts if "为选定类的添加特征" in p] == []
+    assert "乙" in [c.class_name for c in state.class_model.classes]
+
+
+def test_empty_classes_without_feature_analysis_are_not_reported(puml, fake_llm):
+    fake = fake_llm()
+    model = puml.ClassDiagram(classes=[_cls(puml, "甲", []), _cls(puml, "乙", [])])
+    state = puml.AgentState(usecase_file_path="", input_text="需求", class_model=model,
+                            analyzed={"analyze_features": ["甲"]})
+    state = puml._validated_stage("测试阶段", lambda s: s)(state)
+    assert [(d.code, d.classes) for d in state.diagnostics] == [("empty_class", ["甲"])]
+    assert state.requeried == ["甲"]
+    assert len([p for p in fake.prompts if "为选定类的添加特征" in p]) == 1
@@ -0,0 +1,66 @@
+import os
+
+PUML = "@startuml\nclass {name} {{\n -编号\n +查询()\n}}\n@enduml\n"
+
+
+def _watcher(puml, tmp_path):
+    watcher = puml.PlantUMLWatcher(str(tmp_path), interval=0.01, debounce=0.0)
+    watcher.load()
+    return watcher
+
+
+def _touch(path, content):
+    path.write_bytes(content if isinstance(content, bytes) else content.encode("utf-8"))
+    # 保证修改时间或大小变化能被轮询发现
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+
+def test_same_stem_sources_write_separate_outputs(puml, tmp_path):
+    (tmp_path / "a.puml").write_text(PUML.format(name="学生"), encoding="utf-8")
+    (tmp_path / "a.txt").write_text(PUML.format(name="课程"), encoding="utf-8")
+    watcher = _watcher(puml, tmp_path)
+    out = tmp_path / "_refined"
+    assert "学生" in (out / "a.puml").read_text(encoding="utf-8")
+    assert "课程" in (out / "a.txt.puml").read_text(encoding="utf-8")
+
+    (tmp_path / "a.txt").unlink()
+    events = watcher.poll()
+    assert [e.summary for e in events] == ["文件已删除，移除输出"]
+    assert not (out / "a.txt.puml").exists()
+    assert "学生" in (out / "a.puml").read_text(encoding="utf-8")
+
+
+def test_removing_a_source_keeps_outputs_it_did_not_write(puml, tmp_path):
+    # a.txt不含类定义，是需求文本，不拥有任何输出
+    (tmp_path / "a.txt").write_text("需求文本", encoding="utf-8")
+    watcher = _watcher(puml, tmp_path)
+    out = tmp_path / "_refined"
+    out.mkdir(exist_ok=True)
+    (out / "a.txt.puml").write_text("手工文件", encoding="utf-8")
+    (tmp_path / "a.txt").unlink()
+    assert watcher.poll() == []
+    assert (out / "a.txt.puml").read_text(encoding="utf-8") == "手工文件"
+
+
+def test_bad_file_reports_an_error_and_watching_continues(puml, tmp_path):
+    good, bad = tmp_path / "good.puml", tmp_path / "bad.puml"
+    good.write_text(PUML.format(name="学生"), encoding="utf-8")
+    bad.write_text(PUML.format(name="课程"), encoding="utf-8")
+    watcher = _watcher(puml, tmp_path)
+    out = tmp_path / "_refined"
+
+    _touch(bad, b"@startuml\nclass \xff\xfe {\n}\n@enduml\n")
+    _touch(good, PUML.format(name="老师"))
+    events = {os.path.basename(e.path): e for e in watcher.poll()}
+    assert events["bad.puml"].error.startswith("UnicodeDecodeError")
+    assert not events["good.puml"].error
+    assert "老师" in (out / "good.puml").read_text(encoding="utf-8")
+    # 失败时保留上一版本的输出，修好后重新处理
+    assert "课程" in (out / "bad.puml").read_text(encoding="utf-8")
+
+    _touch(bad, PUML.format(name="教室"))
+    events = watcher.poll()
+    assert [e.error for e in events] == [""]
+    assert "教室" in (out / "bad.puml").read_text(encoding="utf-8")
+    assert watcher.stats()["errors"] == 1